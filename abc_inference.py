@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+
+"""Approximate Bayesian computation for agent models without a tractable likelihood.
+
+Agents are simulated playing the task, vectorized over sessions as in
+simulate.py, and each session is compressed to summary statistics: the stay
+probabilities after rewarded and unrewarded, common and rare trials, the
+reward rate, the rate of slow trials and quantiles of the response times of
+both stages. The models extend the hybrid agent of hybrid.py with learning of
+the transition probability or forgetting of the values of options not
+chosen, and response times are drawn from a Wald distribution, the time for a
+diffusion to reach a single boundary, with a drift rate that grows with the
+difference between the values of the options. The posterior of each session
+is approximated by rejection, from a reference table of sessions simulated
+from the prior and stored on disk for reuse, or by sequential Monte Carlo
+ABC (ABC-PMC of Beaumont et al., 2009). Simulations run in parallel."""
+
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import *
+
+import argparse
+import csv
+import io
+import multiprocessing
+
+import numpy as np
+
+import hybrid
+from analysis import CONDITIONS
+from cache import ArtifactStore, content_hash
+from hierarchical import load_cohort
+from results import add_exclude_argument, select_sessions, get_config, get_chunks
+from simulate import create_reward_probabilities, diffuse, get_reward_probability
+from two_step import RESULTS_DIR, MAX_WAIT
+
+# Response time parameters: boundary of the diffusion and non-decision time (s)
+RT_PARAMETERS = ('a', 't0')
+# Parameters of each model, with eta the learning rate of the transition
+# probability and phi the rate at which values not chosen return to 0.5
+MODELS = {
+    'hybrid': hybrid.PARAMETERS + RT_PARAMETERS,
+    'transition_learning': hybrid.PARAMETERS + ('eta',) + RT_PARAMETERS,
+    'forgetting': hybrid.PARAMETERS + ('phi',) + RT_PARAMETERS,
+}
+# Bounds of the uniform prior of each parameter
+BOUNDS = {
+    'alpha': (0., 1.), 'beta': (0., 10.), 'w': (0., 1.), 'persev': (-1., 1.),
+    'eta': (0., 0.5), 'phi': (0., 0.5), 'a': (0.5, 3.), 't0': (0.1, 1.),
+}
+# Drift rate of a choice between options of equal value
+BASE_DRIFT = 1.
+# Quantiles of the response times in the summary statistics
+QUANTILES = (0.1, 0.5, 0.9)
+STATISTICS = (
+    ['stay_{}_{}'.format(reward, transition) for reward, transition, _, _ in CONDITIONS] +
+    ['reward_rate', 'slow_rate'] +
+    ['rt{}_q{}'.format(stage, int(100*q)) for stage in (1, 2) for q in QUANTILES])
+# Sessions simulated in each chunk of a reference table
+TABLE_CHUNK = 10000
+# Increase when the simulation of the agents or the summary statistics change
+SIMULATOR_VERSION = 1
+
+def sample_prior(rng, model, num_samples):
+    "Get parameter values drawn from the prior, one row per sample."
+    bounds = np.array([BOUNDS[name] for name in MODELS[model]])
+    return rng.uniform(bounds[:, 0], bounds[:, 1], (num_samples, len(bounds)))
+
+def in_prior(model, theta):
+    "Get whether each row of parameter values is within the bounds of the prior."
+    bounds = np.array([BOUNDS[name] for name in MODELS[model]])
+    return ((theta > bounds[:, 0]) & (theta < bounds[:, 1])).all(axis=-1)
+
+def to_params(model, theta):
+    "Get a dictionary of parameter arrays from rows of parameter values."
+    return {name: theta[..., i] for i, name in enumerate(MODELS[model])}
+
+def simulate_sessions(rng, model, params, num_trials, common_prob, diffusion_rate):
+    """Simulate sessions of agents, one per element of the parameter arrays.
+
+    Returns arrays coded as by hierarchical.load_cohort, with slow trials when
+    a response would take longer than MAX_WAIT."""
+    shape = params['alpha'].shape
+    probs = create_reward_probabilities(rng, shape + (2, 2))
+    q1, q2 = hybrid.initial_values(shape)
+    # Believed probability of the common transitions
+    belief = np.full(shape, common_prob)
+    prev_choice1 = np.full(shape, -1)
+    data = {key: np.zeros(shape + (num_trials,), dtype=int)
+            for key in ('choice1', 'final_state', 'choice2', 'reward')}
+    data['rt1'] = np.zeros(shape + (num_trials,))
+    data['rt2'] = np.zeros(shape + (num_trials,))
+    for t in range(num_trials):
+        logit1 = hybrid.first_stage_logit(q1, q2, params, prev_choice1, belief[..., None])
+        choice1 = (rng.random(shape) < 1/(1 + np.exp(-logit1))).astype(int)
+        rt1 = params['t0'] + rng.wald(params['a']/(BASE_DRIFT + np.abs(logit1)), params['a']**2)
+        common = rng.random(shape) < common_prob
+        final_state = np.where(common, choice1, 1 - choice1)
+        logit2 = hybrid.second_stage_logit(q2, final_state, params)
+        choice2 = (rng.random(shape) < 1/(1 + np.exp(-logit2))).astype(int)
+        rt2 = params['t0'] + rng.wald(params['a']/(BASE_DRIFT + np.abs(logit2)), params['a']**2)
+        reward = (rng.random(shape) < get_reward_probability(probs, final_state, choice2)).astype(int)
+        slow1 = rt1 > MAX_WAIT
+        slow2 = slow1 | (rt2 > MAX_WAIT)
+        choice1 = np.where(slow1, -1, choice1)
+        final_state = np.where(slow1, -1, final_state)
+        choice2 = np.where(slow2, -1, choice2)
+        reward = np.where(slow2, 0, reward)
+        if 'eta' in params:
+            belief += params['eta']*((final_state == choice1) - belief)*(choice1 >= 0)
+        hybrid.update(q1, q2, choice1, final_state, choice2, reward, params)
+        if 'phi' in params:
+            first = hybrid.one_hot(choice1)
+            second = hybrid.one_hot(final_state)[..., :, None]*hybrid.one_hot(choice2)[..., None, :]
+            q1 += params['phi'][..., None]*(0.5 - q1)*(1 - first)
+            q2 += params['phi'][..., None, None]*(0.5 - q2)*(1 - second)
+        for key, value in (('choice1', choice1), ('final_state', final_state), ('choice2', choice2),
+                           ('reward', reward), ('rt1', np.where(slow1, -1, rt1)),
+                           ('rt2', np.where(slow2, -1, rt2))):
+            data[key][..., t] = value
+        prev_choice1 = np.where(choice1 >= 0, choice1, prev_choice1)
+        probs = diffuse(rng, probs, diffusion_rate)
+    return data
+
+def get_summary_statistics(data):
+    """Get the summary statistics of each session, in the order of STATISTICS.
+
+    Stay probabilities are smoothed by half a stay and half a switch, so they
+    are defined in conditions without trials, and the response time
+    quantiles of sessions without responses are MAX_WAIT."""
+    played = ~np.isnan(data['rt1'])
+    complete = data['choice2'] >= 0
+    common = (data['final_state'] == data['choice1']).astype(int)
+    stay = data['choice1'][..., 1:] == data['choice1'][..., :-1]
+    pairs = complete[..., :-1] & complete[..., 1:]
+    statistics = []
+    for _, _, cond_reward, cond_common in CONDITIONS:
+        in_condition = pairs & (data['reward'][..., :-1] == cond_reward) & (common[..., :-1] == cond_common)
+        statistics.append(((stay & in_condition).sum(axis=-1) + 0.5)/(in_condition.sum(axis=-1) + 1))
+    num_played = np.maximum(played.sum(axis=-1), 1)
+    statistics.append(data['reward'].sum(axis=-1)/num_played)
+    statistics.append((played & ~complete).sum(axis=-1)/num_played)
+    for key in ('rt1', 'rt2'):
+        # Quantiles with linear interpolation, as np.quantile, of the
+        # response times sorted before the missing ones
+        rt = np.sort(np.where(data[key] > 0, data[key], np.inf), axis=-1)
+        rt[np.isinf(rt)] = MAX_WAIT
+        num_responses = (data[key] > 0).sum(axis=-1)
+        for q in QUANTILES:
+            position = q*np.maximum(num_responses - 1, 0)
+            lower = np.floor(position).astype(int)
+            upper = np.minimum(lower + 1, np.maximum(num_responses - 1, 0))
+            rt_lower = np.take_along_axis(rt, lower[..., None], axis=-1)[..., 0]
+            rt_upper = np.take_along_axis(rt, upper[..., None], axis=-1)[..., 0]
+            statistics.append(rt_lower + (position - lower)*(rt_upper - rt_lower))
+    return np.stack(statistics, axis=-1)
+
+def _simulate_chunk(args):
+    "Get the summary statistics of sessions simulated with given parameter values."
+    model, theta, settings, seed = args
+    rng = np.random.default_rng(seed)
+    return get_summary_statistics(simulate_sessions(rng, model, to_params(model, theta), *settings))
+
+def _table_chunk(args):
+    "Get a chunk of a reference table, with parameter values drawn from the prior."
+    model, settings, num_sessions, seed = args
+    rng = np.random.default_rng(seed)
+    theta = sample_prior(rng, model, num_sessions)
+    return {'theta': theta, 'statistics': _simulate_chunk((model, theta, settings, rng.integers(2**32)))}
+
+def simulate_statistics(pool, processes, model, theta, settings, seed_sequence):
+    """Get the summary statistics of sessions simulated in parallel, one per row of theta.
+
+    theta is split into a chunk for each of the pool's processes. The seeds
+    of the chunks are spawned from a SeedSequence, so each call gets new ones."""
+    chunks = [theta[chunk] for chunk in get_chunks(len(theta), processes)]
+    if not chunks:
+        # All proposals of a batch can be outside the prior
+        return np.empty((0, len(STATISTICS)))
+    seeds = seed_sequence.spawn(len(chunks))
+    return np.concatenate(pool.map(_simulate_chunk, [
+        (model, chunk, settings, chunk_seed) for chunk, chunk_seed in zip(chunks, seeds)]))
+
+def get_reference_table(pool, model, num_sessions, settings, store, seed=0):
+    """Get a reference table of sessions simulated from the prior.
+
+    The table is made of chunks stored under a content hash of everything
+    they depend on, so a larger table reuses the chunks of a smaller one."""
+    keys = [
+        content_hash({'simulator': SIMULATOR_VERSION, 'model': model,
+                      'bounds': [BOUNDS[name] for name in MODELS[model]],
+                      'settings': list(settings), 'chunk_size': TABLE_CHUNK,
+                      'seed': seed, 'chunk': chunk})
+        for chunk in range(-(-num_sessions//TABLE_CHUNK))
+    ]
+    missing = [chunk for chunk, key in enumerate(keys) if key not in store]
+    for chunk, result in zip(missing, pool.imap(_table_chunk, [
+            (model, settings, TABLE_CHUNK, [seed, chunk]) for chunk in missing])):
+        store[keys[chunk]] = result
+    chunks = [store[key] for key in keys]
+    return (np.concatenate([chunk['theta'] for chunk in chunks])[:num_sessions],
+            np.concatenate([chunk['statistics'] for chunk in chunks])[:num_sessions])
+
+def get_scale(statistics):
+    "Get the scale of each summary statistic, from its median absolute deviation."
+    mad = 1.4826*np.median(np.abs(statistics - np.median(statistics, axis=0)), axis=0)
+    return np.where(mad > 0, mad, np.maximum(statistics.std(axis=0), 1e-6))
+
+def get_distances(statistics, observed, scale):
+    "Get the distances between simulated and observed summary statistics."
+    return np.sqrt((((statistics - observed)/scale)**2).sum(axis=-1))
+
+def rejection(theta, statistics, observed, quantile=0.001):
+    """Get the posterior samples of a session by rejection from a reference table.
+
+    Keeps the parameter values of the simulated sessions closest to the
+    observed one."""
+    distances = get_distances(statistics, observed, get_scale(statistics))
+    num_accepted = max(1, int(quantile*len(theta)))
+    accepted = np.argpartition(distances, num_accepted - 1)[:num_accepted]
+    return theta[accepted], np.full(num_accepted, 1/num_accepted)
+
+def smc(pool, processes, model, observed, settings, num_particles=1000, num_generations=6,
+        initial_samples=10000, tolerance_quantile=0.5, max_simulations=1000000, seed=0):
+    """Get weighted posterior samples of a session by sequential Monte Carlo ABC.
+
+    The first generation keeps the closest of sessions simulated from the
+    prior. Each following generation lowers the tolerance to a quantile of
+    the distances of the previous one and perturbs its particles with a
+    Gaussian kernel of twice their covariance, until enough simulated
+    sessions are within the tolerance."""
+    if num_particles < 1:
+        raise ValueError('SMC-ABC needs at least one particle, not {}'.format(num_particles))
+    seed_sequence = np.random.SeedSequence(seed)
+    rng = np.random.default_rng(seed_sequence.spawn(1)[0])
+    theta = sample_prior(rng, model, initial_samples)
+    statistics = simulate_statistics(pool, processes, model, theta, settings, seed_sequence)
+    scale = get_scale(statistics)
+    distances = get_distances(statistics, observed, scale)
+    best = np.argsort(distances)[:num_particles]
+    particles, distances = theta[best], distances[best]
+    weights = np.full(num_particles, 1/num_particles)
+    num_simulations = initial_samples
+    for _ in range(1, num_generations):
+        tolerance = np.quantile(distances, tolerance_quantile)
+        cov = 2*np.cov(particles, rowvar=False, aweights=weights)
+        chol = np.linalg.cholesky(cov + 1e-12*np.eye(len(cov)))
+        accepted, accepted_distances = [], []
+        batch_size = num_particles
+        while sum(len(batch) for batch in accepted) < num_particles:
+            if num_simulations >= max_simulations:
+                return particles, weights
+            ancestors = rng.choice(num_particles, batch_size, p=weights)
+            proposals = particles[ancestors] + rng.standard_normal(particles[ancestors].shape).dot(chol.T)
+            proposals = proposals[in_prior(model, proposals)]
+            batch_distances = get_distances(
+                simulate_statistics(pool, processes, model, proposals, settings, seed_sequence), observed, scale)
+            num_simulations += len(proposals)
+            within = batch_distances <= tolerance
+            accepted.append(proposals[within])
+            accepted_distances.append(batch_distances[within])
+            # Simulate enough for the particles still needed at the acceptance rate so far
+            rate = max(sum(len(batch) for batch in accepted), 1)/num_simulations
+            batch_size = int(min(max(num_particles, (num_particles - len(accepted[-1]))/rate), 10*num_particles))
+        new_particles = np.concatenate(accepted)[:num_particles]
+        # Importance weights of the uniform prior against the mixture of perturbation kernels
+        deviations = np.linalg.solve(chol, (new_particles[:, None, :] - particles[None, :, :]).reshape(
+            -1, particles.shape[1]).T).T.reshape(num_particles, num_particles, -1)
+        kernel = np.exp(-0.5*(deviations**2).sum(axis=-1)).dot(weights)
+        weights = 1/kernel
+        weights /= weights.sum()
+        particles = new_particles
+        distances = np.concatenate(accepted_distances)[:num_particles]
+    return particles, weights
+
+def summarize_posterior(model, particles, weights):
+    "Get the posterior mean and standard deviation of each parameter."
+    mean = weights.dot(particles)
+    sd = np.sqrt(weights.dot((particles - mean)**2))
+    return {name: (mean[i], sd[i]) for i, name in enumerate(MODELS[model])}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--results-dir', default=RESULTS_DIR)
+    parser.add_argument('--session', choices=('tutorial', 'game'), default='game')
+    parser.add_argument('--model', choices=sorted(MODELS), default='hybrid')
+    parser.add_argument('--method', choices=('rejection', 'smc'), default='rejection')
+    parser.add_argument(
+        '--table-sessions', type=int, default=1000000, help='sessions in the reference table')
+    parser.add_argument(
+        '--quantile', type=float, default=0.001, help='fraction of the table accepted by rejection')
+    parser.add_argument('--particles', type=int, default=1000, help='particles of SMC-ABC')
+    parser.add_argument('--generations', type=int, default=6, help='generations of SMC-ABC')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='CSV file for the posterior of each session')
+    add_exclude_argument(parser)
+    args = parser.parse_args()
+
+    paths = select_sessions(args.results_dir, args.session, args.exclude)
+    labels, data = load_cohort(paths, by_subject=False) if paths else ([], None)
+    if not labels:
+        print('No sessions to fit')
+        return
+    config = get_config(paths[0])
+    settings = (config.num_trials, config.common_prob, config.diffusion_rate)
+    observed = get_summary_statistics(data)
+    processes = args.processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes)
+    try:
+        if args.method == 'rejection':
+            theta, statistics = get_reference_table(
+                pool, args.model, args.table_sessions, settings, ArtifactStore('abc_tables'), args.seed)
+            posteriors = [rejection(theta, statistics, session, args.quantile) for session in observed]
+        else:
+            posteriors = [
+                smc(pool, processes, args.model, session, settings, args.particles, args.generations, seed=[args.seed, i])
+                for i, session in enumerate(observed)
+            ]
+    finally:
+        pool.close()
+        pool.join()
+
+    rows = []
+    print('{:<30}'.format('') + ''.join('{:>14}'.format(name) for name in MODELS[args.model]))
+    for label, (particles, weights) in zip(labels, posteriors):
+        posterior = summarize_posterior(args.model, particles, weights)
+        print('{:<30}'.format(label) + ''.join(
+            '{:>7.3f} ({:.2f})'.format(*posterior[name]) for name in MODELS[args.model]))
+        rows.extend((label, args.model, name) + posterior[name] for name in MODELS[args.model])
+    if args.output:
+        with io.open(args.output, 'w', newline='') as outf:
+            csv_writer = csv.writer(outf)
+            csv_writer.writerow(('session', 'model', 'parameter', 'mean', 'sd'))
+            csv_writer.writerows(rows)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""Adaptive choice of the task parameters between blocks of trials.
+
+The transition probability and the diffusion rate of the reward
+probabilities are chosen for each block to maximize the expected information
+about the participant's model-based weight. The expected information depends
+on precomputed tables of log-likelihoods of simulated blocks, built offline
+by running this module, so that choosing the next design only takes a few
+array operations on a memory-mapped table."""
+
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import *
+
+import argparse
+import io
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+import hybrid
+from simulate import simulate_hybrid
+from two_step import DESIGN_TABLE
+
+# Design parameters considered for each block
+COMMON_PROBS = (0.6, 0.7, 0.8, 0.9)
+DIFFUSION_RATES = (0.0125, 0.025, 0.05, 0.1)
+# Model-based weights for which the tables are computed, as in the online estimator
+WS = hybrid.OnlineEstimator.WS
+
+def get_metadata_path(table_path):
+    return os.path.splitext(table_path)[0] + '.json'
+
+def _simulate_design(args):
+    """Get the log-likelihoods of simulated blocks under each model-based weight.
+
+    The other parameters are drawn at random for each simulated block and
+    assumed known when computing the likelihoods."""
+    common_prob, diffusion_rate, block_length, num_samples, seed = args
+    rng = np.random.default_rng(seed)
+    table = np.zeros((len(WS), num_samples, len(WS)), dtype=np.float32)
+    for i, w in enumerate(WS):
+        params = {
+            'alpha': rng.uniform(0.2, 0.8, num_samples),
+            'beta': rng.uniform(2, 8, num_samples),
+            'w': np.full(num_samples, w),
+            'persev': rng.uniform(0, 1, num_samples),
+        }
+        sessions = simulate_hybrid(rng, params, block_length, common_prob, diffusion_rate)
+        fit_params = {name: value[:, None] for name, value in params.items()}
+        fit_params['w'] = WS[None, :]
+        table[i] = hybrid.log_likelihood(
+            fit_params, *[sessions[key][:, None, :]
+                          for key in ('choice1', 'final_state', 'choice2', 'reward')],
+            common_prob=common_prob)
+    return table
+
+def build_tables(table_path, block_length=10, num_samples=500, processes=None, seed=0):
+    "Build the tables for all designs in parallel and save them to disk."
+    designs = [(common_prob, diffusion_rate)
+               for common_prob in COMMON_PROBS for diffusion_rate in DIFFUSION_RATES]
+    seeds = np.random.SeedSequence(seed).spawn(len(designs))
+    pool = multiprocessing.Pool(processes)
+    try:
+        table = np.array(pool.map(_simulate_design, [
+            (common_prob, diffusion_rate, block_length, num_samples, design_seed)
+            for (common_prob, diffusion_rate), design_seed in zip(designs, seeds)
+        ]))
+    finally:
+        pool.close()
+        pool.join()
+    np.save(table_path, table)
+    with io.open(get_metadata_path(table_path), 'w', encoding='utf-8') as outf:
+        outf.write(json.dumps({
+            'designs': designs,
+            'ws': WS.tolist(),
+            'block_length': block_length,
+            'num_samples': num_samples,
+        }))
+
+class AdaptiveDesign(object):
+    "Chooses the task parameters at the end of each block from precomputed tables."
+    def __init__(self, table_path, estimator):
+        try:
+            with io.open(get_metadata_path(table_path), 'r', encoding='utf-8') as inf:
+                metadata = json.load(inf)
+        except (IOError, OSError):
+            raise IOError('No adaptive design table in {}, build it first by running adaptive_design.py'.format(
+                table_path))
+        assert np.allclose(metadata['ws'], WS)
+        self.designs = [tuple(design) for design in metadata['designs']]
+        self.block_length = metadata['block_length']
+        # Tables have dimensions design, true weight, simulated block, fitted weight
+        self.table = np.load(table_path, mmap_mode='r')
+        self.estimator = estimator
+        self.history = []
+    def get_expected_information(self, w_posterior):
+        "Get the expected information gain about the model-based weight for each design."
+        log_prior = np.log(np.maximum(w_posterior, 1e-12))
+        table = np.asarray(self.table)
+        log_marginal = np.logaddexp.reduce(table + log_prior, axis=-1)
+        log_own = np.diagonal(table, axis1=1, axis2=3).transpose(0, 2, 1)
+        return ((log_own - log_marginal).mean(axis=-1)*w_posterior).sum(axis=-1)
+    def next_trial(self, config, trials):
+        "Set the parameters of the configuration for the next block if a block has ended."
+        if trials % self.block_length:
+            return
+        w_axis = hybrid.PARAMETERS.index('w')
+        posterior = self.estimator.get_posterior()
+        w_posterior = posterior.sum(axis=tuple(
+            axis for axis in range(posterior.ndim) if axis != w_axis))
+        information = self.get_expected_information(w_posterior)
+        best = int(np.argmax(information))
+        config.common_prob, config.diffusion_rate = self.designs[best]
+        self.estimator.common_prob = config.common_prob
+        self.history.append({
+            'trial': trials,
+            'common_prob': config.common_prob,
+            'diffusion_rate': config.diffusion_rate,
+            'information': float(information[best]),
+        })
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the adaptive design tables.')
+    parser.add_argument('--output', default=DESIGN_TABLE)
+    parser.add_argument('--block-length', type=int, default=10)
+    parser.add_argument('--samples', type=int, default=500, help='simulated blocks per design and weight')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    build_tables(args.output, args.block_length, args.samples, args.processes, args.seed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+"""Stay probability analysis of the two-stage task results.
+
+Computes the probability of repeating the previous first-stage choice by
+previous reward and previous transition (common or rare), and a logistic
+regression of stays on reward, transition and their interaction, with
+bootstrap confidence intervals obtained by resampling subjects."""
+
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import *
+
+import argparse
+
+import numpy as np
+
+from cache import JsonCache, file_hash
+from results import (add_exclude_argument, select_sessions, get_subject, load_session, get_chunks,
+                     map_chunks)
+from two_step import RESULTS_DIR
+
+# Conditions in the order they are reported
+CONDITIONS = (
+    ('rewarded', 'common', 1, 1),
+    ('rewarded', 'rare', 1, 0),
+    ('unrewarded', 'common', 0, 1),
+    ('unrewarded', 'rare', 0, 0),
+)
+COEFFICIENTS = ('intercept', 'reward', 'transition', 'reward:transition')
+
+def summarize_session(session):
+    """Get the previous reward, previous transition and stay for each pair of
+    consecutive trials in a session, skipping pairs with a slow trial."""
+    valid = (session['slow'][:-1] == 0) & (session['slow'][1:] == 0)
+    return {
+        'reward': session['reward'][:-1][valid].astype(int).tolist(),
+        'common': session['common'][:-1][valid].astype(int).tolist(),
+        'stay': (session['choice1'][1:] == session['choice1'][:-1])[valid].astype(int).tolist(),
+    }
+
+def load_summaries(paths, cache):
+    "Get the summary of each session, processing only files not in the cache."
+    summaries = []
+    for path in paths:
+        key = file_hash(path)
+        if key not in cache:
+            session = load_session(path)
+            cache[key] = summarize_session(session) if len(session['trial']) else None
+        if cache[key] is not None:
+            summaries.append((get_subject(path), cache[key]))
+    return summaries
+
+def get_subject_data(summaries):
+    "Join the summaries of the sessions of each subject into NumPy arrays."
+    subjects = {}
+    for subject, summary in summaries:
+        subjects.setdefault(subject, []).append(summary)
+    subject_data = []
+    for subject in sorted(subjects):
+        reward, common, stay = [
+            np.concatenate([np.array(summary[key], dtype=int) for summary in subjects[subject]])
+            for key in ('reward', 'common', 'stay')
+        ]
+        if len(stay):
+            subject_data.append((subject, reward, common, stay))
+    return subject_data
+
+def get_stay_probabilities(reward, common, stay):
+    "Get the stay probability in each condition, NaN for conditions with no trials."
+    probs = np.full(len(CONDITIONS), np.nan)
+    for i, (_, _, cond_reward, cond_common) in enumerate(CONDITIONS):
+        in_condition = (reward == cond_reward) & (common == cond_common)
+        if in_condition.any():
+            probs[i] = stay[in_condition].mean()
+    return probs
+
+def get_design_matrix(reward, common):
+    "Get the design matrix for the logistic regression, with effects coded as -1 and +1."
+    reward = 2*reward - 1
+    common = 2*common - 1
+    return np.column_stack((np.ones(len(reward)), reward, common, reward*common))
+
+def fit_logistic(X, y, max_iterations=50, tol=1e-8):
+    "Fit a logistic regression by Newton-Raphson."
+    coefs = np.zeros(X.shape[1])
+    # A small ridge keeps the fit finite when stays are perfectly separated
+    ridge = 1e-4*np.eye(X.shape[1])
+    for _ in range(max_iterations):
+        p = 1/(1 + np.exp(-X.dot(coefs)))
+        grad = X.T.dot(y - p) - ridge.dot(coefs)
+        hess = (X*(p*(1 - p))[:, None]).T.dot(X) + ridge
+        step = np.linalg.solve(hess, grad)
+        coefs += step
+        if np.abs(step).max() < tol:
+            break
+    return coefs
+
+def get_statistics(subject_probs, subject_X, subject_y, sample):
+    "Get the mean stay probabilities and regression coefficients for a sample of subjects."
+    probs = np.nanmean(subject_probs[sample], axis=0)
+    coefs = fit_logistic(
+        np.concatenate([subject_X[i] for i in sample]),
+        np.concatenate([subject_y[i] for i in sample]))
+    return np.concatenate((probs, coefs))
+
+def _bootstrap_chunk(args):
+    "Compute the statistics for a chunk of bootstrap samples in a worker process."
+    subject_probs, subject_X, subject_y, seed, num_samples = args
+    rng = np.random.default_rng(seed)
+    num_subjects = len(subject_probs)
+    return np.array([
+        get_statistics(
+            subject_probs, subject_X, subject_y, rng.integers(num_subjects, size=num_subjects))
+        for _ in range(num_samples)
+    ])
+
+def analyze(subject_data, num_samples=2000, processes=None, seed=0, alpha=0.05):
+    """Get the statistics and their bootstrap confidence intervals.
+
+    Bootstrap samples are split into chunks computed in parallel, one chunk per process."""
+    subject_probs = np.array([
+        get_stay_probabilities(reward, common, stay) for _, reward, common, stay in subject_data])
+    subject_X = [get_design_matrix(reward, common) for _, reward, common, _ in subject_data]
+    subject_y = [stay for _, _, _, stay in subject_data]
+    estimates = get_statistics(subject_probs, subject_X, subject_y, np.arange(len(subject_data)))
+    if num_samples < 1:
+        return estimates, None
+    chunk_sizes = [len(chunk) for chunk in get_chunks(num_samples, processes)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+    samples = np.concatenate(map_chunks(_bootstrap_chunk, [
+        (subject_probs, subject_X, subject_y, chunk_seed, chunk_size)
+        for chunk_seed, chunk_size in zip(seeds, chunk_sizes)
+    ]))
+    intervals = np.nanpercentile(samples, [100*alpha/2, 100*(1 - alpha/2)], axis=0).T
+    return estimates, intervals
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--results-dir', default=RESULTS_DIR)
+    parser.add_argument('--bootstrap', type=int, default=2000, help='number of bootstrap samples')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    add_exclude_argument(parser)
+    args = parser.parse_args()
+
+    paths = select_sessions(args.results_dir, exclude=args.exclude)
+    cache = JsonCache('analysis')
+    summaries = load_summaries(paths, cache)
+    cache.save()
+    subject_data = get_subject_data(summaries)
+    if not subject_data:
+        print('No trials to analyze')
+        return
+    print('Subjects: {}, trial pairs: {}'.format(
+        len(subject_data), sum(len(stay) for _, _, _, stay in subject_data)))
+
+    estimates, intervals = analyze(subject_data, args.bootstrap, args.processes, args.seed)
+    labels = ['P(stay | {}, {})'.format(reward, transition) for reward, transition, _, _ in CONDITIONS]
+    labels += ['coef {}'.format(name) for name in COEFFICIENTS]
+    for i, label in enumerate(labels):
+        if intervals is None:
+            print('{:<35} {:7.3f}'.format(label, estimates[i]))
+        else:
+            print('{:<35} {:7.3f}  [{:7.3f}, {:7.3f}]'.format(
+                label, estimates[i], intervals[i, 0], intervals[i, 1]))
+
+if __name__ == '__main__':
+    main()
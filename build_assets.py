@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+"""Builds the texture variants of the images in the assets directory for each window size.
+
+The images are laid out for a 1280x1024 design and drawn centered in pixel
+units, so a window smaller than the design only shows the middle of each
+image. For each window size, every image is cropped to the part that can be
+on the screen and trimmed of its transparent borders, and the position and
+size at which the trimmed texture must be drawn, in design pixels, are
+written to a manifest. The images are drawn pixel for pixel where they were
+before, while each texture only has the pixels that can be seen. At startup
+load_image_collection picks the smallest set that covers the window."""
+
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import *
+
+import argparse
+import io
+import json
+import math
+import os
+from os.path import join
+
+from PIL import Image
+
+from cache import file_hash
+from two_step import ASSETS_DIR, ASSET_VARIANTS_DIR, DESIGN_SIZE
+
+# Window sizes built by default: the test window, common lab screens and the design
+WINDOW_SIZES = ((800, 600), (1024, 768), (1366, 768), DESIGN_SIZE)
+
+def get_visible_box(image_size, window_size):
+    "Get the box of an image centered in a window that is on the screen, in image pixels."
+    box = []
+    for axis in (0, 1):
+        margin = (image_size[axis] - min(window_size[axis], image_size[axis]))/2
+        box.append((int(math.floor(margin)), image_size[axis] - int(math.floor(margin))))
+    return (box[0][0], box[1][0], box[0][1], box[1][1])
+
+def build_variant(image, window_size):
+    """Get the trimmed texture of an image for a window, with its position and size.
+
+    The position is that of the center of the texture relative to the center
+    of the image, in pixels with y upward as in PsychoPy."""
+    left, top, right, bottom = get_visible_box(image.size, window_size)
+    texture = image.crop((left, top, right, bottom))
+    if texture.mode in ('RGBA', 'LA') or 'transparency' in texture.info:
+        bbox = texture.convert('RGBA').getchannel('A').getbbox()
+        if bbox is None:
+            # Nothing of the image is visible, so keep a single transparent pixel
+            bbox = (0, 0, 1, 1)
+        texture = texture.crop(bbox)
+        left, top = left + bbox[0], top + bbox[1]
+    width, height = texture.size
+    pos = (left + width/2 - image.size[0]/2, image.size[1]/2 - (top + height/2))
+    return texture, pos, (width, height)
+
+def get_variant_name(window_size):
+    return '{}x{}'.format(*window_size)
+
+def build_assets(window_sizes=WINDOW_SIZES, assets_dir=ASSETS_DIR, variants_dir=ASSET_VARIANTS_DIR):
+    """Build the texture variants for each window size.
+
+    Images whose source is unchanged since the last build are not rebuilt."""
+    names = sorted(fn for fn in os.listdir(assets_dir) if os.path.splitext(fn)[1] == '.png')
+    for window_size in window_sizes:
+        directory = join(variants_dir, get_variant_name(window_size))
+        manifest_path = join(directory, 'manifest.json')
+        try:
+            with io.open(manifest_path, 'r', encoding='utf-8') as inf:
+                manifest = json.load(inf)
+        except (IOError, OSError, ValueError):
+            manifest = {'design_size': list(DESIGN_SIZE), 'window_size': list(window_size), 'images': {}}
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        source_bytes = variant_bytes = 0
+        images = {}
+        for fn in names:
+            name = os.path.splitext(fn)[0]
+            source_path = join(assets_dir, fn)
+            source_hash = file_hash(source_path)
+            entry = manifest['images'].get(name)
+            if (entry is None or entry['source_hash'] != source_hash or
+                    not os.path.exists(join(directory, entry['file']))):
+                image = Image.open(source_path)
+                texture, pos, size = build_variant(image, window_size)
+                texture.save(join(directory, fn), optimize=True)
+                entry = {'file': fn, 'source_hash': source_hash, 'pos': list(pos), 'size': list(size),
+                         'source_size': list(image.size)}
+            images[name] = entry
+            source_bytes += 4*entry['source_size'][0]*entry['source_size'][1]
+            variant_bytes += 4*entry['size'][0]*entry['size'][1]
+        manifest['images'] = images
+        # Write the manifest last, so an interrupted build is never used
+        tmp_path = manifest_path + '.tmp'
+        with io.open(tmp_path, 'w', encoding='utf-8') as outf:
+            outf.write(json.dumps(manifest, indent=1, sort_keys=True))
+        os.replace(tmp_path, manifest_path)
+        print('{}: {} images, {:.1f} MB of textures instead of {:.1f} MB'.format(
+            get_variant_name(window_size), len(images), variant_bytes/2**20, source_bytes/2**20))
+
+def parse_size(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--sizes', type=parse_size, nargs='+', default=list(WINDOW_SIZES),
+        help='window sizes as WIDTHxHEIGHT (default: {})'.format(
+            ' '.join(get_variant_name(size) for size in WINDOW_SIZES)))
+    args = parser.parse_args()
+    build_assets(args.sizes)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+"""On-disk caches for the analysis tools."""
+
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import *
+
+import hashlib
+import io
+import json
+import os
+from os.path import join
+
+import numpy as np
+
+from two_step import CURRENT_DIR
+
+# Directory for cached results, never committed
+CACHE_DIR = join(CURRENT_DIR, 'cache')
+
+def file_hash(path):
+    "Get the SHA-1 hash of the contents of a file."
+    sha1 = hashlib.sha1()
+    with io.open(path, 'rb') as inf:
+        for chunk in iter(lambda: inf.read(1 << 16), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def content_hash(description):
+    "Get the SHA-1 hash of a JSON-serializable description of how something was computed."
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+class JsonCache(object):
+    "A dictionary of JSON-serializable values kept in a file in the cache directory."
+    def __init__(self, name):
+        self.path = join(CACHE_DIR, '{}.json'.format(name))
+        try:
+            with io.open(self.path, 'r', encoding='utf-8') as inf:
+                self.data = json.load(inf)
+        except (IOError, OSError, ValueError):
+            self.data = {}
+        self.modified = False
+    def __contains__(self, key):
+        return key in self.data
+    def __getitem__(self, key):
+        return self.data[key]
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.modified = True
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+    def save(self):
+        "Write the cache to disk if it was modified."
+        if not self.modified:
+            return
+        if not os.path.exists(CACHE_DIR):
+            os.mkdir(CACHE_DIR)
+        # Write to a temporary file first so an interrupted run can't corrupt the cache
+        tmp_path = self.path + '.tmp'
+        with io.open(tmp_path, 'w', encoding='utf-8') as outf:
+            outf.write(json.dumps(self.data))
+        os.replace(tmp_path, self.path)
+        self.modified = False
+
+class ArtifactStore(object):
+    """Dictionaries of NumPy arrays kept in a directory in the cache directory.
+
+    Each entry is stored under a content hash of what it was computed from,
+    so entries never need to be invalidated."""
+    def __init__(self, name):
+        self.directory = join(CACHE_DIR, name)
+    def get_path(self, key):
+        return join(self.directory, '{}.npz'.format(key))
+    def __contains__(self, key):
+        return os.path.exists(self.get_path(key))
+    def __getitem__(self, key):
+        with np.load(self.get_path(key)) as arrays:
+            return dict(arrays)
+    def __setitem__(self, key, arrays):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        path = self.get_path(key)
+        tmp_path = path + '.tmp'
+        with io.open(tmp_path, 'wb') as outf:
+            np.savez(outf, **arrays)
+        os.replace(tmp_path, path)
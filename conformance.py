@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+"""Statistical checks that the generated trials match the task specification.
+
+Checks, over many generated trials, that transitions are common with the
+configured probability after the fixed first trials, that reward
+probabilities stay within their bounds and diffuse with the configured
+rate, that symbols are placed on either side with equal probability, and
+that rewards are given with their probabilities. The checks run on
+Trial.get_sequence, which generates the trials of the experiment, and on
+the vectorized generator in simulate.py and the task engine in task.py,
+which stand in for it in simulations, so that all are held to the same
+specification. Trial.get_sequence is the slowest, so the sessions are
+split between processes. All random seeds are fixed, so the results are reproducible.
+Exits with status 1 if any check fails."""
+
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import *
+
+import argparse
+import math
+import random
+import sys
+from itertools import chain
+
+import numpy as np
+from scipy import stats
+
+from results import get_chunks, map_chunks
+from simulate import generate_trials
+from task import Task
+from two_step import TutorialConfig, GameConfig, RewardProbability, Model, Trial
+
+CONFIGS = {'tutorial': TutorialConfig, 'game': GameConfig}
+# Significance level of each check
+ALPHA = 1e-3
+# Maximum number of values kept for the Kolmogorov-Smirnov tests
+SAMPLE_SIZE = 1000000
+# Sessions generated at once by the vectorized generator
+BATCH_SIZE = 100000
+# Number of bins of reward probability for the calibration check
+NUM_BINS = 10
+
+def get_sequence_trials(config, num_sessions, num_trials):
+    """Run Trial.get_sequence for several sessions in step.
+
+    Yields dictionaries of arrays in the same format as simulate.generate_trials."""
+    models = [Model.create_random(config) for _ in range(num_sessions)]
+    sequences = [Trial.get_sequence(config, model) for model in models]
+    fsymbol_index = {code: i for i, code in enumerate(chain(*config.final_state_symbols))}
+    # Pair of each final symbol and whether it is shown swapped when on the left
+    pairs = {code: (i, code != pair[0]) for i, pair in enumerate(config.final_state_symbols) for code in pair}
+    num_symbols = len(fsymbol_index)
+    for t in range(num_trials):
+        arrays = {
+            'trial': t,
+            'common': np.zeros(num_sessions, dtype=bool),
+            'isymbol_swapped': np.zeros(num_sessions, dtype=bool),
+            'fsymbol_swapped': np.zeros((num_sessions, len(config.final_state_symbols)), dtype=bool),
+            'reward_probabilities': np.zeros((num_sessions, num_symbols)),
+            'rewards': np.zeros((num_sessions, num_symbols), dtype=bool),
+        }
+        for i, (sequence, model) in enumerate(zip(sequences, models)):
+            trial = next(sequence)
+            arrays['common'][i] = trial.common
+            arrays['isymbol_swapped'][i] = trial.initial_state.symbols[0].code != model.isymbol_codes[0]
+            for isymbol in trial.initial_state.symbols:
+                symbols = isymbol.final_state.symbols
+                pair, swapped = pairs[symbols[0].code]
+                arrays['fsymbol_swapped'][i, pair] = swapped
+                for symbol in symbols:
+                    arrays['reward_probabilities'][i, fsymbol_index[symbol.code]] = symbol.reward_probability
+                    arrays['rewards'][i, fsymbol_index[symbol.code]] = symbol.reward
+        yield arrays
+
+def get_engine_trials(rng, config, num_sessions, num_trials):
+    """Generate trials with the task engine for several sessions at once.
+
+    Yields dictionaries of arrays in the same format as simulate.generate_trials."""
+    task = Task.from_config(config)
+    for trial in task.generate_trials(rng, num_sessions, num_trials):
+        yield {
+            'trial': trial['trial'],
+            'common': trial['common'][0][:, 0, 0],
+            'isymbol_swapped': trial['positions'][0][:, 0, 0] != 0,
+            'fsymbol_swapped': trial['positions'][1][:, :, 0] != 0,
+            'reward_probabilities': trial['reward_probabilities'].reshape(num_sessions, -1),
+            'rewards': trial['rewards'].reshape(num_sessions, -1),
+        }
+
+class Statistics(object):
+    "Sufficient statistics of generated trials for the checks, which can be merged."
+    def __init__(self, config):
+        self.config = config
+        self.counts = {key: 0 for key in (
+            'fixed', 'fixed_mismatches', 'trials', 'common', 'isymbols', 'isymbols_swapped',
+            'fsymbols', 'fsymbols_swapped', 'steps', 'step_sum', 'step_sumsq',
+            'rewards', 'reward_excess', 'reward_variance')}
+        self.prob_range = [np.inf, -np.inf]
+        self.bins = np.zeros((3, NUM_BINS))
+        self.step_sample = []
+        self.initial_sample = []
+        self.prev_probs = None
+    def add(self, trial):
+        "Add the statistics of a trial of each session."
+        counts = self.counts
+        config = self.config
+        t = trial['trial']
+        if t < len(config.fixed_common):
+            counts['fixed'] += len(trial['common'])
+            counts['fixed_mismatches'] += int((trial['common'] != config.fixed_common[t]).sum())
+        else:
+            counts['trials'] += len(trial['common'])
+            counts['common'] += int(trial['common'].sum())
+        counts['isymbols'] += trial['isymbol_swapped'].size
+        counts['isymbols_swapped'] += int(trial['isymbol_swapped'].sum())
+        counts['fsymbols'] += trial['fsymbol_swapped'].size
+        counts['fsymbols_swapped'] += int(trial['fsymbol_swapped'].sum())
+
+        probs = trial['reward_probabilities']
+        self.prob_range = [min(self.prob_range[0], probs.min()), max(self.prob_range[1], probs.max())]
+        if t == 0:
+            self._add_sample(self.initial_sample, probs.ravel())
+        else:
+            # Steps far from the boundaries, which are never reflected in practice
+            margin = 6*config.diffusion_rate
+            interior = ((self.prev_probs > RewardProbability.MIN_VALUE + margin) &
+                        (self.prev_probs < RewardProbability.MAX_VALUE - margin))
+            steps = (probs - self.prev_probs)[interior]
+            counts['steps'] += len(steps)
+            counts['step_sum'] += steps.sum()
+            counts['step_sumsq'] += (steps**2).sum()
+            self._add_sample(self.step_sample, steps)
+        self.prev_probs = probs
+
+        rewards = trial['rewards']
+        counts['rewards'] += rewards.size
+        counts['reward_excess'] += (rewards - probs).sum()
+        counts['reward_variance'] += (probs*(1 - probs)).sum()
+        bins = np.minimum(((probs - RewardProbability.MIN_VALUE)/(
+            RewardProbability.MAX_VALUE - RewardProbability.MIN_VALUE)*NUM_BINS).astype(int), NUM_BINS - 1)
+        self.bins[0] += np.bincount(bins.ravel(), rewards.ravel(), NUM_BINS)
+        self.bins[1] += np.bincount(bins.ravel(), probs.ravel(), NUM_BINS)
+        self.bins[2] += np.bincount(bins.ravel(), (probs*(1 - probs)).ravel(), NUM_BINS)
+    def _add_sample(self, sample, values):
+        kept = sum(len(part) for part in sample)
+        if kept < SAMPLE_SIZE:
+            sample.append(values[:SAMPLE_SIZE - kept].copy())
+    def merge(self, other):
+        "Add the statistics of other sessions."
+        for key in self.counts:
+            self.counts[key] += other.counts[key]
+        self.prob_range = [min(self.prob_range[0], other.prob_range[0]),
+                           max(self.prob_range[1], other.prob_range[1])]
+        self.bins += other.bins
+        for part in other.step_sample:
+            self._add_sample(self.step_sample, part)
+        for part in other.initial_sample:
+            self._add_sample(self.initial_sample, part)
+    def get_checks(self):
+        "Get the name, result and p-value (or None for exact checks) of each check."
+        counts = self.counts
+        config = self.config
+        rate = config.diffusion_rate
+        checks = [('fixed transitions', counts['fixed_mismatches'] == 0, None)]
+        checks.append(z_check('common transition rate', counts['common'], counts['trials'], config.common_prob))
+        checks.append((
+            'reward probabilities within [{}, {}]'.format(
+                RewardProbability.MIN_VALUE, RewardProbability.MAX_VALUE),
+            self.prob_range[0] >= RewardProbability.MIN_VALUE and
+            self.prob_range[1] <= RewardProbability.MAX_VALUE, None))
+        p_value = stats.kstest(
+            np.concatenate(self.initial_sample), 'uniform',
+            args=(RewardProbability.MIN_VALUE, RewardProbability.MAX_VALUE - RewardProbability.MIN_VALUE)
+        ).pvalue
+        checks.append(('initial reward probabilities uniform', p_value >= ALPHA, p_value))
+        n = counts['steps']
+        z = counts['step_sum']/(rate*math.sqrt(n))
+        p_value = math.erfc(abs(z)/math.sqrt(2))
+        checks.append(('diffusion step mean 0', p_value >= ALPHA, p_value))
+        variance = counts['step_sumsq']/n
+        z = (variance/rate**2 - 1)/math.sqrt(2/n)
+        p_value = math.erfc(abs(z)/math.sqrt(2))
+        checks.append(('diffusion step sd {}'.format(rate), p_value >= ALPHA, p_value))
+        p_value = stats.kstest(np.concatenate(self.step_sample), 'norm', args=(0, rate)).pvalue
+        checks.append(('diffusion steps normal', p_value >= ALPHA, p_value))
+        checks.append(z_check('initial symbol placement', counts['isymbols_swapped'], counts['isymbols'], 0.5))
+        checks.append(z_check('final symbol placement', counts['fsymbols_swapped'], counts['fsymbols'], 0.5))
+        z = counts['reward_excess']/math.sqrt(counts['reward_variance'])
+        p_value = math.erfc(abs(z)/math.sqrt(2))
+        checks.append(('reward frequency', p_value >= ALPHA, p_value))
+        filled = self.bins[2] > 0
+        chi2 = (((self.bins[0] - self.bins[1])**2)[filled]/self.bins[2][filled]).sum()
+        p_value = stats.chi2.sf(chi2, filled.sum())
+        checks.append(('reward calibration by probability', p_value >= ALPHA, p_value))
+        return checks
+
+def z_check(name, successes, n, p):
+    "Check a proportion with a normal approximation to the binomial test."
+    z = (successes - n*p)/math.sqrt(n*p*(1 - p))
+    p_value = math.erfc(abs(z)/math.sqrt(2))
+    return ('{} {}'.format(name, p), p_value >= ALPHA, p_value)
+
+def _run_chunk(args):
+    "Get the statistics of a chunk of sessions in a worker process."
+    source, config_name, seed, num_sessions, num_trials = args
+    config = CONFIGS[config_name]
+    statistics = Statistics(config)
+    if source in ('vectorized', 'engine'):
+        rng = np.random.default_rng(seed)
+        generate = generate_trials if source == 'vectorized' else get_engine_trials
+        for start in range(0, num_sessions, BATCH_SIZE):
+            batch = Statistics(config)
+            for trial in generate(rng, config, min(BATCH_SIZE, num_sessions - start), num_trials):
+                batch.add(trial)
+            statistics.merge(batch)
+    else:
+        random.seed(int(seed.generate_state(1)[0]))
+        for trial in get_sequence_trials(config, num_sessions, num_trials):
+            statistics.add(trial)
+    return statistics
+
+def run_checks(source, config_name, total_trials, num_trials, processes=None, seed=0):
+    "Generate trials in parallel and get the results of the checks."
+    num_sessions = max(1, total_trials//num_trials)
+    chunks = [len(chunk) for chunk in get_chunks(num_sessions, processes)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    results = map_chunks(_run_chunk, [
+        (source, config_name, chunk_seed, chunk, num_trials)
+        for chunk_seed, chunk in zip(seeds, chunks)
+    ])
+    statistics = results[0]
+    for other in results[1:]:
+        statistics.merge(other)
+    return statistics.get_checks()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--config', choices=sorted(CONFIGS), default='tutorial')
+    parser.add_argument(
+        '--trials', type=int, default=20000000, help='trials from the vectorized generator and the engine')
+    parser.add_argument(
+        '--reference-trials', type=int, default=2000000, help='trials from Trial.get_sequence')
+    parser.add_argument('--session-length', type=int, default=None, help='trials per session')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    config = CONFIGS[args.config]
+    num_trials = args.session_length or config.num_trials
+    passed = True
+    for source, total_trials in (('vectorized', args.trials), ('engine', args.trials),
+                                 ('get_sequence', args.reference_trials)):
+        print('{} ({} trials):'.format(source, total_trials))
+        for name, result, p_value in run_checks(
+                source, args.config, total_trials, num_trials, args.processes, args.seed):
+            passed = passed and result
+            print('  {:<45} {}{}'.format(
+                name, 'PASS' if result else 'FAIL',
+                '' if p_value is None else ' (p = {:.3g})'.format(p_value)))
+    sys.exit(0 if passed else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+"""Drift-diffusion models of the choices and response times.
+
+Fits a diffusion model to the first- and second-stage choices and response
+times of each session. Option 1 is the upper boundary and option 0 the lower
+one, the process starts halfway between them and the diffusion coefficient
+is 1. In the plain model each stage has a constant drift rate; in the
+reinforcement learning model (RL-DDM) the drift rate of each trial is the
+log-odds of the hybrid agent in hybrid.py, so beta scales the value
+difference into a drift rate. Slow trials, with no response within MAX_WAIT
+seconds, are censored: they contribute the probability of no boundary being
+reached by then. Response densities are computed with the series of Navarro
+and Fuss (2009), vectorized over trials, sessions and the shifted parameter
+values of the finite-difference gradient, and sessions are fitted in
+parallel."""
+
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import *
+
+import argparse
+import csv
+import io
+
+import numpy as np
+from scipy import optimize
+
+import hybrid
+from hierarchical import load_cohort
+from results import add_exclude_argument, select_sessions, get_config, get_chunks, map_chunks
+from two_step import RESULTS_DIR, MAX_WAIT
+
+# Parameters of each model: drift rates (v), boundary separations (a) and
+# non-decision times (t) of the first and second stage
+MODELS = {
+    'ddm': ('v1', 'v2', 'a1', 'a2', 't1', 't2'),
+    'rlddm': hybrid.PARAMETERS + ('a1', 'a2', 't1', 't2'),
+}
+# Maximum non-decision time (s)
+MAX_T0 = 1.
+# Probability of a response at a uniformly random time within MAX_WAIT, with
+# either choice, instead of from the diffusion
+LAPSE = 0.02
+# Terms of the small-time and large-time series of the density, and of the survival series
+SMALL_TIME_TERMS = 5
+LARGE_TIME_TERMS = 10
+SURVIVAL_TERMS = 30
+# Step for the finite differences of the log-likelihood
+STEP = 1e-4
+# Prior variance of the unconstrained parameters, which keeps the estimates finite
+PRIOR_VAR = 10.
+
+def sigmoid(x):
+    return 1/(1 + np.exp(-x))
+
+# Transformations from unconstrained values and their starting points
+TRANSFORMS = {
+    'alpha': sigmoid, 'beta': np.exp, 'w': sigmoid, 'persev': lambda x: x,
+    'v1': lambda x: x, 'v2': lambda x: x, 'a1': np.exp, 'a2': np.exp,
+    't1': lambda x: MAX_T0*sigmoid(x), 't2': lambda x: MAX_T0*sigmoid(x),
+}
+INITIAL_VALUES = {
+    'alpha': 0., 'beta': np.log(3), 'w': 0., 'persev': 0., 'v1': 0., 'v2': 0.,
+    'a1': np.log(1.5), 'a2': np.log(1.5), 't1': np.log(0.3/0.7), 't2': np.log(0.3/0.7),
+}
+
+def to_params(model, x):
+    "Get the parameters of a model from unconstrained values in the last dimension."
+    return {name: TRANSFORMS[name](x[..., i]) for i, name in enumerate(MODELS[model])}
+
+def log_density_lower(t, v, a, w):
+    """Get the log-density of first reaching the lower boundary at time t.
+
+    The starting point is w*a. Uses the small-time series for t < a**2 and the
+    large-time series otherwise, each with its leading term factored out."""
+    u = t/a**2
+    small = u < 1
+    # Small-time series, in terms of the distance to the nearest image of the start
+    u_small = np.where(small, u, 1.)
+    k = np.arange(-SMALL_TIME_TERMS, SMALL_TIME_TERMS + 1)
+    x = w[..., None] + 2*k
+    terms = x*np.exp(-(x**2 - w[..., None]**2)/(2*u_small[..., None]))
+    log_small = (-0.5*np.log(2*np.pi*u_small**3) - w**2/(2*u_small) +
+                 np.log(np.maximum(terms.sum(axis=-1), 1e-300)))
+    # Large-time series
+    u_large = np.where(small, 1., u)
+    k = np.arange(1, LARGE_TIME_TERMS + 1)
+    terms = k*np.exp(-(k**2 - 1)*np.pi**2*u_large[..., None]/2)*np.sin(k*np.pi*w[..., None])
+    log_large = (np.log(np.pi) - np.pi**2*u_large/2 +
+                 np.log(np.maximum(terms.sum(axis=-1), 1e-300)))
+    return -2*np.log(a) - v*a*w - v**2*t/2 + np.where(small, log_small, log_large)
+
+def log_density(t, choice, v, a, w=0.5):
+    "Get the log-density of reaching the boundary of each choice at time t."
+    t, choice, v, a, w = np.broadcast_arrays(t, choice, v, a, w)
+    upper = choice == 1
+    return log_density_lower(t, np.where(upper, -v, v), a, np.where(upper, 1 - w, w))
+
+def log_survival(t, v, a, w=0.5):
+    "Get the log-probability that neither boundary has been reached by time t."
+    t, v, a, w = np.broadcast_arrays(t, v, a, w)
+    k = np.arange(1, SURVIVAL_TERMS + 1)
+    c = k*np.pi/a[..., None]
+    terms = (np.sin(k*np.pi*w[..., None])*c*(1 - (-1)**k*np.exp(v*a)[..., None])/
+             ((v**2)[..., None] + c**2)*np.exp(-(k**2 - 1)*np.pi**2*t[..., None]/(2*a[..., None]**2)))
+    return np.minimum(
+        np.log(2/a) - v*w*a - v**2*t/2 - np.pi**2*t/(2*a**2) +
+        np.log(np.maximum(terms.sum(axis=-1), 1e-300)), 0)
+
+def stage_log_likelihood(rt, choice, v, a, t0):
+    """Get the log-likelihood of the responses in one stage of each trial.
+
+    Response times of -1 are censored at MAX_WAIT and NaN marks trials
+    without this stage, which contribute nothing."""
+    rt, choice, v, a, t0 = np.broadcast_arrays(rt, choice, v, a, t0)
+    total = np.zeros(rt.shape)
+    # Each series is only computed for the trials that need it
+    responded = rt > 0
+    decision_time = rt[responded] - t0[responded]
+    log_f = log_density(
+        np.maximum(decision_time, 1e-3), choice[responded], v[responded], a[responded])
+    total[responded] = np.logaddexp(
+        np.log(1 - LAPSE) + np.where(decision_time > 0, log_f, -np.inf), np.log(LAPSE/(2*MAX_WAIT)))
+    censored = rt == -1
+    total[censored] = np.log(1 - LAPSE) + log_survival(
+        MAX_WAIT - t0[censored], v[censored], a[censored])
+    return total
+
+def get_drift_rates(model, params, data, common_prob):
+    "Get the drift rates of both stages of each trial."
+    if model == 'ddm':
+        shape = data['choice1'].shape
+        return (params['v1'][..., None]*np.ones(shape), params['v2'][..., None]*np.ones(shape))
+    choice1, final_state, choice2 = data['choice1'], data['final_state'], data['choice2']
+    shape = np.broadcast(*[params[name] for name in hybrid.PARAMETERS] + [choice1[..., 0]]).shape
+    q1, q2 = hybrid.initial_values(shape)
+    prev_choice1 = np.full(shape, -1)
+    drift1 = np.zeros(shape + choice1.shape[-1:])
+    drift2 = np.zeros(shape + choice1.shape[-1:])
+    for t in range(choice1.shape[-1]):
+        drift1[..., t] = hybrid.first_stage_logit(q1, q2, params, prev_choice1, common_prob)
+        drift2[..., t] = hybrid.second_stage_logit(q2, final_state[..., t], params)
+        hybrid.update(q1, q2, choice1[..., t], final_state[..., t], choice2[..., t],
+                      data['reward'][..., t], params)
+        prev_choice1 = np.where(choice1[..., t] >= 0, choice1[..., t], prev_choice1)
+    return drift1, drift2
+
+def log_likelihood(model, params, data, common_prob):
+    "Get the log-likelihood of the choices and response times of a batch of sessions."
+    drift1, drift2 = get_drift_rates(model, params, data, common_prob)
+    # There is no second stage after a slow first stage
+    rt2 = np.where(data['choice1'] >= 0, data['rt2'], np.nan)
+    return (
+        stage_log_likelihood(data['rt1'], data['choice1'], drift1, params['a1'][..., None],
+                             params['t1'][..., None]).sum(axis=-1) +
+        stage_log_likelihood(rt2, data['choice2'], drift2, params['a2'][..., None],
+                             params['t2'][..., None]).sum(axis=-1))
+
+def _fit_chunk(args):
+    """Get the maximum a posteriori parameters of a chunk of sessions.
+
+    The sessions are independent, so they are optimized together, and all the
+    shifted parameter values of the gradient are evaluated in a single batch."""
+    model, data, common_prob = args
+    num_sessions = len(data['choice1'])
+    k = len(MODELS[model])
+    x0 = np.tile([INITIAL_VALUES[name] for name in MODELS[model]], (num_sessions, 1))
+    steps = np.concatenate((np.zeros((1, k)), STEP*np.eye(k), -STEP*np.eye(k)))
+    def objective(flat):
+        x = flat.reshape(x0.shape)[None, :, :] + steps[:, None, :]
+        f = -log_likelihood(model, to_params(model, x), data, common_prob) + 0.5*(x**2).sum(axis=-1)/PRIOR_VAR
+        return f[0].sum(), ((f[1:k + 1] - f[k + 1:])/(2*STEP)).T.ravel()
+    result = optimize.minimize(objective, x0.ravel(), jac=True, method='L-BFGS-B')
+    x = result.x.reshape(x0.shape)
+    return x, log_likelihood(model, to_params(model, x), data, common_prob)
+
+def fit(model, data, common_prob, processes=None):
+    """Fit a model to each session, in parallel.
+
+    Returns the unconstrained parameter values and the log-likelihood of each session."""
+    results = map_chunks(_fit_chunk, [
+        (model, {key: value[chunk] for key, value in data.items()}, common_prob)
+        for chunk in get_chunks(len(data['choice1']), processes)
+    ])
+    return {'x': np.concatenate([x for x, _ in results]),
+            'log_likelihood': np.concatenate([log_lik for _, log_lik in results])}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--results-dir', default=RESULTS_DIR)
+    parser.add_argument('--session', choices=('tutorial', 'game'), default='game')
+    parser.add_argument('--models', choices=sorted(MODELS), nargs='+', default=sorted(MODELS))
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--output', help='CSV file for the parameters of each session and model')
+    add_exclude_argument(parser)
+    args = parser.parse_args()
+
+    paths = select_sessions(args.results_dir, args.session, args.exclude)
+    labels, data = load_cohort(paths, by_subject=False) if paths else ([], None)
+    if not labels:
+        print('No sessions to fit')
+        return
+    common_prob = get_config(paths[0]).common_prob
+    num_observations = ((data['choice1'] >= 0).sum() + (data['choice2'] >= 0).sum())
+    rows = []
+    for model in args.models:
+        result = fit(model, data, common_prob, args.processes)
+        params = to_params(model, result['x'])
+        log_lik = result['log_likelihood'].sum()
+        print('{}: log-likelihood {:.1f}, BIC {:.1f}'.format(
+            model, log_lik, -2*log_lik + result['x'].size*np.log(num_observations)))
+        for name in MODELS[model]:
+            print('  {:<8} median {:7.3f}'.format(name, np.median(params[name])))
+        for i, label in enumerate(labels):
+            rows.extend((label, model, name, params[name][i]) for name in MODELS[model])
+            rows.append((label, model, 'log_likelihood', result['log_likelihood'][i]))
+    if args.output:
+        with io.open(args.output, 'w', newline='') as outf:
+            csv_writer = csv.writer(outf)
+            csv_writer.writerow(('session', 'model', 'parameter', 'value'))
+            csv_writer.writerows(rows)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+"""Hierarchical fit of the hybrid model to a whole cohort.
+
+Fits a Gaussian group distribution of the (transformed) parameters and each
+subject's parameters by expectation-maximization with the Laplace
+approximation. Each subject's sessions are fitted together, with the common
+transition probability of each trial from the session's design history. The
+likelihood is evaluated for all subjects at once on padded NumPy arrays, and
+the subjects are split into chunks fitted in parallel."""
+
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import *
+
+import argparse
+import csv
+import io
+import multiprocessing
+import os
+from collections import OrderedDict
+
+import numpy as np
+from scipy import optimize
+
+import hybrid
+from results import (add_exclude_argument, select_sessions, get_subject, load_session, get_common_probs,
+                     get_chunks)
+from two_step import RESULTS_DIR
+
+# Step for the finite differences of the log-posterior
+STEP = 1e-4
+# Starting group mean of the unconstrained parameters
+PRIOR_MEAN = np.array([0., np.log(3), 0., 0.])
+
+def to_params(x):
+    "Get the parameters from unconstrained values, one row per subject."
+    return {
+        'alpha': 1/(1 + np.exp(-x[..., 0])),
+        'beta': np.exp(x[..., 1]),
+        'w': 1/(1 + np.exp(-x[..., 2])),
+        'persev': x[..., 3],
+    }
+
+def load_cohort(paths, by_subject=True):
+    """Stack the sessions in results files into arrays padded with missing choices.
+
+    There is a row for each subject, with the subject's sessions one after
+    the other and session_start True on the first trial of each, or a row for
+    each session if not by_subject. Choices and final states are coded as in
+    hybrid.py, and common_prob has the common transition probability of each
+    trial. Response times are kept as in the files, with -1 for slow trials,
+    and padded with NaN. Empty files are skipped."""
+    rows = OrderedDict()
+    for path in paths:
+        session = load_session(path)
+        if len(session['trial']):
+            session['common_prob'] = get_common_probs(path, session['trial'])
+            label = get_subject(path) if by_subject else os.path.basename(path)
+            rows.setdefault(label, []).append(session)
+    labels = list(rows)
+    if not labels:
+        return labels, None
+    num_trials = max(sum(len(session['trial']) for session in sessions) for sessions in rows.values())
+    data = {key: np.full((len(labels), num_trials), -1, dtype=int)
+            for key in ('choice1', 'final_state', 'choice2')}
+    data['reward'] = np.zeros((len(labels), num_trials), dtype=int)
+    data['session_start'] = np.zeros((len(labels), num_trials), dtype=bool)
+    # Padded trials have no choices, so their transition probability does not matter
+    data['common_prob'] = np.full((len(labels), num_trials), 0.5)
+    for key in ('rt1', 'rt2'):
+        data[key] = np.full((len(labels), num_trials), np.nan)
+    for i, sessions in enumerate(rows.values()):
+        start = 0
+        for session in sessions:
+            trials = slice(start, start + len(session['trial']))
+            for key in ('choice1', 'final_state', 'choice2'):
+                data[key][i, trials] = np.where(session[key] > 0, session[key] - 1, -1)
+            data['reward'][i, trials] = session['reward']
+            data['session_start'][i, start] = True
+            data['common_prob'][i, trials] = session['common_prob']
+            for key in ('rt1', 'rt2'):
+                data[key][i, trials] = session[key]
+            start = trials.stop
+    return labels, data
+
+def negative_log_posterior(x, data, mu, var):
+    """Get the negative log-posterior of each subject's unconstrained parameters.
+
+    data has the arrays of load_cohort."""
+    log_prior = -0.5*(((x - mu)**2)/var + np.log(2*np.pi*var)).sum(axis=-1)
+    return -hybrid.log_likelihood(
+        to_params(x), data['choice1'], data['final_state'], data['choice2'], data['reward'],
+        data['common_prob'], data['session_start']) - log_prior
+
+def get_shifted(x, steps, data, mu, var):
+    """Get the negative log-posterior of each subject at shifted parameter values.
+
+    All shifts are evaluated in a single batch, with the shift as the first dimension."""
+    return negative_log_posterior(x[None, :, :] + steps[:, None, :], data, mu, var)
+
+def get_gradient(x, data, mu, var):
+    """Get the negative log-posterior and its gradient for each subject.
+
+    Subjects are independent, so a step in one parameter of all subjects at
+    once gives all their partial derivatives."""
+    k = x.shape[1]
+    steps = np.concatenate((np.zeros((1, k)), STEP*np.eye(k), -STEP*np.eye(k)))
+    f = get_shifted(x, steps, data, mu, var)
+    return f[0], ((f[1:k + 1] - f[k + 1:])/(2*STEP)).T
+
+def get_hessian(x, data, mu, var):
+    "Get the Hessian of the negative log-posterior of each subject, made positive definite."
+    k = x.shape[1]
+    pairs = [(j, l) for j in range(k) for l in range(j)]
+    steps = [np.zeros(k)]
+    for j in range(k):
+        steps += [STEP*np.eye(k)[j], -STEP*np.eye(k)[j]]
+    for j, l in pairs:
+        for sign_j, sign_l in ((1, 1), (1, -1), (-1, 1), (-1, -1)):
+            steps.append(STEP*(sign_j*np.eye(k)[j] + sign_l*np.eye(k)[l]))
+    f = get_shifted(x, np.array(steps), data, mu, var)
+    hess = np.zeros((x.shape[0], k, k))
+    for j in range(k):
+        hess[:, j, j] = (f[1 + 2*j] + f[2 + 2*j] - 2*f[0])/STEP**2
+    for i, (j, l) in enumerate(pairs):
+        shifted = f[1 + 2*k + 4*i:5 + 2*k + 4*i]
+        hess[:, j, l] = hess[:, l, j] = (
+            shifted[0] - shifted[1] - shifted[2] + shifted[3])/(4*STEP**2)
+    eigvals, eigvecs = np.linalg.eigh(hess)
+    eigvals = np.maximum(eigvals, 1e-6)
+    return np.einsum('sij,sj,skj->sik', eigvecs, eigvals, eigvecs)
+
+def _fit_chunk(args):
+    "Get the maximum a posteriori parameters of a chunk of subjects and their Hessians."
+    x0, data, mu, var = args
+    shape = x0.shape
+    def objective(flat):
+        f, grad = get_gradient(flat.reshape(shape), data, mu, var)
+        return f.sum(), grad.ravel()
+    result = optimize.minimize(objective, x0.ravel(), jac=True, method='L-BFGS-B')
+    x = result.x.reshape(shape)
+    return x, get_hessian(x, data, mu, var)
+
+def _map_chunks(pool, chunks, x, data, mu, var):
+    "Get the maximum a posteriori parameters and Hessians of all subjects, chunk by chunk."
+    results = pool.map(_fit_chunk, [
+        (x[chunk], {key: value[chunk] for key, value in data.items()}, mu, var)
+        for chunk in chunks
+    ])
+    return (np.concatenate([chunk_x for chunk_x, _ in results]),
+            np.concatenate([chunk_hess for _, chunk_hess in results]))
+
+def fit_individual(data, mu, var, processes=None):
+    """Fit each subject's parameters separately with a fixed Gaussian prior.
+
+    Returns each subject's maximum a posteriori values and posterior covariance."""
+    num_subjects = len(data['choice1'])
+    chunks = get_chunks(num_subjects, processes)
+    pool = multiprocessing.Pool(len(chunks))
+    try:
+        x, hess = _map_chunks(pool, chunks, np.tile(mu, (num_subjects, 1)), data, mu, var)
+    finally:
+        pool.close()
+        pool.join()
+    return {'x': x, 'cov': np.linalg.inv(hess)}
+
+def fit(data, processes=None, max_iterations=100, tol=1e-3):
+    """Fit the group distribution and the subjects' parameters.
+
+    Returns the group mean and variance of the unconstrained parameters, each
+    subject's maximum a posteriori values and posterior covariance, and the
+    Laplace approximation of the log-evidence of the data."""
+    num_subjects = len(data['choice1'])
+    k = len(hybrid.PARAMETERS)
+    mu = PRIOR_MEAN
+    var = np.full(k, 10.)
+    x = np.tile(mu, (num_subjects, 1))
+    chunks = get_chunks(num_subjects, processes)
+    pool = multiprocessing.Pool(len(chunks))
+    try:
+        for _ in range(max_iterations):
+            x, hess = _map_chunks(pool, chunks, x, data, mu, var)
+            cov = np.linalg.inv(hess)
+            # Update the group distribution from the subjects' approximate posteriors
+            new_mu = x.mean(axis=0)
+            new_var = np.maximum((x**2 + np.diagonal(cov, axis1=1, axis2=2)).mean(axis=0) - new_mu**2, 1e-3)
+            converged = np.abs(new_mu - mu).max() < tol and np.abs(new_var - var).max() < tol
+            mu, var = new_mu, new_var
+            if converged:
+                break
+    finally:
+        pool.close()
+        pool.join()
+    log_evidence = (-negative_log_posterior(x, data, mu, var) +
+                    0.5*k*np.log(2*np.pi) - 0.5*np.linalg.slogdet(hess)[1]).sum()
+    return {'mu': mu, 'var': var, 'x': x, 'cov': cov, 'log_evidence': log_evidence}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--results-dir', default=RESULTS_DIR)
+    parser.add_argument('--session', choices=('tutorial', 'game'), default='game')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--output', help='CSV file for the individual parameters')
+    add_exclude_argument(parser)
+    args = parser.parse_args()
+
+    paths = select_sessions(args.results_dir, args.session, args.exclude)
+    labels, data = load_cohort(paths) if paths else ([], None)
+    if not labels:
+        print('No sessions to fit')
+        return
+    result = fit(data, args.processes)
+
+    print('Subjects: {}, log-evidence: {:.1f}'.format(len(labels), result['log_evidence']))
+    group = to_params(result['mu'])
+    for i, name in enumerate(hybrid.PARAMETERS):
+        print('{:<8} group {:7.3f} (sd of unconstrained values {:.3f})'.format(
+            name, float(group[name]), np.sqrt(result['var'][i])))
+    if args.output:
+        params = to_params(result['x'])
+        with io.open(args.output, 'w', newline='') as outf:
+            csv_writer = csv.writer(outf)
+            csv_writer.writerow(('subject',) + hybrid.PARAMETERS)
+            for i, label in enumerate(labels):
+                csv_writer.writerow([label] + [params[name][i] for name in hybrid.PARAMETERS])
+
+if __name__ == '__main__':
+    main()
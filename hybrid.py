@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+"""Hybrid model-based/model-free agent for the two-stage task.
+
+Choices and final states are coded 0 and 1 (the codes in the results files
+minus one) and -1 when there was no choice. First-stage choice i commonly
+leads to final state i. All functions are vectorized with NumPy: parameter
+arrays broadcast over any leading batch dimensions, such as subjects or a grid
+of parameter values, and data arrays have the same leading dimensions."""
+
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import *
+
+import numpy as np
+
+# Learning rate, inverse temperature, model-based weight and perseveration
+PARAMETERS = ('alpha', 'beta', 'w', 'persev')
+
+def log_sigmoid(x):
+    "Get log(1/(1 + exp(-x))) without overflow."
+    return -np.logaddexp(0, -x)
+
+def one_hot(choice):
+    "Get a one-hot encoding of choices, all zeros for missing choices."
+    return (np.asarray(choice)[..., None] == np.arange(2)).astype(float)
+
+def initial_values(shape):
+    "Get the initial first- and second-stage model-free values for a batch of agents."
+    return np.full(tuple(shape) + (2,), 0.5), np.full(tuple(shape) + (2, 2), 0.5)
+
+def first_stage_logit(q1, q2, params, prev_choice1, common_prob):
+    "Get the log-odds of choosing first-stage option 1 over option 0."
+    max_q2 = q2.max(axis=-1)
+    q_mb = common_prob*max_q2 + (1 - common_prob)*max_q2[..., ::-1]
+    w = params['w'][..., None]
+    q_net = w*q_mb + (1 - w)*q1
+    prev_sign = np.where(np.asarray(prev_choice1) < 0, 0, 2*np.asarray(prev_choice1) - 1)
+    return params['beta']*(q_net[..., 1] - q_net[..., 0]) + params['persev']*prev_sign
+
+def second_stage_logit(q2, final_state, params):
+    "Get the log-odds of choosing second-stage option 1 over option 0 in a final state."
+    diff = (q2[..., 1] - q2[..., 0])*one_hot(final_state)
+    return params['beta']*diff.sum(axis=-1)
+
+def update(q1, q2, choice1, final_state, choice2, reward, params):
+    """Update the model-free values in place after a trial.
+
+    Trials without a second-stage choice leave the values unchanged. With an
+    eligibility trace of 1, the first-stage value moves toward the reward."""
+    first = one_hot(choice1)
+    second = one_hot(final_state)[..., :, None]*one_hot(choice2)[..., None, :]
+    alpha = params['alpha']*(np.asarray(choice2) >= 0)
+    q1 += (alpha*(reward - (q1*first).sum(axis=-1)))[..., None]*first
+    q2 += (alpha*(reward - (q2*second).sum(axis=(-2, -1))))[..., None, None]*second
+
+def trial_log_likelihood(q1, q2, params, prev_choice1, choice1, final_state, choice2, common_prob):
+    "Get the log-likelihood of the choices in a trial, before updating the values."
+    logit1 = first_stage_logit(q1, q2, params, prev_choice1, common_prob)
+    logit2 = second_stage_logit(q2, final_state, params)
+    choice1 = np.asarray(choice1)
+    choice2 = np.asarray(choice2)
+    return (
+        np.where(choice1 >= 0, log_sigmoid(np.where(choice1 == 1, logit1, -logit1)), 0) +
+        np.where(choice2 >= 0, log_sigmoid(np.where(choice2 == 1, logit2, -logit2)), 0))
+
+def log_likelihood(params, choice1, final_state, choice2, reward, common_prob, session_start=None):
+    """Get the log-likelihood of a batch of sessions.
+
+    Data arrays have the trial number as their last dimension and are padded
+    with -1 choices after the end of shorter sessions. common_prob is the
+    common transition probability, or an array of that of each trial like the
+    data. Several sessions of a subject can be joined in a row, with
+    session_start True on the first trial of each, where the values start over."""
+    shape = np.broadcast(*[params[name] for name in PARAMETERS] + [choice1[..., 0]]).shape
+    common_prob = np.broadcast_to(common_prob, choice1.shape)
+    start_q1, start_q2 = initial_values(shape)
+    q1, q2 = initial_values(shape)
+    total = np.zeros(shape)
+    prev_choice1 = np.full(shape, -1)
+    for t in range(choice1.shape[-1]):
+        if session_start is not None:
+            start = session_start[..., t]
+            q1 = np.where(start[..., None], start_q1, q1)
+            q2 = np.where(start[..., None, None], start_q2, q2)
+            prev_choice1 = np.where(start, -1, prev_choice1)
+        total += trial_log_likelihood(
+            q1, q2, params, prev_choice1, choice1[..., t], final_state[..., t],
+            choice2[..., t], common_prob[..., t, None])
+        update(q1, q2, choice1[..., t], final_state[..., t], choice2[..., t], reward[..., t], params)
+        prev_choice1 = np.where(choice1[..., t] >= 0, choice1[..., t], prev_choice1)
+    return total
+
+def get_row_data(row):
+    "Get the choices, final state and reward in a row of a results file, coded from 0."
+    return (
+        int(row['choice1']) - 1 if int(row['choice1']) > 0 else -1,
+        int(row['final_state']) - 1 if int(row['final_state']) > 0 else -1,
+        int(row['choice2']) - 1 if int(row['choice2']) > 0 else -1,
+        int(row['reward']),
+    )
+
+class OnlineEstimator(object):
+    """Posterior over the hybrid model parameters, updated after each trial.
+
+    The posterior is kept on a fixed grid of parameter values, so each update
+    takes the same time regardless of the number of trials. Random responding
+    is kept as an alternative hypothesis to detect participants who have not
+    understood the task."""
+    ALPHAS = np.linspace(0.1, 0.9, 9)
+    BETAS = np.array([1., 3., 6., 10.])
+    WS = np.linspace(0, 1, 11)
+    PERSEVS = np.array([0., 1.])
+    PRIOR_RANDOM = 0.5
+    # Posterior probability of random responding from which it is reported
+    RANDOM_THRESHOLD = 0.95
+    def __init__(self, common_prob):
+        self.common_prob = common_prob
+        grid = np.meshgrid(self.ALPHAS, self.BETAS, self.WS, self.PERSEVS, indexing='ij')
+        self.params = dict(zip(PARAMETERS, grid))
+        self.q1, self.q2 = initial_values(grid[0].shape)
+        self.log_posterior = np.zeros(grid[0].shape)
+        self.log_random = 0.
+        self.prev_choice1 = -1
+        self.trials = 0
+    def update(self, row):
+        "Update the posterior with a row just recorded by run_trial_sequence."
+        choice1, final_state, choice2, reward = get_row_data(row)
+        self.log_posterior += trial_log_likelihood(
+            self.q1, self.q2, self.params, self.prev_choice1, choice1, final_state, choice2,
+            self.common_prob)
+        self.log_random += np.log(0.5)*((choice1 >= 0) + (choice2 >= 0))
+        update(self.q1, self.q2, choice1, final_state, choice2, reward, self.params)
+        if choice1 >= 0:
+            self.prev_choice1 = choice1
+        # Keep the log-posterior near zero to avoid underflow in long sessions
+        shift = self.log_posterior.max()
+        self.log_posterior -= shift
+        self.log_random -= shift
+        self.trials += 1
+    def get_posterior(self):
+        "Get the normalized posterior over the grid, given the participant is not random."
+        posterior = np.exp(self.log_posterior)
+        return posterior/posterior.sum()
+    def get_estimate(self, name):
+        "Get the posterior mean and standard deviation of a parameter."
+        posterior = self.get_posterior()
+        mean = (posterior*self.params[name]).sum()
+        return mean, np.sqrt((posterior*(self.params[name] - mean)**2).sum())
+    def get_prob_random(self):
+        "Get the posterior probability that the participant is responding randomly."
+        log_hybrid = np.log(np.exp(self.log_posterior).mean())
+        log_odds = (self.log_random - log_hybrid +
+                    np.log(self.PRIOR_RANDOM) - np.log(1 - self.PRIOR_RANDOM))
+        return 1/(1 + np.exp(-log_odds))
+    def is_random(self):
+        "Whether the participant is most likely responding randomly."
+        return self.get_prob_random() >= self.RANDOM_THRESHOLD
+    def __str__(self):
+        output = "After {} trials: ".format(self.trials)
+        for name in ('w', 'alpha'):
+            output += "{} = {:.2f} (sd {:.2f}); ".format(name, *self.get_estimate(name))
+        output += "P(random responding) = {:.2f}".format(self.get_prob_random())
+        return output
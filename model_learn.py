@@ -21,23 +21,33 @@ from __future__ import (absolute_import, division, print_function, unicode_liter
 from builtins import *
 
 import argparse
+import gc
+import glob
 import sys
 import os
+import pickle
+import queue
+import threading
 import socket
 import random
+import string
 import csv
 import io
+import json
 import time
-from itertools import chain
+from itertools import chain, product
+from collections import OrderedDict
 from os.path import join
 from psychopy import visual, core, event, data, gui
 import wx
 from bidi.algorithm import get_display  # For proper RTL text handling
+from hybrid import OnlineEstimator
+from adaptive_design import AdaptiveDesign
+from walk_bank import WalkBank
+from two_step import (
+    CURRENT_DIR, ASSETS_DIR, ASSET_VARIANTS_DIR, DESIGN_SIZE, RESULTS_DIR, DESIGN_TABLE, WALK_BANK,
+    TutorialConfig, GameConfig, Model, Trial, CSV_FIELDNAMES, code_to_bin)
 
-# Directories
-CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
-ASSETS_DIR = join(CURRENT_DIR, 'assets')
-RESULTS_DIR = join(CURRENT_DIR, 'tutorial_results')
 
 # CHANGE PARAMETER BELOW BEFORE RUNNING
 # Font for displaying the instructions
@@ -49,6 +59,38 @@ color_translations = {
     'pink': u'הורוד',
     'blue': u'הכחול'
 }
+# Messages of the tutorial, with fields for translated colors and for the side
+# (right or left) of a choice
+TUTORIAL_MESSAGES = {
+    'carpets_out': u'הוצאתם את השטיחים המכושפים שלכם מהארון ופרסתם אותם על הרצפה.',
+    'left_carpet': u"משמאל הנחתם את השטיח שמכושף לעוף להר {color} …",
+    'right_carpet': u"ומימין השטיח שמכושף לעוף להר {color} …",
+    'carpet_symbols': u"הסמלים שכתובים על השטיחים משמעותם ”ההר {left_color}“ ו-”ההר {right_color}“ בשפה המקומית.",
+    'choose_carpet': u"בקרוב תוכלו לבחור שטיח ולעוף עליו על ידי לחיצה על המקש השמאלי או הימני.",
+    'carpets_glow': u"כשהשטיחים מתחילים לזהור, יש לך 8 שניות ללחוץ על מקש, או שהם יעופו בלעדיך.",
+    'carpets_ready': u"השטיחים שלכם מוכנים ועומדים להתחיל לזהור. התכוננו לעשות את הבחירה שלכם.",
+    'selected_carpet': u"בחרת בשטיח שב{side}, שמכושף לעוף אל ההר {color}. טיסה נעימה!",
+    'common_flight': u"הטיסה שלך להר {color} עברה היטב, בלי שום תקלות.",
+    'rare_flight': u"אוי לא! הרוחות ליד ההר {other_color} חזקות מדי. "
+                   u"אתה מחליט לנחות עם השטיח שלך על ההר {color} במקום.",
+    'landed': u"נחתת בבטחה על ההר {color}.",
+    'lamps_intro': u"הנה המנורות שבהן גרים הג'ינים של ההר {color}.",
+    'left_lamp': u"המנורה משמאל היא ביתו של הג'יני ששמו מופיע למטה בשפה המקומית.",
+    'right_lamp': u"המנורה מימין היא ביתו של הג'יני ששמו מופיע למטה בשפה המקומית.",
+    'choose_lamp': u"בקרוב תוכלו לבחור מנורה ולשפשף אותה על ידי לחיצה על המקש השמאלי או הימני.",
+    'lamps_glow': u"כשהמנורות מתחילות לזהור, יש לך 8 שניות ללחוץ על מקש, אחרת הג'ינים יחזרו לישון.",
+    'lamps_ready': u"המנורות עומדות להתחיל לזהור, התכוננו לבצע את הבחירה שלכם.",
+    'selected_lamp': u"אתם מרימים את המנורה שב{side} ומשפשפים אותה.",
+    'reward': u"הג'יני יצא מהמנורה שלו, הקשיב לשיר, ונתן לך מטבע זהב!",
+    'remember_genie': u"זכרו את שמו של הג'יני הזה למקרה שתרצו לבחור שוב את המנורה שלו בעתיד.",
+    'genie_color': u"הצבע של המנורה שלו מזכיר לך שהוא גר על ההר {color}.",
+    'no_reward': u"הג'יני נשאר בתוך המנורה שלו, ולא קיבלת מטבע זהב.",
+}
+# Message under the title of the game, from the start of assets/game_instructions.txt
+GAME_START_MESSAGE = (u"המשחק עומד להתחיל. תבצעו {num_trials} טיסות להרים ותקבלו תשלום על כל מטבע זהב "
+                      u"שהג'ינים ייתנו לכם. לחצו על מקש הרווח כדי להתחיל.")
+# Translations of the keys to the side of a choice
+side_translations = {'s': u'שמאל', 'k': u'ימין'}
 
 def check_exit():
     """Exit the program if Escape is pressed."""
@@ -56,32 +98,40 @@ def check_exit():
         core.quit()
 
 
-# Configuration for tutorial and game
-class TutorialConfig:
-    final_state_colors = ('red', 'black')
-    initial_state_symbols = (7, 8)
-    final_state_symbols = ((9, 10), (11, 12))
-    num_trials = 20 #20
-    common_prob = 0.7 # Optimal performance 61%
-    @classmethod
-    def proceed(cls, trials, slow_trials):
-        del slow_trials
-        return trials < cls.num_trials
-    @classmethod
-    def do_break(cls, trials, slow_trials):
-        del trials, slow_trials
-        return False
-    @classmethod
-    def get_common(cls, trial):
-        if trial == 0 or trial == 1:
-            return True
-        if trial == 2:
-            return False
-        return random.random() < cls.common_prob
-
 # Classes and functions
 
 def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--adaptive', action='store_true',
+        help='choose the transition and diffusion parameters between blocks')
+    parser.add_argument(
+        '--game', action='store_true', help='run the full game after the tutorial')
+    parser.add_argument(
+        '--resume', nargs='?', const='', default=None, metavar='SESSION',
+        help="continue an interrupted session of the subject from its checkpoint; SESSION is "
+             "the name of its file or its date, as in 2019_Jan_31_1200, and is required "
+             "if the subject has several")
+    parser.add_argument(
+        '--walk', type=int, default=None,
+        help='id of the reward probability walk of the game in the walk bank, to yoke participants')
+    args = parser.parse_args()
+    if args.walk is not None and args.adaptive:
+        parser.error('--walk fixes the reward probabilities, so it cannot be used with --adaptive')
+    if args.walk is not None and not args.game:
+        parser.error('--walk sets the reward probabilities of the game, so it requires --game')
+    # Check the design table and the walk before the participant starts, not when the sessions do
+    if args.adaptive and not os.path.exists(DESIGN_TABLE):
+        parser.error('No adaptive design table in {}, build it with adaptive_design.py'.format(DESIGN_TABLE))
+    walk_bank = None
+    if args.walk is not None:
+        try:
+            walk_bank = WalkBank(WALK_BANK)
+            walk_bank.get_walk(args.walk)
+        except (IOError, OSError):
+            parser.error('No walk bank in {}, build it with walk_bank.py'.format(WALK_BANK))
+        except KeyError as error:
+            parser.error(error.args[0])
 
     # Get participant information
     info = {
@@ -102,10 +152,25 @@ def main():
     #create filename
     filename = join(
         RESULTS_DIR, '{}_{}'.format(part_code, data.getDateStr()))
+    resume = None
+    if args.resume is not None:
+        checkpoints = find_checkpoints(part_code, args.resume)
+        if not checkpoints:
+            print('No checkpoint for subject_number {} {}'.format(part_code, args.resume).strip())
+            core.quit()
+        if len(checkpoints) > 1:
+            print('Several interrupted sessions for subject_number {}, choose one with --resume SESSION:'.format(
+                part_code))
+            for path in checkpoints:
+                print('  {}'.format(os.path.splitext(os.path.basename(path))[0]))
+            core.quit()
+        # Continue writing to the files of the interrupted session
+        filename, resume = os.path.splitext(checkpoints[0])[0].rsplit('_', 1)
     if part_code == 'TEST':
         fullscr = False # Displays small window
         # Decrease number of trials
         TutorialConfig.num_trials = 20
+        GameConfig.num_trials = 20
     else:
         fullscr = True # Fullscreen for the participants
 
@@ -117,19 +182,18 @@ def main():
     # Load all images
     images = load_image_collection(win, ASSETS_DIR)
 
-    # Randomize mountain sides and common transitions for the tutorial and game
-    tutorial_mountain_sides = list(TutorialConfig.final_state_colors)
-    random.shuffle(tutorial_mountain_sides)
-    tutorial_model = Model.create_random(TutorialConfig)
-    
     # Tutorial flights
-    with io.open('{}_tutorial.csv'.format(filename), 'wb') as outf:
-        csv_writer = csv.DictWriter(outf, fieldnames=CSV_FIELDNAMES)
-        csv_writer.writeheader()
-        run_trial_sequence(
-            TutorialConfig, TutorialDisplay(win, images, tutorial_mountain_sides),
-            tutorial_model, csv_writer)
-
+    if resume != 'game':
+        run_session(
+            TutorialConfig, TutorialDisplay, win, images, '{}_tutorial'.format(filename),
+            args.adaptive, resume == 'tutorial')
+
+    # Game flights
+    if args.game or resume == 'game':
+        rewards = run_session(
+            GameConfig, GameDisplay, win, images, '{}_game'.format(filename), args.adaptive,
+            resume == 'game', walk_bank, args.walk)
+        print('Rewards: {}'.format(rewards))
     
     # Display Hebrew text
     finish_text = visual.TextStim(win, text=u" הניסוי הסתיים, תודה!"[::-1], font='Arial')
@@ -146,154 +210,194 @@ def main():
     core.quit()  # Quit PsychoPy
 
 
-class RewardProbability(float):
-    "Reward probability that drifts within a min and a max value."
-    MIN_VALUE = 0.25
-    MAX_VALUE = 0.75
-    DIFFUSION_RATE = 0.025
-    def __new__(cls, value):
-        assert value >= cls.MIN_VALUE and value <= cls.MAX_VALUE
-        return super(RewardProbability, cls).__new__(cls, value)
-    @classmethod
-    def create_random(cls):
-        "Create a random reward probability within the allowed interval."
-        return cls(random.uniform(cls.MIN_VALUE, cls.MAX_VALUE))
-    def diffuse(self):
-        "Get the next probability by diffusion."
-        return self.__class__(
-            self.reflect_on_boundaries(random.gauss(0, self.DIFFUSION_RATE)))
-    def get_reward(self):
-        "Get a reward (0 or 1) with this probability."
-        return int(random.random() < self)
-    def reflect_on_boundaries(self, incr):
-        "Reflect reward probability on boundaries."
-        next_value = self + (incr % 1)
-        if next_value > self.MAX_VALUE:
-            next_value = 2*self.MAX_VALUE - next_value
-        if next_value < self.MIN_VALUE:
-            next_value = 2*self.MIN_VALUE - next_value
-        return next_value
-
-class Symbol(object):
-    "A Tibetan symbol for a carpet or lamp."
-    def __init__(self, code):
-        self.code = code
-    def __str__(self):
-        return '{:02d}'.format(self.code)
-
-class InitialSymbol(Symbol):
-    "An initial state symbol."
-    def __init__(self, code, final_state):
-        super(InitialSymbol, self).__init__(code)
-        self.final_state = final_state
-
-class FinalSymbol(Symbol):
-    "A final state symbol."
-    def __init__(self, code, reward_probability):
-        super(FinalSymbol, self).__init__(code)
-        self.reward_probability = reward_probability
-        self.reward = self.reward_probability.get_reward()
-
-class State(object):
-    "A initial state in the task."
-    def __init__(self, symbols):
-        assert len(symbols) == 2
-        self.symbols = symbols
-
-class FinalState(State):
-    "A final state in the task."
-    def __init__(self, color, symbols):
-        self.color = color
-        super(FinalState, self).__init__(symbols)
-
-class Model(object):
-    """A transition model and configuration of final states for the task."""
-    def __init__(self, isymbol_codes, colors, fsymbol_codes):
-        self.isymbol_codes = isymbol_codes
-        self.colors = colors
-        self.fsymbol_codes = fsymbol_codes
-    @classmethod
-    def create_random(cls, config):
-        """Create a random model for the task from a given configuration."""
-        colors = list(config.final_state_colors)
-        random.shuffle(colors)
-        fsymbol_codes = list(config.final_state_symbols)
-        random.shuffle(fsymbol_codes)
-        return cls(config.initial_state_symbols, colors, fsymbol_codes)
-    def get_paths(self, common):
-        "Generator for the paths from initial symbol to final symbols."
-        if common:
-            for isymbol_code, color, fsymbol_codes in zip(
-                    self.isymbol_codes, self.colors, self.fsymbol_codes):
-                yield (isymbol_code, color, fsymbol_codes)
-        else:
-            for isymbol_code, color, fsymbol_codes in zip(
-                    self.isymbol_codes, reversed(self.colors), reversed(self.fsymbol_codes)):
-                yield (isymbol_code, color, fsymbol_codes)
-    def __str__(self):
-        output = "Common transitions: "
-        for isymbol_code, color, fsymbol_codes in self.get_paths(True):
-            output += "{} -> {} -> {}; ".format(isymbol_code, color, fsymbol_codes)
-        return output
-
-class Trial(object):
-    "A trial in the task."
-    def __init__(self, number, initial_state, common):
-        self.number = number
-        self.initial_state = initial_state
-        self.common = common
-    @classmethod
-    def get_sequence(cls, config, model):
-        "Get an infinite sequence of trials with this configuration."
-        trials = 0
-        reward_probabilities = {
-            fsymbol_code: RewardProbability.create_random()
-            for fsymbol_code in chain(*config.final_state_symbols)
+def find_checkpoints(part_code, session=''):
+    """Get the checkpoints of the subject's interrupted sessions, oldest first.
+
+    If a session is given, only its checkpoint: session is the name of a file
+    of the session, with or without the subject number and the part of the
+    task, or its date."""
+    checkpoints = sorted(
+        glob.glob(join(RESULTS_DIR, '{}_*.checkpoint'.format(part_code))),
+        key=os.path.getmtime)
+    if not session:
+        return checkpoints
+    session = os.path.splitext(os.path.basename(session))[0]
+    selected = []
+    for path in checkpoints:
+        name = os.path.splitext(os.path.basename(path))[0]
+        date_part = name[len(part_code) + 1:]
+        if session in (name, name.rsplit('_', 1)[0], date_part, date_part.rsplit('_', 1)[0]):
+            selected.append(path)
+    return selected
+
+def run_session(config, display_class, win, images, filename, adaptive, resume=False,
+                walk_bank=None, walk_id=None):
+    """Run a sequence of trials, writing each trial to the results file as it ends.
+
+    A checkpoint is kept while the session runs, so that it can be resumed
+    from the trial where it was interrupted. The reward probabilities follow
+    a walk from the walk bank if its id is given."""
+    # The adaptive mode and checkpoints change the design of this session
+    # only, on a copy of the configuration that starts from its defaults
+    config = type(str(config.__name__), (config,), {
+        'common_prob': config.common_prob, 'diffusion_rate': config.diffusion_rate})
+    checkpoint_path = '{}.checkpoint'.format(filename)
+    csv_path = '{}.csv'.format(filename)
+    if resume:
+        with io.open(checkpoint_path, 'rb') as inf:
+            start = pickle.load(inf)
+        session = start['session']
+        model = Model(
+            session['isymbol_codes'], session['colors'],
+            [tuple(codes) for codes in session['fsymbol_codes']])
+        mountain_sides = session['mountain_sides']
+        config.common_prob = start['common_prob']
+        config.diffusion_rate = start['diffusion_rate']
+        walk_id = session.get('walk')
+        if walk_id is not None:
+            walk_bank = WalkBank(WALK_BANK)
+            assert walk_bank.id == session['walk_bank'], 'The walk bank changed since the session started'
+        # Keep only the trials before the checkpoint
+        with io.open(csv_path, 'r', newline='') as inf:
+            rows = [row for row in csv.DictReader(inf) if int(row['trial']) < start['trial']]
+    else:
+        start = None
+        rows = []
+        # Randomize mountain sides and common transitions
+        mountain_sides = list(config.final_state_colors)
+        random.shuffle(mountain_sides)
+        model = Model.create_random(config)
+        session = {
+            'isymbol_codes': list(model.isymbol_codes),
+            'colors': list(model.colors),
+            'fsymbol_codes': [list(codes) for codes in model.fsymbol_codes],
+            'mountain_sides': mountain_sides,
         }
+        if walk_id is not None:
+            session['walk_bank'] = walk_bank.id
+            session['walk'] = walk_id
+        # Record what the results file doesn't, so the session can be replayed
+        with io.open('{}_model.json'.format(filename), 'w', encoding='utf-8') as outf:
+            outf.write(json.dumps(session))
+    # Live estimate of the participant's strategy, as a comprehension check
+    estimator = OnlineEstimator(config.common_prob)
+    if adaptive:
+        designer = AdaptiveDesign(DESIGN_TABLE, estimator)
+    else:
+        designer = None
+    if designer is not None and start is not None:
+        designer.history = list(start['design_history'])
+    checkpointer = CheckpointWriter(checkpoint_path, session)
+
+    write_results(csv_path, rows)
+    for row in rows:
+        estimator.update(row)
+    # Line buffered, so each row is on disk as soon as it is written
+    with io.open(csv_path, 'a', newline='', buffering=1) as outf:
+        csv_writer = csv.DictWriter(outf, fieldnames=CSV_FIELDNAMES)
+        rewards = run_trial_sequence(
+            config, display_class(win, images, mountain_sides), model, csv_writer,
+            estimator, designer, checkpointer, start,
+            walk_bank.get_walk(walk_id) if walk_id is not None else None, walk_id,
+            walk_bank.id if walk_id is not None else None)
+    # The session is complete and no longer needs to be resumed
+    checkpointer.close(remove=True)
+    print(estimator)
+    if designer is not None:
+        with io.open('{}_design.json'.format(filename), 'w', encoding='utf-8') as outf:
+            outf.write(json.dumps(designer.history))
+    return rewards
+
+def write_results(path, rows):
+    """Write a results file with the given rows, replacing any previous file atomically.
+
+    The trials of a resumed session are kept in the results file even if
+    it is interrupted again while they are written."""
+    tmp_path = path + '.tmp'
+    with io.open(tmp_path, 'w', newline='') as outf:
+        csv_writer = csv.DictWriter(outf, fieldnames=CSV_FIELDNAMES)
+        csv_writer.writeheader()
+        csv_writer.writerows(rows)
+        outf.flush()
+        os.fsync(outf.fileno())
+    os.replace(tmp_path, path)
+
+class CheckpointWriter(object):
+    """Writes the state of a session at the start of each trial.
+
+    Checkpoints are written by a background thread, so the display never
+    waits for the disk, and replace the previous one atomically."""
+    def __init__(self, path, session):
+        self.path = path
+        self.session = session
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write_checkpoints)
+        self.thread.daemon = True
+        self.thread.start()
+    def save(self, state):
+        "Queue a checkpoint to be written."
+        self.queue.put(state)
+    def close(self, remove=False):
+        "Write the queued checkpoints and stop, removing the checkpoint file if requested."
+        self.queue.put(None)
+        self.thread.join()
+        if remove and os.path.exists(self.path):
+            os.remove(self.path)
+    def _write_checkpoints(self):
         while True:
-            common = config.get_common(trials)
-            isymbols = []
-            for isymbol_code, color, fsymbol_codes in model.get_paths(common):
-                fsymbols = [
-                    FinalSymbol(fsymbol_code, reward_probabilities[fsymbol_code])
-                    for fsymbol_code in fsymbol_codes
-                ]
-                random.shuffle(fsymbols)
-                final_state = FinalState(color, tuple(fsymbols))
-                isymbols.append(InitialSymbol(isymbol_code, final_state))
-            random.shuffle(isymbols)
-            initial_state = State(isymbols)
-            yield cls(trials, initial_state, common)
-            for fsymbol_code, prob in reward_probabilities.items():
-                reward_probabilities[fsymbol_code] = prob.diffuse()
-            trials += 1
-
-CSV_FIELDNAMES = (
-    'trial', 'common', 'reward.1.1', 'reward.1.2', 'reward.2.1',
-    'reward.2.2', 'isymbol_lft', 'isymbol_rgt', 'rt1', 'choice1', 'final_state',
-    'fsymbol_lft', 'fsymbol_rgt', 'rt2', 'choice2', 'reward', 'slow')
+            state = self.queue.get()
+            if state is None:
+                break
+            state['session'] = self.session
+            tmp_path = self.path + '.tmp'
+            with io.open(tmp_path, 'wb') as outf:
+                pickle.dump(state, outf, protocol=2)
+                outf.flush()
+                os.fsync(outf.fileno())
+            os.replace(tmp_path, self.path)
 
 def get_intertrial_interval():
     #return random.uniform(0.7, 1.3)
     return 1
 
-def code_to_bin(code, common=True):
-    if common:
-        return 2 - code % 2
-    else:
-        return code % 2 + 1
-
-def run_trial_sequence(config, display, model, csv_writer):
-    rewards = 0
-    slow_trials = 0
+def run_trial_sequence(config, display, model, csv_writer, estimator=None, designer=None,
+                       checkpointer=None, start=None, walk=None, walk_id=None, walk_bank_id=None):
     common_transitions = {
         isymbol_code: {'color': color}
         for isymbol_code, color, fsymbol_codes in model.get_paths(True)
     }
-    # Trial loop
-    for trial in Trial.get_sequence(config, model):
-        completed_trials = trial.number - slow_trials
-        row = {'trial': trial.number, 'common': int(trial.common)}
+    if start is None:
+        rewards = 0
+        slow_trials = 0
+        trial_number = 0
+        sequence = Trial.get_sequence(config, model, walk=walk)
+    else:
+        # Continue from a checkpoint
+        rewards = start['rewards']
+        slow_trials = start['slow_trials']
+        trial_number = start['trial']
+        display.set_state(start['display'])
+        random.setstate(start['random_state'])
+        sequence = Trial.get_sequence(
+            config, model, start['trial'], start['reward_probabilities'], walk)
+    # The next trial, prepared while the start of the trial is shown
+    prepared = {}
+    def prepare_trial():
+        trial = next(sequence)
+        if checkpointer is not None:
+            checkpointer.save({
+                'trial': trial.number,
+                'random_state': trial.random_state,
+                'reward_probabilities': trial.reward_probabilities,
+                'rewards': rewards,
+                'slow_trials': slow_trials,
+                'display': display.get_state(),
+                'common_prob': config.common_prob,
+                'diffusion_rate': config.diffusion_rate,
+                'design_history': list(designer.history) if designer is not None else [],
+            })
+        row = {'trial': trial.number, 'common': int(trial.common),
+               'walk': walk_id if walk_id is not None else -1, 'walk_bank': walk_bank_id or ''}
         for isymbol in trial.initial_state.symbols:
             for fsymbol in isymbol.final_state.symbols:
                 key = 'reward.{}.{}'.format(
@@ -301,108 +405,196 @@ def run_trial_sequence(config, display, model, csv_writer):
                 row[key] = fsymbol.reward_probability
         row['isymbol_lft'] = code_to_bin(trial.initial_state.symbols[0].code)
         row['isymbol_rgt'] = code_to_bin(trial.initial_state.symbols[1].code)
-
-        display.display_start_of_trial(trial.number)
-        check_exit()
-        # First-stage choice
-        isymbols = [symbol.code for symbol in trial.initial_state.symbols]
-        display.display_carpets(completed_trials, isymbols, common_transitions)
-
-        event.clearEvents()
-        keys_times = event.waitKeys(
-            maxWait=8, keyList=('s', 'k'), timeStamped=core.Clock())
-        check_exit()
-        if keys_times is None:
-            slow_trials += 1
-            display.display_slow1()
-            row.update({
-                'rt1': -1,
-                'choice1': -1,
-                'final_state': -1,
-                'fsymbol_lft': -1,
-                'fsymbol_rgt': -1,
-                'rt2': -1,
-                'choice2': -1,
-                'reward': 0,
-                'slow': 1,
-            })
-        else:
-            choice1, rt1 = keys_times[0]
-            row['rt1'] = rt1
-
-            display.display_selected_carpet(completed_trials, choice1, isymbols, common_transitions)
-
-            # Transition
-            chosen_symbol1 = trial.initial_state.symbols[int(choice1 == 'k')]
-            final_state = chosen_symbol1.final_state
-            row['choice1'] = code_to_bin(chosen_symbol1.code)
-            row['final_state'] = code_to_bin(chosen_symbol1.code, trial.common)
-
-            display.display_transition(completed_trials, final_state.color, trial.common)
-
-            # Second-stage choice
-            fsymbols = [symbol.code for symbol in final_state.symbols]
-            row['fsymbol_lft'] = code_to_bin(final_state.symbols[0].code)
-            row['fsymbol_rgt'] = code_to_bin(final_state.symbols[1].code)
-
-            display.display_lamps(completed_trials, final_state.color, fsymbols)
+        display.prepare_screens()
+        prepared['trial'] = trial
+        prepared['row'] = row
+        # Collect garbage during the intertrial interval only, so it never delays a screen
+        gc.collect()
+    random_reported = False
+    # A resumed session is introduced with the flights that are left
+    display.display_start_of_session(config.num_trials - trial_number)
+    gc.disable()
+    try:
+        # Trial loop
+        while True:
+            display.display_start_of_trial(trial_number, prepare_trial)
+            check_exit()
+            trial = prepared['trial']
+            row = prepared['row']
+            completed_trials = trial.number - slow_trials
+            # First-stage choice
+            isymbols = [symbol.code for symbol in trial.initial_state.symbols]
+            display.display_carpets(completed_trials, isymbols, common_transitions)
 
             event.clearEvents()
             keys_times = event.waitKeys(
-                maxWait=8, keyList=('s', 'k'), timeStamped=core.Clock())
+                maxWait=config.max_wait, keyList=('s', 'k'), timeStamped=core.Clock())
             check_exit()
             if keys_times is None:
                 slow_trials += 1
-                display.display_slow2(final_state.color)
+                display.display_slow1()
                 row.update({
+                    'rt1': -1,
+                    'choice1': -1,
+                    'final_state': -1,
+                    'fsymbol_lft': -1,
+                    'fsymbol_rgt': -1,
                     'rt2': -1,
                     'choice2': -1,
                     'reward': 0,
                     'slow': 1,
                 })
             else:
-                choice2, rt2 = keys_times[0]
-                row['rt2'] = rt2
-
-                display.display_selected_lamp(completed_trials, final_state.color, fsymbols, choice2)
-
-                # Reward
-                chosen_symbol2 = final_state.symbols[int(choice2 == 'k')]
-                row['choice2'] = code_to_bin(chosen_symbol2.code)
-                reward = chosen_symbol2.reward
-                row['reward'] = reward
-                row['slow'] = 0
-                if reward:
-                    rewards += 1
-                    display.display_reward(completed_trials, final_state.color, chosen_symbol2.code)
+                choice1, rt1 = keys_times[0]
+                row['rt1'] = rt1
+
+                display.display_selected_carpet(completed_trials, choice1, isymbols, common_transitions)
+
+                # Transition
+                chosen_symbol1 = trial.initial_state.symbols[int(choice1 == 'k')]
+                final_state = chosen_symbol1.final_state
+                row['choice1'] = code_to_bin(chosen_symbol1.code)
+                row['final_state'] = code_to_bin(chosen_symbol1.code, trial.common)
+
+                display.display_transition(completed_trials, final_state.color, trial.common)
+
+                # Second-stage choice
+                fsymbols = [symbol.code for symbol in final_state.symbols]
+                row['fsymbol_lft'] = code_to_bin(final_state.symbols[0].code)
+                row['fsymbol_rgt'] = code_to_bin(final_state.symbols[1].code)
+
+                display.display_lamps(completed_trials, final_state.color, fsymbols)
+
+                event.clearEvents()
+                keys_times = event.waitKeys(
+                    maxWait=config.max_wait, keyList=('s', 'k'), timeStamped=core.Clock())
+                check_exit()
+                if keys_times is None:
+                    slow_trials += 1
+                    display.display_slow2(final_state.color)
+                    row.update({
+                        'rt2': -1,
+                        'choice2': -1,
+                        'reward': 0,
+                        'slow': 1,
+                    })
                 else:
-                    display.display_no_reward(completed_trials, final_state.color, chosen_symbol2.code)
-
-        display.display_end_of_trial()
-
-        # Break
-        if config.do_break(trial.number + 1, slow_trials):
-            display.display_break()
-            event.waitKeys(keyList=('space',))
-        assert all([fdn in row.keys() for fdn in CSV_FIELDNAMES])
-        assert all([key in CSV_FIELDNAMES for key in row.keys()])
-        csv_writer.writerow(row)
-        # Should we run another trial?
-        if not config.proceed(trial.number + 1, slow_trials):
-            break
+                    choice2, rt2 = keys_times[0]
+                    row['rt2'] = rt2
+
+                    display.display_selected_lamp(completed_trials, final_state.color, fsymbols, choice2)
+
+                    # Reward
+                    chosen_symbol2 = final_state.symbols[int(choice2 == 'k')]
+                    row['choice2'] = code_to_bin(chosen_symbol2.code)
+                    reward = chosen_symbol2.reward
+                    row['reward'] = reward
+                    row['slow'] = 0
+                    if reward:
+                        rewards += 1
+                        display.display_reward(completed_trials, final_state.color, chosen_symbol2.code)
+                    else:
+                        display.display_no_reward(completed_trials, final_state.color, chosen_symbol2.code)
+
+            display.display_end_of_trial()
+
+            assert all([fdn in row.keys() for fdn in CSV_FIELDNAMES])
+            assert all([key in CSV_FIELDNAMES for key in row.keys()])
+            csv_writer.writerow(row)
+            if estimator is not None:
+                estimator.update(row)
+                # Tell the experimenter as soon as the participant seems to respond randomly
+                if not random_reported and estimator.is_random():
+                    print('Warning: the participant may be responding randomly. {}'.format(estimator))
+                    random_reported = True
+            if designer is not None:
+                designer.next_trial(config, trial.number + 1)
+
+            # Break, with the estimate so far for the experimenter
+            if config.do_break(trial.number + 1, slow_trials):
+                display.display_break()
+                if estimator is not None:
+                    print('Break: {}'.format(estimator))
+                event.waitKeys(keyList=('space',))
+            # Should we run another trial?
+            trial_number += 1
+            if not config.proceed(trial_number, slow_trials):
+                break
+    finally:
+        gc.enable()
     return rewards
 
-def load_image_collection(win, images_directory):
-    image_collection = {
-        os.path.splitext(fn)[0]: visual.ImageStim(
-            win=win,
-            pos=(0, 0),
-            image=join(images_directory, fn),
-            name=os.path.splitext(fn)[0]
-        )
+class ImageCache(object):
+    """Images loaded on first use, keeping at most max_size textures in memory.
+
+    The least recently used image is released when the cache is full. Images
+    with a layout are drawn at its position and size, and the others centered
+    at their own size."""
+    def __init__(self, win, paths, max_size, layout=None):
+        self.win = win
+        self.paths = paths
+        self.max_size = max_size
+        self.layout = layout or {}
+        self.images = OrderedDict()
+    def __getitem__(self, name):
+        try:
+            image = self.images.pop(name)
+        except KeyError:
+            pos, size = self.layout.get(name, ((0, 0), None))
+            image = visual.ImageStim(
+                win=self.win,
+                pos=pos,
+                size=size,
+                image=self.paths[name],
+                name=name
+            )
+            if len(self.images) >= self.max_size:
+                self.images.popitem(last=False)
+        self.images[name] = image
+        return image
+    def preload(self, names):
+        "Load images ahead of their first use."
+        for name in names:
+            self[name]
+
+def get_asset_variant(window_size, variants_directory=ASSET_VARIANTS_DIR):
+    """Get the directory and manifest of the smallest texture variant covering a window.
+
+    Returns None if no variant was built for a window at least this large."""
+    if not os.path.isdir(variants_directory):
+        return None
+    visible = [min(window_size[axis], DESIGN_SIZE[axis]) for axis in (0, 1)]
+    best = None
+    for variant in os.listdir(variants_directory):
+        manifest_path = join(variants_directory, variant, 'manifest.json')
+        if not os.path.exists(manifest_path):
+            continue
+        with io.open(manifest_path, 'r', encoding='utf-8') as inf:
+            manifest = json.load(inf)
+        size = [min(manifest['window_size'][axis], DESIGN_SIZE[axis]) for axis in (0, 1)]
+        if size[0] >= visible[0] and size[1] >= visible[1] and (
+                best is None or size[0]*size[1] < best[0]):
+            best = (size[0]*size[1], join(variants_directory, variant), manifest)
+    return best[1:] if best is not None else None
+
+def load_image_collection(win, images_directory, max_size=48):
+    """Get the images in a directory, using the texture variant for the window if built.
+
+    Images changed since the variant was built are loaded from the directory."""
+    image_paths = {
+        os.path.splitext(fn)[0]: join(images_directory, fn)
         for fn in os.listdir(images_directory) if os.path.splitext(fn)[1] == '.png'
     }
-    return image_collection
+    layout = {}
+    variant = get_asset_variant(win.size, join(images_directory, 'variants'))
+    if variant is not None:
+        directory, manifest = variant
+        built = os.path.getmtime(join(directory, 'manifest.json'))
+        for name, entry in manifest['images'].items():
+            if name in image_paths and os.path.getmtime(image_paths[name]) <= built:
+                image_paths[name] = join(directory, entry['file'])
+                layout[name] = (tuple(entry['pos']), tuple(entry['size']))
+    return ImageCache(win, image_paths, max_size, layout)
 
 def get_random_transition_model(config):
     isymbols = list(config.initial_state_symbols)
@@ -413,6 +605,16 @@ def get_random_transition_model(config):
     random.shuffle(colors)
     return {isymbols[i]: {'color': colors[i], 'symbols': fsymbols[i]} for i in range(2)}
 
+def get_symbol_image_names(config):
+    "Get the names of the images of the symbols of a configuration."
+    names = []
+    for symbols in (config.initial_state_symbols,) + tuple(config.final_state_symbols):
+        names += ['tibetan.{:02d}{:02d}'.format(*symbols),
+                  'tibetan.{:02d}{:02d}'.format(*reversed(symbols))]
+    for symbol in chain(*config.final_state_symbols):
+        names.append('tibetan.{:02d}'.format(symbol))
+    return names
+
 class TutorialDisplay(object):
     def __init__(self, win, images, mountain_sides):
         self.win = win
@@ -429,18 +631,10 @@ class TutorialDisplay(object):
             opacity=0.9,
             name='Tutorial message frame',
         )
-        self.msg_text = visual.TextStim(
-            win=self.win,
-            pos=(600, 405),
-            height=30,
-            fontFiles=[TTF_FONT],
-            font='OpenSans',
-            color=(-1, -1, -1),
-            wrapWidth=1120,
-            alignHoriz='right',
-            alignVert='center',
-            name='Tutorial message text'
-        )
+        # Messages are laid out once and kept by text, at the current position
+        self.messages = {}
+        self.msg_pos = (600, 405)
+        self.msg_text = None
         self.center_text = visual.TextStim(
             win=win,
             pos=(0, 0),
@@ -451,13 +645,94 @@ class TutorialDisplay(object):
             color=(1, 1, 1),
             name='Center text'
         )
-    def display_start_of_trial(self, trial):
+        self.images.preload(self.get_image_names())
+    def get_image_names(self):
+        "Get the names of all images this display can show."
+        colors = TutorialConfig.final_state_colors
+        names = [
+            'carpets_tutorial', 'carpets_glow_tutorial', 'left_carpet_destination',
+            'right_carpet_destination', 'tutorial_carpet_symbols', 'tutorial_s_carpet_selected',
+            'tutorial_k_carpet_selected', 's_lamp_selected', 'k_lamp_selected',
+            'left_lamp_symbol', 'right_lamp_symbol', 'genie_coin', 'genie_zero', 'rubbed_lamp',
+            'slow1', 'slow2', 'break',
+            'carpets_to_{}_{}'.format(*colors), 'carpets_to_{}_{}'.format(*reversed(colors)),
+        ]
+        for color in colors:
+            names += ['lamps_{}'.format(color), 'lamps_{}_glow'.format(color),
+                      'reward_{}'.format(color)]
+            names += ['flight_{}-{}_{}{}'.format(color, self.mountain_sides[0],
+                                                 self.mountain_sides[1], wind)
+                      for wind in ('', '-wind')]
+        return names + get_symbol_image_names(TutorialConfig)
+    def get_messages(self):
+        "Get the name and fields of every message this display can show."
+        colors = TutorialConfig.final_state_colors
+        for name, template in sorted(TUTORIAL_MESSAGES.items()):
+            keys = [field for _, field, _, _ in string.Formatter().parse(template) if field]
+            for values in product(*[side_translations if key == 'side' else colors for key in keys]):
+                yield name, dict(zip(keys, values))
+    def get_state(self):
+        "Get what the display keeps from trial to trial, to resume a session."
+        return {'visits_to_mountains': dict(self.visits_to_mountains), 'msg_pos': self.msg_pos}
+    def set_state(self, state):
+        self.visits_to_mountains = dict(state['visits_to_mountains'])
+        self.msg_pos = tuple(state['msg_pos'])
+    def get_message(self, name, **fields):
+        """Get the text stimulus of a message at the current message position.
+
+        Colors are given in English and sides as the key pressed."""
+        for key, value in fields.items():
+            fields[key] = side_translations[value] if key == 'side' else color_translations[value.lower()]
+        text = TUTORIAL_MESSAGES[name].format(**fields)[::-1]  # Reversed for RTL rendering
+        try:
+            msg_text = self.messages[text]
+        except KeyError:
+            msg_text = self.messages[text] = visual.TextStim(
+                win=self.win,
+                text=text,
+                pos=self.msg_pos,
+                height=30,
+                fontFiles=[TTF_FONT],
+                font='OpenSans',
+                color=(-1, -1, -1),
+                wrapWidth=1120,
+                alignHoriz='right',
+                alignVert='center',
+                name='Tutorial message text'
+            )
+        msg_text.pos = self.msg_pos
+        return msg_text
+    def prepare_screens(self):
+        """Get the screens of the next trial ready while the start of the trial is shown.
+
+        Makes sure the images are loaded, with their textures on the GPU,
+        and lays out the messages, so the screens are flipped without delay."""
+        self.images.preload(self.get_image_names())
+        for name, fields in self.get_messages():
+            self.get_message(name, **fields)
+    def flip(self):
+        """Show the screen drawn on the window.
+
+        Stimuli are always drawn on self.win, and replay.py replaces this
+        method and wait to record the screens instead of showing them."""
+        self.win.flip()
+    def wait(self, secs, prepare=None):
+        """Keep the current screen for a number of seconds.
+
+        Anything to prepare is done first, within the same time."""
+        if prepare is None:
+            core.wait(secs)
+            return
+        timer = core.CountdownTimer(secs)
+        prepare()
+        core.wait(max(timer.getTime(), 0))
+    def display_start_of_trial(self, trial, prepare=None):
         hebrew_text =  str(trial + 1)+ u'נסיעת הכנה מספר '[::-1]
         self.center_text.text = hebrew_text
 
         self.center_text.draw()
-        self.win.flip()
-        core.wait(3)
+        self.flip()
+        self.wait(3, prepare)
     def display_carpets(self, trial, isymbols, common_transitions):
         isymbols_image = self.images['tibetan.{:02d}{:02d}'.format(*isymbols)]
         destination_image = self.images['carpets_to_{}_{}'.format(
@@ -471,125 +746,107 @@ class TutorialDisplay(object):
 
         if trial < 3:
             draw_main_images()
-            self.win.flip()
-            core.wait(0.5)
+            self.flip()
+            self.wait(0.5)
 
             draw_main_images()
             self.msg_frame.draw()
-            self.msg_text.text = hebrew_text = u'הוצאתם את השטיחים המכושפים שלכם מהארון '\
-              u'ופרסתם אותם על הרצפה.'[::-1]  # היפוך הכיוון
+            self.msg_text = self.get_message('carpets_out')
             self.msg_text.draw()
-            self.win.flip()
-            core.wait(4.5)
+            self.flip()
+            self.wait(4.5)
 
             draw_main_images()
-            self.win.flip()
-            core.wait(0.5)
+            self.flip()
+            self.wait(0.5)
 
             if trial < 2:
                 draw_main_images()
                 self.images['left_carpet_destination'].draw()
                 self.msg_frame.draw()
-                
-                self.msg_text.text  = u"משמאל הנחתם את השטיח שמכושף "\
-              u"לעוף להר {} …".format(
-                  color_translations[common_transitions[isymbols[0]]['color'].lower()]
-              )[::-1]  # היפוך הכיוון
-                self.msg_text.pos = (50,405)
+
+                self.msg_pos = (50,405)
+                self.msg_text = self.get_message(
+                    'left_carpet', color=common_transitions[isymbols[0]]['color'])
                 self.msg_text.draw()
-                self.win.flip()
-                core.wait(5)
+                self.flip()
+                self.wait(5)
 
                 draw_main_images()
-                self.win.flip()
-                core.wait(0.5)
+                self.flip()
+                self.wait(0.5)
 
                 draw_main_images()
                 self.images['right_carpet_destination'].draw()
                 self.msg_frame.draw()
-                self.msg_text.text = u"ומימין השטיח שמכושף "\
-                     u"לעוף להר {} …".format(
-                    color_translations[common_transitions[isymbols[1]]['color'].lower()]
-                )[::-1]
-                self.msg_text.pos = (500,405)
+                self.msg_pos = (500,405)
+                self.msg_text = self.get_message(
+                    'right_carpet', color=common_transitions[isymbols[1]]['color'])
                 self.msg_text.draw()
-                self.win.flip()
-                core.wait(5)
+                self.flip()
+                self.wait(5)
 
                 draw_main_images()
-                self.win.flip()
-                core.wait(0.5)
+                self.flip()
+                self.wait(0.5)
 
                 draw_main_images()
                 self.images['tutorial_carpet_symbols'].draw()
                 self.msg_frame.draw()
-                self.msg_text.text = u"הסמלים שכתובים על השטיחים משמעותם ”ההר {}“ ו-”ההר {}“ בשפה המקומית.".format(
-    color_translations[common_transitions[isymbols[0]]['color'].lower()],
-    color_translations[common_transitions[isymbols[1]]['color'].lower()]
-)[::-1]
-                self.msg_text.pos = (625,405)
+                self.msg_pos = (625,405)
+                self.msg_text = self.get_message(
+                    'carpet_symbols', left_color=common_transitions[isymbols[0]]['color'],
+                    right_color=common_transitions[isymbols[1]]['color'])
                 self.msg_text.draw()
-                self.win.flip()
-                core.wait(5)
+                self.flip()
+                self.wait(5)
                 
 
                 draw_main_images()
-                self.win.flip()
-                core.wait(0.5)
+                self.flip()
+                self.wait(0.5)
 
             draw_main_images()
             self.msg_frame.draw()
-            
-            hebrew_text = u"בקרוב תוכלו לבחור שטיח ולעוף עליו על ידי לחיצה על המקש השמאלי או הימני."
-
-            # Assign the reversed text to the TextStim object
-            self.msg_text.text = hebrew_text[::-1]  # Reverse for proper RTL rendering
-
-            # self.msg_text.text = 'You will soon be able to choose a carpet '\
-            #     'and fly on it by pressing the left or right arrow key.'
+            # 'You will soon be able to choose a carpet and fly on it by pressing the left or
+            # right arrow key.'
+            self.msg_text = self.get_message('choose_carpet')
             self.msg_text.draw()
-            self.win.flip()
-            core.wait(3)
+            self.flip()
+            self.wait(3)
             
 
             draw_main_images()
-            self.win.flip()
-            core.wait(0.5)
+            self.flip()
+            self.wait(0.5)
 
             draw_main_images()
             self.msg_frame.draw()
-            hebrew_text = u"כשהשטיחים מתחילים לזהור, יש לך 8 שניות ללחוץ על מקש, "\
-              u"או שהם יעופו בלעדיך."
-            self.msg_text.text = hebrew_text[::-1]  # Reverse for proper RTL rendering
+            self.msg_text = self.get_message('carpets_glow')
             self.msg_text.draw()
-            self.win.flip()
-            core.wait(3)
+            self.flip()
+            self.wait(3)
 
             draw_main_images()
-            self.win.flip()
-            core.wait(0.5)
+            self.flip()
+            self.wait(0.5)
         elif trial < 5:
             draw_main_images()
-            self.win.flip()
-            core.wait(0.5)
+            self.flip()
+            self.wait(0.5)
 
             draw_main_images()
             self.msg_frame.draw()
-            hebrew_text = u"השטיחים שלכם מוכנים ועומדים להתחיל לזהור. התכוננו לעשות את הבחירה שלכם."
-
-
-            # Assign the reversed text to the TextStim object
-            self.msg_text.text = hebrew_text[::-1]  # Reverse for propesr RTL rendering
-
+            self.msg_text = self.get_message('carpets_ready')
             self.msg_text.draw()
-            self.win.flip()
-            core.wait(3)
+            self.flip()
+            self.wait(3)
 
         # Glow carpets for response
         self.images['carpets_glow_tutorial'].draw()
         isymbols_image.draw()
         destination_image.draw()
-        self.win.flip()
+        self.flip()
     def display_selected_carpet(self, trial, choice1, isymbols, common_transitions):
         isymbols_image = self.images['tibetan.{:02d}{:02d}'.format(*isymbols)]
         destination_image = self.images['carpets_to_{}_{}'.format(
@@ -602,30 +859,25 @@ class TutorialDisplay(object):
             self.images['tutorial_{}_carpet_selected'.format(choice1)].draw()
         if trial < 4:
             draw_main_images()
-            self.win.flip()
-            core.wait(0.5)
+            self.flip()
+            self.wait(0.5)
 
             draw_main_images()
             self.msg_frame.draw()
-            hebrew_text = u"בחרת בשטיח שב{}, שמכושף לעוף אל ההר {}. טיסה נעימה!".format(
-            u'ימין' if choice1 == 'k' else u'שמאל',
-            color_translations[common_transitions[isymbols[int(choice1 == 'k')]]['color'].lower()]
-        )
-
-            # Assign the reversed text for RTL display
-            self.msg_text.text = hebrew_text[::-1]  # Reverse the text for proper RTL rendering
-
+            self.msg_text = self.get_message(
+                'selected_carpet', side=choice1,
+                color=common_transitions[isymbols[int(choice1 == 'k')]]['color'])
             self.msg_text.draw()
-            self.win.flip()
-            core.wait(5)
+            self.flip()
+            self.wait(5)
 
             draw_main_images()
-            self.win.flip()
-            core.wait(0.5)
+            self.flip()
+            self.wait(0.5)
         else:
             draw_main_images()
-            self.win.flip()
-            core.wait(2)
+            self.flip()
+            self.wait(2)
     def display_transition(self, trial, final_state_color, common):
         transition_image = self.images['flight_{}-{}_{}{}'.format(
             final_state_color,
@@ -635,38 +887,31 @@ class TutorialDisplay(object):
         )]
 
         if common:
-            hebrew_text = u"הטיסה שלך להר {} עברה היטב, בלי שום תקלות.".format(
-             color_translations[final_state_color.lower()]
-                )
-            self.msg_text.text = hebrew_text[::-1]
+            self.msg_text = self.get_message('common_flight', color=final_state_color)
         else:
             colors = TutorialConfig.final_state_colors
-            hebrew_text = u"אוי לא! הרוחות ליד ההר {} חזקות מדי. "\
-              u"אתה מחליט לנחות עם השטיח שלך על ההר {} במקום.".format(
-            color_translations[colors[1 - colors.index(final_state_color)].lower()],
-            color_translations[final_state_color.lower()]
-            )
-
-            self.msg_text.text = hebrew_text[::-1]  # PsychoPy requires reversed text for RTL languages
+            self.msg_text = self.get_message(
+                'rare_flight', other_color=colors[1 - colors.index(final_state_color)],
+                color=final_state_color)
 
         if trial < 2:
             transition_image.draw()
-            self.win.flip()
-            core.wait(0.5)
+            self.flip()
+            self.wait(0.5)
 
             transition_image.draw()
             self.msg_frame.draw()
             self.msg_text.draw()
-            self.win.flip()
-            core.wait(3 if common else 6)
+            self.flip()
+            self.wait(3 if common else 6)
 
             transition_image.draw()
-            self.win.flip()
-            core.wait(0.5)
+            self.flip()
+            self.wait(0.5)
         else:
             transition_image.draw()
-            self.win.flip()
-            core.wait(2)
+            self.flip()
+            self.wait(2)
     def display_lamps(self, trial, final_state_color, fsymbols):
         fsymbols_image = self.images['tibetan.{:02}{:02}'.format(*fsymbols)]
         def draw_main_images():
@@ -675,127 +920,101 @@ class TutorialDisplay(object):
 
         if self.visits_to_mountains[final_state_color] < 1:
             draw_main_images()
-            self.win.flip()
-            core.wait(0.5)
+            self.flip()
+            self.wait(0.5)
 
             draw_main_images()
             
-            hebrew_text = u"נחתת בבטחה על ההר {}.".format(
-            color_translations[final_state_color.lower()])
-            self.msg_text.text = hebrew_text[::-1]  # Reverse for RTL display in PsychoPy
+            self.msg_text = self.get_message('landed', color=final_state_color)
 
             self.msg_frame.draw()
             self.msg_text.draw()
-            self.win.flip()
-            core.wait(2)
+            self.flip()
+            self.wait(2)
 
             draw_main_images()
-            self.win.flip()
-            core.wait(0.5)
+            self.flip()
+            self.wait(0.5)
 
             draw_main_images()
-            hebrew_text = u"הנה המנורות שבהן גרים הג'ינים של ההר {}.".format(
-            color_translations[final_state_color.lower()])
-
-            # Reverse the text for proper RTL rendering in PsychoPy
-            self.msg_text.text = hebrew_text[::-1]  # PsychoPy requires reversed text for RTL languages
+            self.msg_text = self.get_message('lamps_intro', color=final_state_color)
 
             self.msg_frame.draw()
             self.msg_text.draw()
-            self.win.flip()
-            core.wait(3)
+            self.flip()
+            self.wait(3)
 
             draw_main_images()
-            self.win.flip()
-            core.wait(0.5)
+            self.flip()
+            self.wait(0.5)
 
             draw_main_images()
-            hebrew_text = u"המנורה משמאל היא ביתו של הג'יני "\
-              u"ששמו מופיע למטה בשפה המקומית."
-
-            # Reverse the text for proper RTL rendering in PsychoPy
-            self.msg_text.text = hebrew_text[::-1]  # PsychoPy requires reversed text for RTL languages
+            self.msg_text = self.get_message('left_lamp')
 
             self.msg_frame.draw()
             self.msg_text.draw()
             self.images['left_lamp_symbol'].draw()
-            self.win.flip()
-            core.wait(4)
+            self.flip()
+            self.wait(4)
 
             draw_main_images()
-            self.win.flip()
-            core.wait(0.5)
+            self.flip()
+            self.wait(0.5)
 
             draw_main_images()
-            hebrew_text = u"המנורה מימין היא ביתו של הג'יני "\
-              u"ששמו מופיע למטה בשפה המקומית."
-
-            # Reverse the text for proper RTL rendering in PsychoPy
-            self.msg_text.text = hebrew_text[::-1]  # PsychoPy requires reversed text for RTL languages
+            self.msg_text = self.get_message('right_lamp')
 
             self.msg_frame.draw()
             self.msg_text.draw()
             self.images['right_lamp_symbol'].draw()
-            self.win.flip()
-            core.wait(3)
+            self.flip()
+            self.wait(3)
             draw_main_images()
-            self.win.flip()
-            core.wait(0.5)
+            self.flip()
+            self.wait(0.5)
 
             draw_main_images()
-            hebrew_text = u"בקרוב תוכלו לבחור מנורה ולשפשף אותה על ידי לחיצה "\
-              u"על המקש השמאלי או הימני."
-
-            # Reverse the text for proper RTL rendering in PsychoPy
-            self.msg_text.text = hebrew_text[::-1]  # Reverse for RTL display
+            self.msg_text = self.get_message('choose_lamp')
 
             self.msg_frame.draw()
             self.msg_text.draw()
-            self.win.flip()
-            core.wait(4)
+            self.flip()
+            self.wait(4)
 
             draw_main_images()
-            self.win.flip()
-            core.wait(0.5)
+            self.flip()
+            self.wait(0.5)
 
             draw_main_images()
-            hebrew_text = u"כשהמנורות מתחילות לזהור, יש לך 8 שניות ללחוץ על מקש, "\
-              u"אחרת הג'ינים יחזרו לישון."
-
-            # Reverse the text for proper RTL rendering in PsychoPy
-            self.msg_text.text = hebrew_text[::-1]  # Reverse for RTL display
+            self.msg_text = self.get_message('lamps_glow')
             self.msg_frame.draw()
             self.msg_text.draw()
-            self.win.flip()
-            core.wait(3)
+            self.flip()
+            self.wait(3)
             
 
             draw_main_images()
-            self.win.flip()
-            core.wait(0.5)
+            self.flip()
+            self.wait(0.5)
         elif trial < 5:
             draw_main_images()
-            self.win.flip()
-            core.wait(0.5)
+            self.flip()
+            self.wait(0.5)
 
             draw_main_images()
-            hebrew_text = u"המנורות עומדות להתחיל לזהור, התכוננו לבצע את הבחירה שלכם."
-
-
-            # Assign the reversed text to `self.msg_text.text` for RTL rendering
-            self.msg_text.text = hebrew_text[::-1]
+            self.msg_text = self.get_message('lamps_ready')
             self.msg_frame.draw()
             self.msg_text.draw()
-            self.win.flip()
-            core.wait(3)
+            self.flip()
+            self.wait(3)
 
             draw_main_images()
-            self.win.flip()
-            core.wait(0.5)
+            self.flip()
+            self.wait(0.5)
 
         self.images['lamps_{}_glow'.format(final_state_color)].draw()
         fsymbols_image.draw()
-        self.win.flip()
+        self.flip()
         self.visits_to_mountains[final_state_color] += 1
     def display_selected_lamp(self, trial, final_state_color, fsymbols, choice2):
         fsymbols_image = self.images['tibetan.{:02}{:02}'.format(*fsymbols)]
@@ -805,28 +1024,23 @@ class TutorialDisplay(object):
             fsymbols_image.draw()
         if trial < 5:
             draw_main_images()
-            self.win.flip()
-            core.wait(0.5)
+            self.flip()
+            self.wait(0.5)
 
             draw_main_images()
             self.msg_frame.draw()
-            hebrew_text = u"אתם מרימים את המנורה שב{} ומשפשפים אותה.".format(
-            u'ימין' if choice2 == 'k' else u'שמאל'  # Translate 's' and 'k' dynamically
-            )
-
-            # Assign the reversed text to `self.msg_text.text` for RTL rendering
-            self.msg_text.text = hebrew_text[::-1]
+            self.msg_text = self.get_message('selected_lamp', side=choice2)
             self.msg_text.draw()
-            self.win.flip()
-            core.wait(4)
+            self.flip()
+            self.wait(4)
 
             draw_main_images()
-            self.win.flip()
-            core.wait(0.5)
+            self.flip()
+            self.wait(0.5)
         else:
             draw_main_images()
-            self.win.flip()
-            core.wait(2)
+            self.flip()
+            self.wait(2)
     def display_reward(self, trial, final_state_color, chosen_symbol2):
         def draw_main_images():
             self.images['genie_coin'].draw()
@@ -835,60 +1049,49 @@ class TutorialDisplay(object):
 
         if trial < 5:
             draw_main_images()
-            self.win.flip()
-            core.wait(1.5)
+            self.flip()
+            self.wait(1.5)
 
             draw_main_images()
             self.msg_frame.draw()
-            hebrew_text = u"הג'יני יצא מהמנורה שלו, הקשיב לשיר, ונתן לך מטבע זהב!"
-
-            # Assign the reversed text to `self.msg_text.text` for RTL rendering
-            self.msg_text.text = hebrew_text[::-1]
+            self.msg_text = self.get_message('reward')
             self.msg_text.draw()
-            self.win.flip()
-            core.wait(3)
+            self.flip()
+            self.wait(3)
 
             draw_main_images()
-            self.win.flip()
-            core.wait(0.5)
+            self.flip()
+            self.wait(0.5)
 
             if trial < 2:
                 draw_main_images()
                 self.msg_frame.draw()
-                hebrew_text = u"זכרו את שמו של הג'יני הזה למקרה שתרצו לבחור שוב את המנורה שלו בעתיד."
-
-                # Assign the reversed text to `self.msg_text.text` for RTL rendering
-                self.msg_text.text = hebrew_text[::-1]
+                self.msg_text = self.get_message('remember_genie')
                 self.msg_text.draw()
                 self.images['rubbed_lamp'].draw()
-                self.win.flip()
-                core.wait(5)
+                self.flip()
+                self.wait(5)
 
                 draw_main_images()
                 self.images['rubbed_lamp'].draw()
-                self.win.flip()
-                core.wait(0.5)
+                self.flip()
+                self.wait(0.5)
 
                 draw_main_images()
                 self.msg_frame.draw()
-                hebrew_text = u"הצבע של המנורה שלו מזכיר לך שהוא גר על ההר {}.".format(
-                color_translations[final_state_color.lower()]  # Translate the color dynamically
-                )
-
-                # Assign the reversed text to `self.msg_text.text` for RTL rendering
-                self.msg_text.text = hebrew_text[::-1]
+                self.msg_text = self.get_message('genie_color', color=final_state_color)
                 self.msg_text.draw()
                 self.images['rubbed_lamp'].draw()
-                self.win.flip()
-                core.wait(3)
+                self.flip()
+                self.wait(3)
 
                 draw_main_images()
-                self.win.flip()
-                core.wait(0.5)
+                self.flip()
+                self.wait(0.5)
         else:
             draw_main_images()
-            self.win.flip()
-            core.wait(1.5)
+            self.flip()
+            self.wait(1.5)
     def display_no_reward(self, trial, final_state_color, chosen_symbol2):
         def draw_main_images():
             self.images['genie_zero'].draw()
@@ -897,74 +1100,145 @@ class TutorialDisplay(object):
 
         if trial < 10:
             draw_main_images()
-            self.win.flip()
-            core.wait(1.5)
+            self.flip()
+            self.wait(1.5)
 
             draw_main_images()
             self.msg_frame.draw()
-            hebrew_text = u"הג'יני נשאר בתוך המנורה שלו, ולא קיבלת מטבע זהב."
-
-            # Assign the reversed text to `self.msg_text.text` for RTL rendering
-            self.msg_text.text = hebrew_text[::-1]
+            self.msg_text = self.get_message('no_reward')
             self.msg_text.draw()
-            self.win.flip()
-            core.wait(3)
+            self.flip()
+            self.wait(3)
 
             draw_main_images()
-            self.win.flip()
-            core.wait(0.5)
+            self.flip()
+            self.wait(0.5)
 
             if trial < 2:
                 draw_main_images()
                 self.msg_frame.draw()
-                hebrew_text = u"זכרו את שמו של הג'יני הזה למקרה שתרצו לבחור שוב את המנורה שלו בעתיד."
-
-                # Assign the reversed text to `self.msg_text.text` for RTL rendering
-                self.msg_text.text = hebrew_text[::-1]
+                self.msg_text = self.get_message('remember_genie')
                 self.msg_text.draw()
                 self.images['rubbed_lamp'].draw()
-                self.win.flip()
-                core.wait(5)
+                self.flip()
+                self.wait(5)
 
                 draw_main_images()
                 self.images['rubbed_lamp'].draw()
-                self.win.flip()
-                core.wait(0.5)
+                self.flip()
+                self.wait(0.5)
 
                 draw_main_images()
                 self.msg_frame.draw()
-                hebrew_text = u"הצבע של המנורה שלו מזכיר לך שהוא גר על ההר {}.".format(
-                color_translations[final_state_color.lower()]  # Translate the color dynamically
-                )
-
-                # Assign the reversed text to `self.msg_text.text` for RTL rendering
-                self.msg_text.text = hebrew_text[::-1]
+                self.msg_text = self.get_message('genie_color', color=final_state_color)
                 self.msg_text.draw()
                 self.images['rubbed_lamp'].draw()
-                self.win.flip()
-                core.wait(3)
+                self.flip()
+                self.wait(3)
 
                 draw_main_images()
-                self.win.flip()
-                core.wait(0.5)
+                self.flip()
+                self.wait(0.5)
         else:
             draw_main_images()
-            self.win.flip()
-            core.wait(1.5)
+            self.flip()
+            self.wait(1.5)
+    def display_start_of_session(self, num_trials):
+        "Introduce the session before its first trial, also when it is resumed."
+        del num_trials
     def display_end_of_trial(self):
         pass
     def display_slow1(self):
         self.images['slow1'].draw()
-        self.win.flip()
-        core.wait(4)
+        self.flip()
+        self.wait(4)
     def display_slow2(self, final_state_color):
         self.images['lamps_{}'.format(final_state_color)].draw()
         self.images['slow2'].draw()
-        self.win.flip()
-        core.wait(4)
+        self.flip()
+        self.wait(4)
     def display_break(self):
         self.images['break'].draw()
-        self.win.flip()
+        self.flip()
+
+class GameDisplay(TutorialDisplay):
+    "Display for the game, without the tutorial messages."
+    def get_image_names(self):
+        names = [
+            'carpets', 'carpets_glow', 's_carpet_selected', 'k_carpet_selected', 'nap',
+            's_lamp_selected', 'k_lamp_selected', 'genie_coin', 'genie_zero',
+            'slow1', 'slow2', 'break', 'game',
+        ]
+        for color in GameConfig.final_state_colors:
+            names += ['lamps_{}'.format(color), 'lamps_{}_glow'.format(color),
+                      'reward_{}'.format(color)]
+        return names + get_symbol_image_names(GameConfig)
+    def get_messages(self):
+        return []
+    def display_start_of_session(self, num_trials):
+        """Show that the game starts, with new carpets and mountains, until space is pressed."""
+        self.images['game'].draw()
+        visual.TextStim(
+            win=self.win,
+            # Reversed for RTL rendering, except for the digits of the number
+            text=GAME_START_MESSAGE.format(num_trials=str(num_trials)[::-1])[::-1],
+            pos=(0, -300),
+            height=30,
+            wrapWidth=1000,
+            fontFiles=[TTF_FONT],
+            font='OpenSans',
+            color=(1, 1, 1),
+            name='Game start text',
+        ).draw()
+        self.flip()
+        event.waitKeys(keyList=('space',))
+    def display_start_of_trial(self, trial, prepare=None):
+        del trial
+        self.flip()
+        self.wait(get_intertrial_interval(), prepare)
+    def display_carpets(self, trial, isymbols, common_transitions):
+        del trial, common_transitions
+        self.images['carpets_glow'].draw()
+        self.images['tibetan.{:02d}{:02d}'.format(*isymbols)].draw()
+        self.flip()
+    def display_selected_carpet(self, trial, choice1, isymbols, common_transitions):
+        del trial, common_transitions
+        self.images['carpets'].draw()
+        self.images['tibetan.{:02d}{:02d}'.format(*isymbols)].draw()
+        self.images['{}_carpet_selected'.format(choice1)].draw()
+        self.flip()
+        self.wait(1)
+    def display_transition(self, trial, final_state_color, common):
+        del trial, final_state_color, common
+        self.images['nap'].draw()
+        self.flip()
+        self.wait(1)
+    def display_lamps(self, trial, final_state_color, fsymbols):
+        del trial
+        self.images['lamps_{}_glow'.format(final_state_color)].draw()
+        self.images['tibetan.{:02}{:02}'.format(*fsymbols)].draw()
+        self.flip()
+    def display_selected_lamp(self, trial, final_state_color, fsymbols, choice2):
+        del trial
+        self.images['lamps_{}'.format(final_state_color)].draw()
+        self.images['{}_lamp_selected'.format(choice2)].draw()
+        self.images['tibetan.{:02}{:02}'.format(*fsymbols)].draw()
+        self.flip()
+        self.wait(1)
+    def display_reward(self, trial, final_state_color, chosen_symbol2):
+        del trial
+        self.images['genie_coin'].draw()
+        self.images['reward_{}'.format(final_state_color)].draw()
+        self.images['tibetan.{:02}'.format(chosen_symbol2)].draw()
+        self.flip()
+        self.wait(1.5)
+    def display_no_reward(self, trial, final_state_color, chosen_symbol2):
+        del trial
+        self.images['genie_zero'].draw()
+        self.images['reward_{}'.format(final_state_color)].draw()
+        self.images['tibetan.{:02}'.format(chosen_symbol2)].draw()
+        self.flip()
+        self.wait(1.5)
 
 if __name__ == '__main__':
     main()
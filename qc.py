@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+"""Quality control of the sessions in the results directory.
+
+Flags empty files, test sessions, sessions with many slow trials or outlying
+response times, position bias in the first-stage choices, and transition
+frequencies that depart from the design of the session: the configuration,
+changed between blocks by the adaptive mode as recorded in the session's
+_design.json. Files are checked in parallel, and the results are cached by
+the content hash of the results and design files, so only new or changed
+sessions are checked again. Files are only hashed again when their size or
+modification time changes."""
+
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import *
+
+import argparse
+import math
+import multiprocessing
+import os
+
+import numpy as np
+
+from cache import JsonCache, file_hash, content_hash
+from results import (TEST_SUBJECTS, list_sessions, get_subject, get_config, load_session, get_design_path,
+                     get_common_probs)
+from two_step import RESULTS_DIR
+
+# Maximum proportion of slow trials
+MAX_SLOW_RATE = 0.2
+# Response times faster than this (s) are anticipations
+MIN_RT = 0.15
+# Response times more than this many median absolute deviations above the median are outliers
+MAX_RT_DEVIATIONS = 5
+# Maximum proportion of outlying response times
+MAX_RT_OUTLIER_RATE = 0.1
+# Significance level of the binomial tests
+ALPHA = 0.01
+# Increase when the checks change, so that cached results are not used
+QC_VERSION = 2
+
+def binomial_test(k, n, p):
+    "Get the two-sided p-value of an exact binomial test."
+    probs = [math.exp(math.lgamma(n + 1) - math.lgamma(i + 1) - math.lgamma(n - i + 1) +
+                      i*math.log(p) + (n - i)*math.log(1 - p)) for i in range(n + 1)]
+    return min(1., sum(prob for prob in probs if prob <= probs[k]*(1 + 1e-7)))
+
+def poisson_binomial_test(k, p):
+    """Get the two-sided p-value of an exact test of k successes in trials
+    with the success probabilities in p."""
+    probs = np.ones(1)
+    for prob in p:
+        probs = np.convolve(probs, (1 - prob, prob))
+    return min(1., probs[probs <= probs[k]*(1 + 1e-7)].sum())
+
+def check_session(path):
+    "Get the list of problems found in a results file."
+    flags = []
+    if get_subject(path).upper() in TEST_SUBJECTS:
+        flags.append('test session')
+    if os.path.getsize(path) == 0:
+        return flags + ['empty file']
+    session = load_session(path)
+    if not len(session['trial']):
+        return flags + ['header only']
+    slow = session['slow'] == 1
+    if slow.mean() > MAX_SLOW_RATE:
+        flags.append('slow rate {:.2f}'.format(slow.mean()))
+
+    rts = np.concatenate((session['rt1'][session['rt1'] != -1], session['rt2'][session['rt2'] != -1]))
+    if len(rts):
+        median = np.median(rts)
+        mad = np.median(np.abs(rts - median))
+        outliers = (rts < MIN_RT) | (rts > median + MAX_RT_DEVIATIONS*mad)
+        if outliers.mean() > MAX_RT_OUTLIER_RATE:
+            flags.append('RT outlier rate {:.2f}'.format(outliers.mean()))
+
+    chose1 = session['choice1'] != -1
+    if chose1.any():
+        left = int((session['choice1'][chose1] == session['isymbol_lft'][chose1]).sum())
+        p_value = binomial_test(left, int(chose1.sum()), 0.5)
+        if p_value < ALPHA:
+            flags.append('position bias: left {}/{} (p = {:.3g})'.format(left, chose1.sum(), p_value))
+
+    config = get_config(path)
+    random_trials = session['trial'] >= len(config.fixed_common)
+    common = session['common'][random_trials]
+    if len(common):
+        common_probs = get_common_probs(path, session['trial'])[random_trials]
+        p_value = poisson_binomial_test(int(common.sum()), common_probs)
+        if p_value < ALPHA:
+            flags.append('common rate {:.2f}, expected {:.2f} (p = {:.3g})'.format(
+                common.mean(), common_probs.mean(), p_value))
+    return flags
+
+def get_stat(path):
+    "Get the size and modification time of a file, or None if there is no file."
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime]
+
+def get_cache_key(path, files):
+    """Get a key for the problems of a results file from everything they depend on.
+
+    The name of the file gives the subject and the configuration, and the
+    design file the common transition probabilities. The files are only
+    hashed again when their size or modification time changed since the key
+    was kept in files."""
+    design_path = get_design_path(path)
+    stats = [get_stat(path), get_stat(design_path)]
+    entry = files.get(path)
+    if entry is not None and entry['stats'] == stats and entry.get('version') == QC_VERSION:
+        return entry['key']
+    key = content_hash({
+        'version': QC_VERSION,
+        'name': os.path.basename(path),
+        'results': file_hash(path),
+        'design': file_hash(design_path) if stats[1] is not None else None,
+    })
+    files[path] = {'stats': stats, 'version': QC_VERSION, 'key': key}
+    return key
+
+def check_sessions(paths, cache, files, processes=None):
+    """Get the problems found in each results file.
+
+    Sessions whose cache key is in the cache are not checked again, and
+    files keeps the cache key of each path."""
+    results = {}
+    to_check = []
+    keys = {}
+    for path in paths:
+        keys[path] = get_cache_key(path, files)
+        if keys[path] in cache:
+            results[path] = cache[keys[path]]
+        else:
+            to_check.append(path)
+    if to_check:
+        pool = multiprocessing.Pool(processes)
+        try:
+            checked = pool.map(check_session, to_check, chunksize=max(1, len(to_check)//64))
+        finally:
+            pool.close()
+            pool.join()
+        for path, flags in zip(to_check, checked):
+            results[path] = flags
+            cache[keys[path]] = flags
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--results-dir', default=RESULTS_DIR)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--all', action='store_true', help='also list sessions without problems')
+    args = parser.parse_args()
+
+    cache = JsonCache('qc')
+    files = JsonCache('qc_files')
+    results = check_sessions(list_sessions(args.results_dir), cache, files, args.processes)
+    cache.save()
+    files.save()
+    flagged = 0
+    for path in sorted(results):
+        if results[path]:
+            flagged += 1
+        if results[path] or args.all:
+            print('{}: {}'.format(os.path.basename(path), '; '.join(results[path]) or 'OK'))
+    print('{} of {} sessions flagged'.format(flagged, len(results)))
+
+if __name__ == '__main__':
+    main()
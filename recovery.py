@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+"""Parameter recovery of the hybrid model with the task's own trial sequences.
+
+Simulates hybrid agents over a grid of parameter values playing the trials
+generated by Trial.get_sequence, fits the hybrid model to the simulated
+sessions and reports how well the parameters are recovered. Simulated
+sessions and fits are cached under a content hash of the configuration, seed,
+agent parameters and fitter version, so changing one setting only computes
+what depends on it."""
+
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import *
+
+import argparse
+import csv
+import io
+import multiprocessing
+import random
+from itertools import product
+
+import numpy as np
+from scipy import stats
+
+import hierarchical
+import hybrid
+from cache import ArtifactStore, content_hash
+from two_step import TutorialConfig, GameConfig, RewardProbability, Model, Trial, code_to_bin
+
+CONFIGS = {'tutorial': TutorialConfig, 'game': GameConfig}
+# Default grid of agent parameters
+GRID = {
+    'alpha': (0.2, 0.5, 0.8),
+    'beta': (2., 5.),
+    'w': (0., 0.5, 1.),
+    'persev': (0., 0.5),
+}
+# Increase when the simulation of the agents or the task changes
+SIMULATOR_VERSION = 1
+# Increase when the fitting procedure changes
+FITTER_VERSION = 1
+# Prior variance of the unconstrained parameters in individual fits
+PRIOR_VAR = np.array([3., 1., 3., 1.])
+
+def get_config(name, settings):
+    "Get a task configuration with some settings changed."
+    return type(str(CONFIGS[name].__name__), (CONFIGS[name],), settings)
+
+def describe_config(config):
+    "Get a description of everything in a configuration that affects the trials."
+    return {
+        'initial_state_symbols': list(config.initial_state_symbols),
+        'final_state_symbols': [list(pair) for pair in config.final_state_symbols],
+        'num_trials': config.num_trials,
+        'common_prob': config.common_prob,
+        'diffusion_rate': config.diffusion_rate,
+        'fixed_common': list(config.fixed_common),
+        'reward_bounds': [RewardProbability.MIN_VALUE, RewardProbability.MAX_VALUE],
+    }
+
+def simulate_session(args):
+    """Simulate a hybrid agent playing a session of the task.
+
+    The trials come from Trial.get_sequence, seeded with the session's seed,
+    and the agent makes its choices with a separate generator so it doesn't
+    change the trials. Returns arrays coded
+    as in hybrid.py."""
+    config_name, settings, params, seed = args
+    config = get_config(config_name, settings)
+    task_seed, agent_seed = np.random.SeedSequence(seed).generate_state(2)
+    random.seed(int(task_seed))
+    rng = np.random.default_rng(agent_seed)
+    params = {name: np.asarray(float(value)) for name, value in params.items()}
+    q1, q2 = hybrid.initial_values(())
+    prev_choice1 = -1
+    session = {key: np.zeros(config.num_trials, dtype=int)
+               for key in ('common', 'choice1', 'final_state', 'choice2', 'reward')}
+    sequence = Trial.get_sequence(config, Model.create_random(config))
+    for t, trial in zip(range(config.num_trials), sequence):
+        logit1 = hybrid.first_stage_logit(q1, q2, params, prev_choice1, config.common_prob)
+        choice1 = int(rng.random() < 1/(1 + np.exp(-logit1)))
+        chosen_symbol1 = [symbol for symbol in trial.initial_state.symbols
+                          if code_to_bin(symbol.code) == choice1 + 1][0]
+        final_state = code_to_bin(chosen_symbol1.code, trial.common) - 1
+        logit2 = hybrid.second_stage_logit(q2, final_state, params)
+        choice2 = int(rng.random() < 1/(1 + np.exp(-logit2)))
+        chosen_symbol2 = [symbol for symbol in chosen_symbol1.final_state.symbols
+                          if code_to_bin(symbol.code) == choice2 + 1][0]
+        reward = chosen_symbol2.reward
+        hybrid.update(q1, q2, choice1, final_state, choice2, reward, params)
+        prev_choice1 = choice1
+        for key, value in (('common', trial.common), ('choice1', choice1), ('final_state', final_state),
+                           ('choice2', choice2), ('reward', reward)):
+            session[key][t] = value
+    return session
+
+def get_agents(grid, num_replicates, seed):
+    "Get the parameters and seed of each simulated agent."
+    return [
+        (dict(zip(hybrid.PARAMETERS, values)), [seed, replicate])
+        for values in product(*[grid[name] for name in hybrid.PARAMETERS])
+        for replicate in range(num_replicates)
+    ]
+
+def simulate(config_name, settings, agents, store, processes=None):
+    "Get the simulated session of each agent and its key, simulating those not in the store."
+    config = get_config(config_name, settings)
+    keys = [
+        content_hash({'simulator': SIMULATOR_VERSION, 'config': describe_config(config),
+                      'params': params, 'seed': seed})
+        for params, seed in agents
+    ]
+    missing = [i for i, key in enumerate(keys) if key not in store]
+    if missing:
+        pool = multiprocessing.Pool(processes)
+        try:
+            sessions = pool.map(
+                simulate_session, [(config_name, settings, agents[i][0], agents[i][1]) for i in missing],
+                chunksize=max(1, len(missing)//64))
+        finally:
+            pool.close()
+            pool.join()
+        for i, session in zip(missing, sessions):
+            store[keys[i]] = session
+    return keys, [store[key] for key in keys]
+
+def stack_sessions(sessions, common_prob):
+    "Stack sessions of the same length as by hierarchical.load_cohort, one row per session."
+    data = {key: np.array([session[key] for session in sessions])
+            for key in ('choice1', 'final_state', 'choice2', 'reward')}
+    data['common_prob'] = np.full(data['choice1'].shape, common_prob)
+    data['session_start'] = np.zeros(data['choice1'].shape, dtype=bool)
+    data['session_start'][:, 0] = True
+    return data
+
+def fit(config, method, keys, sessions, store, processes=None):
+    """Get the fitted unconstrained parameters of each session, fitting those not in the store.
+
+    Individual fits are cached per session. A hierarchical fit depends on the
+    whole cohort, so it is cached under the keys of all its sessions."""
+    if method == 'hierarchical':
+        key = content_hash({'fitter': FITTER_VERSION, 'method': method, 'sessions': keys})
+        if key not in store:
+            result = hierarchical.fit(stack_sessions(sessions, config.common_prob), processes)
+            store[key] = {'x': result['x']}
+        return store[key]['x']
+    fit_keys = [
+        content_hash({'fitter': FITTER_VERSION, 'method': method, 'session': key,
+                      'prior_mean': hierarchical.PRIOR_MEAN.tolist(), 'prior_var': PRIOR_VAR.tolist()})
+        for key in keys
+    ]
+    missing = [i for i, key in enumerate(fit_keys) if key not in store]
+    if missing:
+        result = hierarchical.fit_individual(
+            stack_sessions([sessions[i] for i in missing], config.common_prob), hierarchical.PRIOR_MEAN,
+            PRIOR_VAR, processes)
+        for i, x in zip(missing, result['x']):
+            store[fit_keys[i]] = {'x': x}
+    return np.array([store[key]['x'] for key in fit_keys])
+
+def get_recovery(true_params, fitted_params):
+    "Get the correlations, bias and root mean square error of the recovered parameters."
+    recovery = {}
+    for name in hybrid.PARAMETERS:
+        true = np.asarray(true_params[name])
+        fitted = np.asarray(fitted_params[name])
+        varied = len(np.unique(true)) > 1
+        recovery[name] = {
+            'pearson': stats.pearsonr(true, fitted)[0] if varied else np.nan,
+            'spearman': stats.spearmanr(true, fitted)[0] if varied else np.nan,
+            'bias': (fitted - true).mean(),
+            'rmse': np.sqrt(((fitted - true)**2).mean()),
+        }
+    return recovery
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--config', choices=sorted(CONFIGS), default='game')
+    parser.add_argument('--num-trials', type=int, default=None, help='trials per session')
+    parser.add_argument('--common-prob', type=float, default=None)
+    parser.add_argument('--replicates', type=int, default=10, help='sessions per grid point')
+    parser.add_argument('--method', choices=('individual', 'hierarchical'), default='individual')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--output', help='CSV file for the true and recovered parameters')
+    for name in hybrid.PARAMETERS:
+        parser.add_argument(
+            '--{}'.format(name), type=float, nargs='+', default=GRID[name],
+            help='grid values (default: {})'.format(' '.join(str(value) for value in GRID[name])))
+    args = parser.parse_args()
+
+    settings = {name: value for name, value in (
+        ('num_trials', args.num_trials), ('common_prob', args.common_prob)) if value is not None}
+    config = get_config(args.config, settings)
+    grid = {name: getattr(args, name) for name in hybrid.PARAMETERS}
+    agents = get_agents(grid, args.replicates, args.seed)
+    keys, sessions = simulate(args.config, settings, agents, ArtifactStore('recovery_sessions'), args.processes)
+    x = fit(config, args.method, keys, sessions, ArtifactStore('recovery_fits'), args.processes)
+    true_params = {name: [params[name] for params, _ in agents] for name in hybrid.PARAMETERS}
+    fitted_params = hierarchical.to_params(x)
+
+    print('{} sessions of {} trials, common probability {}, {} fits'.format(
+        len(agents), config.num_trials, config.common_prob, args.method))
+    print('{:<8} {:>8} {:>8} {:>8} {:>8}'.format('', 'pearson', 'spearman', 'bias', 'rmse'))
+    recovery = get_recovery(true_params, fitted_params)
+    for name in hybrid.PARAMETERS:
+        result = recovery[name]
+        print('{:<8} {:8.3f} {:8.3f} {:8.3f} {:8.3f}'.format(
+            name, result['pearson'], result['spearman'], result['bias'], result['rmse']))
+    if args.output:
+        with io.open(args.output, 'w', newline='') as outf:
+            csv_writer = csv.writer(outf)
+            csv_writer.writerow(['true_' + name for name in hybrid.PARAMETERS] +
+                                ['fitted_' + name for name in hybrid.PARAMETERS])
+            for i in range(len(agents)):
+                csv_writer.writerow([true_params[name][i] for name in hybrid.PARAMETERS] +
+                                    [fitted_params[name][i] for name in hybrid.PARAMETERS])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+"""Renders a video of what a participant saw from a session's results file.
+
+The screens are drawn by the same display classes as in the task, on a
+hidden window and without waiting between screens. Each screen is kept in
+the video for as long as it was shown, using the response times in the
+results file. The session is split into chunks of trials rendered in
+parallel, each by its own process, and the chunks are then joined."""
+
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import *
+
+import argparse
+import csv
+import io
+import json
+import os
+import subprocess
+import tempfile
+
+import numpy as np
+try:
+    import imageio
+    import imageio_ffmpeg
+except ImportError:
+    raise ImportError('replay.py writes videos with imageio and imageio-ffmpeg, '
+                      'install them with: pip install imageio imageio-ffmpeg')
+
+from model_learn import TutorialDisplay, GameDisplay, load_image_collection
+from results import get_config, get_chunks, map_chunks
+from two_step import ASSETS_DIR, TEXT_FIELDNAMES, GameConfig, Model, code_to_bin
+
+# Seconds to show the break screen, which waits for the participant in the task
+BREAK_DURATION = 2
+
+def get_session_type(path):
+    "Get the configuration and display class for a results file."
+    config = get_config(path)
+    return config, GameDisplay if config is GameConfig else TutorialDisplay
+
+def load_model(path, config):
+    """Load the model and mountain sides of a session.
+
+    Sessions recorded before the model was saved get the configuration's order."""
+    try:
+        with io.open(os.path.splitext(path)[0] + '_model.json', 'r', encoding='utf-8') as inf:
+            saved = json.load(inf)
+    except (IOError, OSError):
+        print('No model saved for {}, using the default model'.format(path))
+        return (Model(config.initial_state_symbols, list(config.final_state_colors),
+                      list(config.final_state_symbols)),
+                list(config.final_state_colors))
+    model = Model(
+        saved['isymbol_codes'], saved['colors'], [tuple(codes) for codes in saved['fsymbol_codes']])
+    return model, saved['mountain_sides']
+
+def bin_to_code(value, codes):
+    "Get the symbol code that code_to_bin maps to a value."
+    return [code for code in codes if code_to_bin(code) == value][0]
+
+def get_replay_trials(rows, config, model):
+    "Reconstruct the screens' contents for each row of a results file."
+    slow_trials = 0
+    for row in rows:
+        row = {key: value if key in TEXT_FIELDNAMES else float(value) for key, value in row.items()}
+        trial = {
+            'number': int(row['trial']),
+            'completed': int(row['trial']) - slow_trials,
+            'common': bool(row['common']),
+            'isymbols': [bin_to_code(row['isymbol_lft'], config.initial_state_symbols),
+                         bin_to_code(row['isymbol_rgt'], config.initial_state_symbols)],
+            'slow1': row['rt1'] == -1,
+            'slow2': row['rt1'] != -1 and row['rt2'] == -1,
+            'rt1': row['rt1'],
+            'rt2': row['rt2'],
+        }
+        if not trial['slow1']:
+            trial['choice1'] = 'k' if row['choice1'] == row['isymbol_rgt'] else 's'
+            chosen_symbol1 = trial['isymbols'][int(trial['choice1'] == 'k')]
+            for isymbol_code, color, fsymbol_codes in model.get_paths(trial['common']):
+                if isymbol_code == chosen_symbol1:
+                    trial['color'] = color
+                    trial['fsymbols'] = [bin_to_code(row['fsymbol_lft'], fsymbol_codes),
+                                         bin_to_code(row['fsymbol_rgt'], fsymbol_codes)]
+        if not trial['slow1'] and not trial['slow2']:
+            trial['choice2'] = 'k' if row['choice2'] == row['fsymbol_rgt'] else 's'
+            trial['chosen_symbol2'] = trial['fsymbols'][int(trial['choice2'] == 'k')]
+            trial['reward'] = bool(row['reward'])
+        if trial['slow1'] or trial['slow2']:
+            slow_trials += 1
+        trial['slow_trials'] = slow_trials
+        yield trial
+
+class ScreenRecorder(object):
+    """Replaces the flip and wait methods of a display, writing each screen to a video.
+
+    A screen is written when the next one is flipped, once its duration is known."""
+    def __init__(self, win, writer, fps):
+        self.win = win
+        self.writer = writer
+        self.fps = fps
+        self.recording = False
+        self.frame = None
+        self.duration = 0
+    def flip(self):
+        if self.recording:
+            self.write_frame()
+            self.frame = np.asarray(self.win.getMovieFrame(buffer='back'))
+            del self.win.movieFrames[:]
+        self.win.flip()
+    def wait(self, secs, prepare=None):
+        if prepare is not None:
+            prepare()
+        if self.recording:
+            self.duration += secs
+    def write_frame(self):
+        if self.frame is not None:
+            for _ in range(max(1, int(round(self.duration*self.fps)))):
+                self.writer.append_data(self.frame)
+        self.frame = None
+        self.duration = 0
+
+def replay_trial(display, trial, config, common_transitions):
+    "Draw the screens of a trial in the same order as run_trial_sequence."
+    completed = trial['completed']
+    display.display_start_of_trial(trial['number'])
+    display.display_carpets(completed, trial['isymbols'], common_transitions)
+    if trial['slow1']:
+        display.wait(config.max_wait)
+        display.display_slow1()
+    else:
+        display.wait(trial['rt1'])
+        display.display_selected_carpet(
+            completed, trial['choice1'], trial['isymbols'], common_transitions)
+        display.display_transition(completed, trial['color'], trial['common'])
+        display.display_lamps(completed, trial['color'], trial['fsymbols'])
+        if trial['slow2']:
+            display.wait(config.max_wait)
+            display.display_slow2(trial['color'])
+        else:
+            display.wait(trial['rt2'])
+            display.display_selected_lamp(
+                completed, trial['color'], trial['fsymbols'], trial['choice2'])
+            if trial['reward']:
+                display.display_reward(completed, trial['color'], trial['chosen_symbol2'])
+            else:
+                display.display_no_reward(completed, trial['color'], trial['chosen_symbol2'])
+    display.display_end_of_trial()
+    if config.do_break(trial['number'] + 1, trial['slow_trials']):
+        display.display_break()
+        display.wait(BREAK_DURATION)
+
+def _render_chunk(args):
+    """Render the trials from start to stop of a session to a video file.
+
+    Earlier trials are drawn without being recorded, to bring the display to
+    the state it had at the start of the chunk."""
+    path, start, stop, video_path, fps, size = args
+    # Imported here so that only the worker processes open a window
+    from psychopy import visual
+    config, display_class = get_session_type(path)
+    model, mountain_sides = load_model(path, config)
+    with io.open(path, 'r', newline='') as inf:
+        rows = list(csv.DictReader(inf))
+    win = visual.Window(
+        size=size, units='pix', color='#404040', fullscr=False, allowGUI=False,
+        useFBO=True, waitBlanking=False, gamma=None)
+    win.winHandle.set_visible(False)
+    images = load_image_collection(win, ASSETS_DIR)
+    display = display_class(win, images, mountain_sides)
+    writer = imageio.get_writer(video_path, fps=fps, macro_block_size=1)
+    recorder = ScreenRecorder(win, writer, fps)
+    display.flip = recorder.flip
+    display.wait = recorder.wait
+    common_transitions = {
+        isymbol_code: {'color': color}
+        for isymbol_code, color, fsymbol_codes in model.get_paths(True)
+    }
+    for i, trial in enumerate(get_replay_trials(rows[:stop], config, model)):
+        recorder.recording = i >= start
+        replay_trial(display, trial, config, common_transitions)
+    recorder.write_frame()
+    writer.close()
+    win.close()
+    return video_path
+
+def render(path, video_path, fps=10, processes=None, size=(1280, 1024)):
+    """Render a session to a video, in chunks of trials rendered in parallel.
+
+    Returns whether there was a video to render, that is, trials in the session."""
+    with io.open(path, 'r', newline='') as inf:
+        num_trials = len(list(csv.DictReader(inf)))
+    if not num_trials:
+        print('No trials to replay in {}'.format(path))
+        return False
+    tmp_dir = tempfile.mkdtemp()
+    chunk_paths = map_chunks(_render_chunk, [
+        (path, chunk[0], chunk[-1] + 1, os.path.join(tmp_dir, 'chunk{:03d}.mp4'.format(i)), fps, size)
+        for i, chunk in enumerate(get_chunks(num_trials, processes))
+    ])
+    # Join the chunks without encoding them again
+    list_path = os.path.join(tmp_dir, 'chunks.txt')
+    with io.open(list_path, 'w', encoding='utf-8') as outf:
+        for chunk_path in chunk_paths:
+            outf.write("file '{}'\n".format(chunk_path))
+    subprocess.check_call([
+        imageio_ffmpeg.get_ffmpeg_exe(), '-y', '-loglevel', 'error', '-f', 'concat',
+        '-safe', '0', '-i', list_path, '-c', 'copy', video_path])
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('session', help='results file of the session')
+    parser.add_argument('--output', help='video file, by default next to the results file')
+    parser.add_argument('--fps', type=int, default=10)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--size', type=int, nargs=2, default=(1280, 1024))
+    parser.add_argument(
+        '--software-gl', action='store_true',
+        help='render with the software OpenGL driver, for machines without a GPU')
+    args = parser.parse_args()
+    if args.software_gl:
+        # Read when each worker creates its OpenGL context
+        os.environ['LIBGL_ALWAYS_SOFTWARE'] = '1'
+    output = args.output or os.path.splitext(args.session)[0] + '.mp4'
+    if render(args.session, output, args.fps, args.processes, tuple(args.size)):
+        print('Saved {}'.format(output))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+"""Reads the session files written by run_trial_sequence.
+
+Also has what the analysis tools share: the selection of the sessions to
+analyze and the split of the work between processes."""
+
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import *
+
+import csv
+import io
+import json
+import multiprocessing
+import os
+from os.path import join
+
+import numpy as np
+
+from two_step import RESULTS_DIR, CSV_FIELDNAMES, TEXT_FIELDNAMES, TutorialConfig, GameConfig
+
+# Subject numbers used for testing the task, not for real participants
+TEST_SUBJECTS = ('999', 'TEST')
+
+def list_sessions(results_dir=RESULTS_DIR):
+    "List the paths of the session files in a results directory."
+    return sorted(
+        join(results_dir, fn) for fn in os.listdir(results_dir)
+        if os.path.splitext(fn)[1] == '.csv'
+    )
+
+def add_exclude_argument(parser):
+    "Add the argument for the subjects whose sessions are not analyzed."
+    parser.add_argument(
+        '--exclude', nargs='*', default=list(TEST_SUBJECTS), help='subject numbers to exclude')
+
+def select_sessions(results_dir=RESULTS_DIR, session=None, exclude=TEST_SUBJECTS):
+    """List the paths of the session files to analyze.
+
+    Only those of one part of the task ('tutorial' or 'game') if session is
+    given, and none of the subjects in exclude."""
+    exclude = [code.upper() for code in exclude]
+    return [
+        path for path in list_sessions(results_dir)
+        if (session is None or path.endswith('_{}.csv'.format(session))) and
+        get_subject(path).upper() not in exclude
+    ]
+
+def get_chunks(num_items, processes=None):
+    "Split the indices of the items into one chunk per process, without empty chunks."
+    processes = processes or multiprocessing.cpu_count()
+    return [chunk for chunk in np.array_split(np.arange(num_items), processes) if len(chunk)]
+
+def map_chunks(function, args):
+    "Map a function over the arguments of each chunk in a pool with a process per chunk."
+    pool = multiprocessing.Pool(len(args))
+    try:
+        return pool.map(function, args)
+    finally:
+        pool.close()
+        pool.join()
+
+def get_subject(path):
+    "Get the subject number from the name of a session file."
+    return os.path.basename(path).split('_')[0]
+
+def get_config(path):
+    "Get the configuration of the session in a results file."
+    if path.endswith('_game.csv'):
+        return GameConfig
+    return TutorialConfig
+
+def get_design_path(path):
+    return os.path.splitext(path)[0] + '_design.json'
+
+def get_common_probs(path, trials):
+    """Get the common transition probability of each trial of a session.
+
+    It is that of the configuration, changed from the trials where the
+    adaptive mode chose a new design."""
+    probs = np.full(len(trials), get_config(path).common_prob)
+    try:
+        with io.open(get_design_path(path), 'r', encoding='utf-8') as inf:
+            history = json.load(inf)
+    except (IOError, OSError):
+        history = []
+    for design in history:
+        probs[trials >= design['trial']] = design['common_prob']
+    return probs
+
+def load_session(path):
+    """Load a session file as a dictionary of NumPy arrays, one per column.
+
+    Text columns are kept as strings. Empty and header-only files give
+    arrays of length zero."""
+    with io.open(path, 'r', newline='') as inf:
+        reader = csv.DictReader(inf)
+        rows = list(reader)
+        fieldnames = reader.fieldnames or ()
+    return {
+        fdn: np.array([row[fdn] if fdn in TEXT_FIELDNAMES else float(row[fdn]) for row in rows])
+        for fdn in CSV_FIELDNAMES if fdn in fieldnames or not rows
+    }
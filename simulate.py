@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+"""Fast simulation of the two-stage task, vectorized over sessions with NumPy.
+
+Follows the same rules as Trial.get_sequence and RewardProbability, with
+choices, final states and rewards coded as in hybrid.py."""
+
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import *
+
+import numpy as np
+
+import hybrid
+from two_step import RewardProbability
+
+def create_reward_probabilities(rng, shape):
+    "Get random initial reward probabilities, as RewardProbability.create_random."
+    return rng.uniform(RewardProbability.MIN_VALUE, RewardProbability.MAX_VALUE, shape)
+
+def diffuse(rng, probs, diffusion_rate):
+    "Get the next reward probabilities by diffusion, as RewardProbability.diffuse."
+    next_probs = probs + np.mod(rng.normal(0, diffusion_rate, np.shape(probs)), 1)
+    max_value = RewardProbability.MAX_VALUE
+    min_value = RewardProbability.MIN_VALUE
+    next_probs = np.where(next_probs > max_value, 2*max_value - next_probs, next_probs)
+    return np.where(next_probs < min_value, 2*min_value - next_probs, next_probs)
+
+def get_reward_probability(probs, final_state, choice2):
+    "Get the reward probability of the chosen second-stage option."
+    chosen = hybrid.one_hot(final_state)[..., :, None]*hybrid.one_hot(choice2)[..., None, :]
+    return (probs*chosen).sum(axis=(-2, -1))
+
+def simulate_hybrid(rng, params, num_trials, common_prob, diffusion_rate):
+    """Simulate sessions of hybrid agents, one per element of the parameter arrays.
+
+    Returns a dictionary of arrays with the trial number as the last dimension."""
+    shape = np.broadcast(*[params[name] for name in hybrid.PARAMETERS]).shape
+    probs = create_reward_probabilities(rng, shape + (2, 2))
+    q1, q2 = hybrid.initial_values(shape)
+    prev_choice1 = np.full(shape, -1)
+    sessions = {
+        key: np.zeros(shape + (num_trials,), dtype=int)
+        for key in ('choice1', 'common', 'final_state', 'choice2', 'reward')
+    }
+    for t in range(num_trials):
+        logit1 = hybrid.first_stage_logit(q1, q2, params, prev_choice1, common_prob)
+        choice1 = (rng.random(shape) < 1/(1 + np.exp(-logit1))).astype(int)
+        common = (rng.random(shape) < common_prob).astype(int)
+        final_state = np.where(common, choice1, 1 - choice1)
+        logit2 = hybrid.second_stage_logit(q2, final_state, params)
+        choice2 = (rng.random(shape) < 1/(1 + np.exp(-logit2))).astype(int)
+        reward = (rng.random(shape) < get_reward_probability(probs, final_state, choice2)).astype(int)
+        hybrid.update(q1, q2, choice1, final_state, choice2, reward, params)
+        for key, value in (('choice1', choice1), ('common', common), ('final_state', final_state),
+                           ('choice2', choice2), ('reward', reward)):
+            sessions[key][..., t] = value
+        prev_choice1 = choice1
+        probs = diffuse(rng, probs, diffusion_rate)
+    return sessions
+
+def generate_trials(rng, config, num_sessions, num_trials):
+    """Generate trials as Trial.get_sequence does, for many sessions at once.
+
+    Yields a dictionary of arrays over sessions for each trial: whether the
+    transition is common, whether the initial symbols are swapped from the
+    model's order, whether each pair of final symbols is swapped from the
+    configuration's order, and the reward probability and reward of each
+    final symbol in the configuration's order."""
+    num_symbols = len(config.final_state_symbols)*len(config.final_state_symbols[0])
+    probs = create_reward_probabilities(rng, (num_sessions, num_symbols))
+    for t in range(num_trials):
+        if t < len(config.fixed_common):
+            common = np.full(num_sessions, config.fixed_common[t])
+        else:
+            common = rng.random(num_sessions) < config.common_prob
+        yield {
+            'trial': t,
+            'common': common,
+            'isymbol_swapped': rng.random(num_sessions) < 0.5,
+            'fsymbol_swapped': rng.random((num_sessions, len(config.final_state_symbols))) < 0.5,
+            'reward_probabilities': probs,
+            'rewards': rng.random((num_sessions, num_symbols)) < probs,
+        }
+        probs = diffuse(rng, probs, config.diffusion_rate)
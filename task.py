@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+"""Multi-stage task engine defined by transition and reward probability arrays.
+
+A task has one initial state and any number of stages. Each state of a stage
+offers the same number of options, and the option chosen leads to a state of
+the next stage with the probabilities in that stage's transition array. The
+options of the last stage are rewarded with probabilities that diffuse as in
+RewardProbability. Trials are generated for many sessions at once, and the
+columns of the results are generated from the task's structure, so larger
+tasks take the same number of NumPy operations per trial as the two-stage
+task of two_step.py, which Task.from_config reproduces. The rows of a
+two-stage task with two options per state have the columns of CSV_FIELDNAMES,
+so results.load_session and the analyses read them like the files of
+model_learn.py.
+
+model_learn.py does not use the engine: it generates its trials one at a time
+with Trial.get_sequence, from the random module, so that a session can be
+resumed from the random state in its checkpoint. The engine is for
+simulating many sessions at once, such as the conformance checks of the
+generated trials in conformance.py."""
+
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import *
+
+import argparse
+import time
+
+import numpy as np
+
+from simulate import create_reward_probabilities, diffuse
+from two_step import CSV_FIELDNAMES
+
+# Columns of the generic results of a two-stage task in CSV_FIELDNAMES
+TWO_STAGE_COLUMNS = {
+    'symbol1.1': 'isymbol_lft', 'symbol1.2': 'isymbol_rgt', 'state2': 'final_state',
+    'symbol2.1': 'fsymbol_lft', 'symbol2.2': 'fsymbol_rgt',
+}
+
+class Task(object):
+    """Structure of a multi-stage task.
+
+    transitions[s] has shape (states of stage s, options of stage s, states of
+    stage s + 1), and the last stage has num_options[-1] options in each of
+    its states. The first trials can be fixed to have only common (True) or
+    only rare (False) transitions, where the common transition of an option is
+    its most likely one."""
+    def __init__(self, transitions, num_options, diffusion_rate=0.025, fixed_common=()):
+        self.transitions = [np.asarray(array, dtype=float) for array in transitions]
+        self.num_stages = len(self.transitions) + 1
+        self.num_states = (1,) + tuple(array.shape[-1] for array in self.transitions)
+        self.num_options = tuple(num_options)
+        self.diffusion_rate = diffusion_rate
+        self.fixed_common = tuple(fixed_common)
+        if len(self.num_options) != self.num_stages:
+            raise ValueError('Expected the number of options of {} stages'.format(self.num_stages))
+        for stage, array in enumerate(self.transitions):
+            if array.shape[:2] != (self.num_states[stage], self.num_options[stage]):
+                raise ValueError('Transitions of stage {} have shape {}, expected ({}, {}, n)'.format(
+                    stage + 1, array.shape, self.num_states[stage], self.num_options[stage]))
+            if not np.allclose(array.sum(axis=-1), 1):
+                raise ValueError('Transition probabilities of stage {} do not sum to 1'.format(stage + 1))
+        # Destinations of each option from most to least likely, so that a
+        # single uniform number per stage makes all transitions common or rare
+        # together, as in Trial.get_sequence
+        self.destinations = [np.argsort(-array, axis=-1, kind='stable') for array in self.transitions]
+        self.thresholds = [
+            np.cumsum(np.take_along_axis(array, order, axis=-1), axis=-1)
+            for array, order in zip(self.transitions, self.destinations)
+        ]
+    @classmethod
+    def from_config(cls, config):
+        "Get the two-stage task of a configuration of two_step.py."
+        p = config.common_prob
+        return cls([[[[p, 1 - p], [1 - p, p]]]], (2, 2), config.diffusion_rate, config.fixed_common)
+    @classmethod
+    def create(cls, num_options, num_states, common_prob, diffusion_rate=0.025):
+        """Get a task where each option has one common destination.
+
+        num_states has the number of states of each stage after the first.
+        Option o of state i commonly leads to state (i*options + o) modulo the
+        number of states of the next stage, and the other states share the
+        rare transitions equally."""
+        states = (1,) + tuple(num_states)
+        transitions = []
+        for stage in range(len(states) - 1):
+            n = states[stage + 1]
+            array = np.full((states[stage], num_options[stage], n), (1 - common_prob)/max(n - 1, 1))
+            for i in range(states[stage]):
+                for o in range(num_options[stage]):
+                    array[i, o, (i*num_options[stage] + o) % n] = common_prob if n > 1 else 1
+            transitions.append(array)
+        return cls(transitions, num_options, diffusion_rate)
+    def is_two_stage(self):
+        "Whether this task has the structure of the task of two_step.py."
+        return self.num_states == (1, 2) and self.num_options == (2, 2)
+    def get_fieldnames(self):
+        """Get the columns of a results file of this task.
+
+        States, options and screen positions are numbered from 1. For each
+        stage there are the options shown at each position, the response time
+        and the option chosen, and after the first stage the state reached and
+        whether it was reached by the common transition. A two-stage task has
+        the columns of CSV_FIELDNAMES instead."""
+        if self.is_two_stage():
+            return list(CSV_FIELDNAMES)
+        fieldnames = ['trial']
+        fieldnames += ['reward.{}.{}'.format(i + 1, j + 1) for i in range(self.num_states[-1])
+                       for j in range(self.num_options[-1])]
+        for stage in range(self.num_stages):
+            if stage:
+                fieldnames += ['state{}'.format(stage + 1), 'common{}'.format(stage + 1)]
+            fieldnames += ['symbol{}.{}'.format(stage + 1, position + 1)
+                           for position in range(self.num_options[stage])]
+            fieldnames += ['rt{}'.format(stage + 1), 'choice{}'.format(stage + 1)]
+        return fieldnames + ['reward', 'slow']
+    def generate_trials(self, rng, num_sessions, num_trials):
+        """Generate trials for many sessions at once.
+
+        Yields a dictionary of arrays over sessions for each trial: for each
+        stage transition, the state each option of each state leads to and
+        whether that transition is common, the options of each state of each
+        stage in screen order, and the reward probability and reward of each
+        option of the last stage."""
+        probs = create_reward_probabilities(rng, (num_sessions, self.num_states[-1], self.num_options[-1]))
+        for t in range(num_trials):
+            trial = {'trial': t, 'next_states': [], 'common': []}
+            for stage, (order, thresholds) in enumerate(zip(self.destinations, self.thresholds)):
+                draws = rng.random(num_sessions)[:, None, None]
+                if t < len(self.fixed_common):
+                    # Scale the draw into the common or the rare part of the
+                    # row of each state and option, whose common probabilities differ
+                    common_prob = thresholds[..., 0]
+                    if self.fixed_common[t]:
+                        draws = draws*common_prob
+                    else:
+                        draws = common_prob + draws*(1 - common_prob)
+                rank = np.minimum((draws[..., None] >= thresholds).sum(axis=-1),
+                                  thresholds.shape[-1] - 1)
+                trial['next_states'].append(
+                    np.take_along_axis(order[None], rank[..., None], axis=-1)[..., 0])
+                trial['common'].append(rank == 0)
+            trial['positions'] = [
+                np.argsort(rng.random((num_sessions, states, options)), axis=-1)
+                for states, options in zip(self.num_states, self.num_options)
+            ]
+            trial['reward_probabilities'] = probs
+            trial['rewards'] = rng.random(probs.shape) < probs
+            yield trial
+            probs = diffuse(rng, probs, self.diffusion_rate)
+    def play(self, trial, choices):
+        """Get the outcome of the choices made in a trial of each session.
+
+        choices has shape (sessions, stages), with the option chosen in each
+        stage or -1 when there was no choice, which ends the trial. Returns the
+        state of each stage (-1 when not reached), whether each transition was
+        common (-1 when not made) and the reward."""
+        num_sessions = len(choices)
+        sessions = np.arange(num_sessions)
+        states = np.full((num_sessions, self.num_stages), -1)
+        common = np.full((num_sessions, self.num_stages - 1), -1)
+        state = np.zeros(num_sessions, dtype=int)
+        active = np.ones(num_sessions, dtype=bool)
+        for stage in range(self.num_stages):
+            states[:, stage] = np.where(active, state, -1)
+            choice = choices[:, stage]
+            active &= choice >= 0
+            if stage < self.num_stages - 1:
+                option = np.maximum(choice, 0)
+                common[:, stage] = np.where(
+                    active, trial['common'][stage][sessions, state, option], -1)
+                state = trial['next_states'][stage][sessions, state, option]
+        reward = active & trial['rewards'][sessions, state, np.maximum(choices[:, -1], 0)]
+        return states, common, reward.astype(int)
+    def get_rows(self, trial, choices, rts):
+        """Get the rows of the results files of each session for a trial.
+
+        Response times of stages without a choice are written as -1. The rows
+        of a two-stage task are converted to the columns of CSV_FIELDNAMES:
+        its transitions are all common or all rare together, as in
+        Trial.get_sequence, so common is that of the trial, even without a
+        choice, walk is -1 and walk_bank empty."""
+        states, common, reward = self.play(trial, choices)
+        sessions = np.arange(len(choices))
+        rows = []
+        for i in sessions:
+            row = {'trial': int(trial['trial']), 'reward': int(reward[i]),
+                   'slow': int((choices[i] < 0).any())}
+            for state in range(self.num_states[-1]):
+                for option in range(self.num_options[-1]):
+                    row['reward.{}.{}'.format(state + 1, option + 1)] = \
+                        float(trial['reward_probabilities'][i, state, option])
+            for stage in range(self.num_stages):
+                state = states[i, stage]
+                if stage:
+                    row['state{}'.format(stage + 1)] = int(state) + 1 if state >= 0 else -1
+                    row['common{}'.format(stage + 1)] = int(common[i, stage - 1])
+                for position in range(self.num_options[stage]):
+                    row['symbol{}.{}'.format(stage + 1, position + 1)] = (
+                        int(trial['positions'][stage][i, state, position]) + 1 if state >= 0 else -1)
+                chosen = state >= 0 and choices[i, stage] >= 0
+                row['rt{}'.format(stage + 1)] = float(rts[i, stage]) if chosen else -1
+                row['choice{}'.format(stage + 1)] = int(choices[i, stage]) + 1 if chosen else -1
+            if self.is_two_stage():
+                del row['common2']
+                row = {TWO_STAGE_COLUMNS.get(key, key): value for key, value in row.items()}
+                row['common'] = int(trial['common'][0][i, 0, 0])
+                row['walk'] = -1
+                row['walk_bank'] = ''
+            rows.append(row)
+        return rows
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time the generation of trials and random choices for a task structure.')
+    parser.add_argument('--options', type=int, nargs='+', default=[2, 2],
+                        help='options of each stage')
+    parser.add_argument('--states', type=int, nargs='+', default=[2],
+                        help='states of each stage after the first')
+    parser.add_argument('--common-prob', type=float, default=0.7)
+    parser.add_argument('--sessions', type=int, default=10000)
+    parser.add_argument('--trials', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    task = Task.create(args.options, args.states, args.common_prob)
+    rng = np.random.default_rng(args.seed)
+    print('Columns: {}'.format(', '.join(task.get_fieldnames())))
+    start = time.time()
+    rewards = 0
+    for trial in task.generate_trials(rng, args.sessions, args.trials):
+        choices = (rng.random((args.sessions, task.num_stages))*task.num_options).astype(int)
+        rewards += task.play(trial, choices)[2].sum()
+    elapsed = time.time() - start
+    print('{:.1f} us per trial for {} sessions at once, reward rate {:.3f}'.format(
+        1e6*elapsed/args.trials, args.sessions, rewards/(args.sessions*args.trials)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+
+"""Options of the tests: the long-volume checks only run with --run-slow."""
+
+import pytest
+
+def pytest_addoption(parser):
+    parser.addoption('--run-slow', action='store_true', help='run the long-volume checks')
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--run-slow'):
+        return
+    skip = pytest.mark.skip(reason='long-volume check, run with --run-slow')
+    for item in items:
+        if 'slow' in item.keywords:
+            item.add_marker(skip)
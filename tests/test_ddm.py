@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of the likelihood of the drift-diffusion models."""
+
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import *
+
+import numpy as np
+import pytest
+
+from ddm import stage_log_likelihood
+from two_step import MAX_WAIT
+
+@pytest.mark.parametrize('v, a, t0', [(0., 1., 0.3), (1.5, 2., 0.2), (-0.8, 1.2, 0.5), (0.2, 3., 0.)])
+def test_normalization(v, a, t0):
+    "The densities of both choices and the censored mass add up to 1."
+    # Midpoints of a fine grid up to MAX_WAIT, with the onset of the diffusion at t0
+    edges = np.unique(np.concatenate([np.linspace(0, t0, 101), np.linspace(t0, MAX_WAIT, 400001)]))
+    rt = (edges[1:] + edges[:-1])/2
+    widths = np.diff(edges)
+    total = sum((widths*np.exp(stage_log_likelihood(rt, choice, v, a, t0))).sum() for choice in (0, 1))
+    total += np.exp(stage_log_likelihood(-1., 0, v, a, t0))
+    assert total == pytest.approx(1, abs=1e-4)
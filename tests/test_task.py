@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of the rows written by the task engine."""
+
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import *
+
+import csv
+import io
+
+import numpy as np
+
+from results import load_session
+from task import Task
+from two_step import CSV_FIELDNAMES, TEXT_FIELDNAMES, GameConfig
+
+NUM_SESSIONS = 50
+
+def get_rows(task, num_trials, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for trial in task.generate_trials(rng, NUM_SESSIONS, num_trials):
+        choices = (rng.random((NUM_SESSIONS, task.num_stages))*task.num_options).astype(int)
+        # Some sessions are slow in one of the stages
+        choices[rng.random(choices.shape) < 0.1] = -1
+        rts = rng.uniform(0.2, 2, choices.shape)
+        rows.extend(task.get_rows(trial, choices, rts))
+    return rows
+
+def test_two_stage_rows(tmpdir):
+    task = Task.from_config(GameConfig)
+    rows = get_rows(task, 20)
+    assert task.get_fieldnames() == list(CSV_FIELDNAMES)
+    for row in rows:
+        assert sorted(row) == sorted(CSV_FIELDNAMES)
+        assert all(type(value) in (int, float) for key, value in row.items() if key not in TEXT_FIELDNAMES)
+    path = str(tmpdir.join('engine_game.csv'))
+    with io.open(path, 'w', newline='') as outf:
+        writer = csv.DictWriter(outf, fieldnames=task.get_fieldnames())
+        writer.writeheader()
+        writer.writerows(rows)
+    session = load_session(path)
+    chosen = session['choice1'] > 0
+    assert ((session['final_state'] == session['choice1']) == (session['common'] == 1))[chosen].all()
+    assert (session['final_state'][~chosen] == -1).all()
+    slow = (session['choice1'] < 0) | (session['choice2'] < 0)
+    assert (session['slow'] == slow).all()
+    assert (session['reward'][slow] == 0).all()
+
+def test_multi_stage_rows():
+    task = Task.create((3, 2, 2), (3, 4), 0.8)
+    fieldnames = task.get_fieldnames()
+    for row in get_rows(task, 5):
+        assert sorted(row) == sorted(fieldnames)
+        assert all(type(value) in (int, float) for value in row.values())
+
+def test_fixed_common_by_state():
+    "The first transitions are fixed even when the common probability differs between states."
+    transitions = [
+        [[[0.9, 0.1], [0.2, 0.8]]],
+        [[[0.6, 0.4], [0.3, 0.7]], [[0.95, 0.05], [0.55, 0.45]]],
+    ]
+    task = Task(transitions, (2, 2, 2), fixed_common=(True, False, True))
+    rng = np.random.default_rng(0)
+    for trial in task.generate_trials(rng, 2000, 3):
+        for common in trial['common']:
+            assert (common == task.fixed_common[trial['trial']]).all()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of the trials generated by Trial.get_sequence and TutorialConfig.get_common.
+
+The statistical checks are those of conformance.py, run on a small number
+of trials here and on many more with --run-slow."""
+
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import *
+
+import random
+from itertools import islice
+
+import pytest
+
+import conformance
+from two_step import TutorialConfig, GameConfig, Model, Trial
+
+# Trials of Trial.get_sequence checked by default, and with --run-slow
+NUM_TRIALS = 20000
+SLOW_TRIALS = {'get_sequence': 1000000, 'engine': 2000000, 'vectorized': 2000000}
+
+def get_trials(config, num_trials, seed=0):
+    random.seed(seed)
+    model = Model.create_random(config)
+    return model, list(islice(Trial.get_sequence(config, model), num_trials))
+
+@pytest.mark.parametrize('config_name', sorted(conformance.CONFIGS))
+def test_get_sequence(config_name):
+    "The checks of conformance.py pass on the trials of Trial.get_sequence."
+    config = conformance.CONFIGS[config_name]
+    random.seed(0)
+    statistics = conformance.Statistics(config)
+    for trial in conformance.get_sequence_trials(config, NUM_TRIALS//config.num_trials, config.num_trials):
+        statistics.add(trial)
+    for name, result, p_value in statistics.get_checks():
+        assert result, '{} (p = {})'.format(name, p_value)
+
+@pytest.mark.parametrize('config', [TutorialConfig, GameConfig])
+def test_transitions(config):
+    "Each initial symbol leads to its common final state only in common trials."
+    model, trials = get_trials(config, 1000)
+    common_states = dict(zip(model.isymbol_codes, model.colors))
+    for trial in trials:
+        for isymbol in trial.initial_state.symbols:
+            assert (isymbol.final_state.color == common_states[isymbol.code]) == trial.common
+
+def test_resume():
+    "A sequence resumed from a trial generates the same trials."
+    model, trials = get_trials(GameConfig, 20)
+    trial = trials[10]
+    random.setstate(trial.random_state)
+    resumed = list(islice(Trial.get_sequence(GameConfig, model, trial.number, trial.reward_probabilities), 10))
+    assert [t.reward_probabilities for t in resumed] == [t.reward_probabilities for t in trials[10:]]
+    assert [t.common for t in resumed] == [t.common for t in trials[10:]]
+
+@pytest.mark.slow
+@pytest.mark.parametrize('source', sorted(SLOW_TRIALS))
+@pytest.mark.parametrize('config_name', sorted(conformance.CONFIGS))
+def test_conformance(source, config_name):
+    "The checks pass on many trials of Trial.get_sequence and of the simulators that stand in for it."
+    config = conformance.CONFIGS[config_name]
+    for name, result, p_value in conformance.run_checks(source, config_name, SLOW_TRIALS[source], config.num_trials):
+        assert result, '{} (p = {})'.format(name, p_value)
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2019  Carolina Feher da Silva
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Definition of the two-stage task, shared by the task and the analysis tools.
+
+Has the configurations of the tutorial and the game, the generation of
+trials and the format of the results files, without PsychoPy, so the
+analysis tools run where the experiment runtime is not installed."""
+
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import *
+
+import os
+import random
+from itertools import chain
+from os.path import join
+
+# Directories
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+ASSETS_DIR = join(CURRENT_DIR, 'assets')
+# Texture variants of the images for each window size, built by build_assets.py
+ASSET_VARIANTS_DIR = join(ASSETS_DIR, 'variants')
+# Size of the screen the images are laid out for, in pixels
+DESIGN_SIZE = (1280, 1024)
+RESULTS_DIR = join(CURRENT_DIR, 'tutorial_results')
+# Precomputed tables for the adaptive design mode, built by adaptive_design.py
+DESIGN_TABLE = join(CURRENT_DIR, 'adaptive_design.npy')
+# Bank of reward probability walks for yoked sessions, built by walk_bank.py
+WALK_BANK = join(CURRENT_DIR, 'walk_bank.npy')
+
+# Seconds to wait for a choice before the trial is slow
+MAX_WAIT = 8
+
+# Configuration for tutorial and game
+class TutorialConfig:
+    final_state_colors = ('red', 'black')
+    initial_state_symbols = (7, 8)
+    final_state_symbols = ((9, 10), (11, 12))
+    num_trials = 20 #20
+    max_wait = MAX_WAIT
+    common_prob = 0.7 # Optimal performance 61%
+    diffusion_rate = 0.025
+    # Transitions of the first trials, to show both kinds early in the tutorial
+    fixed_common = (True, True, False)
+    @classmethod
+    def proceed(cls, trials, slow_trials):
+        del slow_trials
+        return trials < cls.num_trials
+    @classmethod
+    def do_break(cls, trials, slow_trials):
+        del trials, slow_trials
+        return False
+    @classmethod
+    def get_common(cls, trial):
+        if trial < len(cls.fixed_common):
+            return cls.fixed_common[trial]
+        return random.random() < cls.common_prob
+
+class GameConfig(TutorialConfig):
+    final_state_colors = ('pink', 'blue')
+    initial_state_symbols = (1, 2)
+    final_state_symbols = ((3, 4), (5, 6))
+    num_trials = 200
+    common_prob = 0.7
+    diffusion_rate = 0.025
+    break_interval = 50
+    fixed_common = ()
+    @classmethod
+    def do_break(cls, trials, slow_trials):
+        del slow_trials
+        return trials % cls.break_interval == 0 and trials < cls.num_trials
+
+class RewardProbability(float):
+    "Reward probability that drifts within a min and a max value."
+    MIN_VALUE = 0.25
+    MAX_VALUE = 0.75
+    def __new__(cls, value):
+        assert value >= cls.MIN_VALUE and value <= cls.MAX_VALUE
+        return super(RewardProbability, cls).__new__(cls, value)
+    @classmethod
+    def create_random(cls):
+        "Create a random reward probability within the allowed interval."
+        return cls(random.uniform(cls.MIN_VALUE, cls.MAX_VALUE))
+    def diffuse(self, diffusion_rate):
+        "Get the next probability by diffusion with this standard deviation."
+        return self.__class__(
+            self.reflect_on_boundaries(random.gauss(0, diffusion_rate)))
+    def get_reward(self):
+        "Get a reward (0 or 1) with this probability."
+        return int(random.random() < self)
+    def reflect_on_boundaries(self, incr):
+        "Reflect reward probability on boundaries."
+        next_value = self + (incr % 1)
+        if next_value > self.MAX_VALUE:
+            next_value = 2*self.MAX_VALUE - next_value
+        if next_value < self.MIN_VALUE:
+            next_value = 2*self.MIN_VALUE - next_value
+        return next_value
+
+class Symbol(object):
+    "A Tibetan symbol for a carpet or lamp."
+    def __init__(self, code):
+        self.code = code
+    def __str__(self):
+        return '{:02d}'.format(self.code)
+
+class InitialSymbol(Symbol):
+    "An initial state symbol."
+    def __init__(self, code, final_state):
+        super(InitialSymbol, self).__init__(code)
+        self.final_state = final_state
+
+class FinalSymbol(Symbol):
+    "A final state symbol."
+    def __init__(self, code, reward_probability):
+        super(FinalSymbol, self).__init__(code)
+        self.reward_probability = reward_probability
+        self.reward = self.reward_probability.get_reward()
+
+class State(object):
+    "A initial state in the task."
+    def __init__(self, symbols):
+        assert len(symbols) == 2
+        self.symbols = symbols
+
+class FinalState(State):
+    "A final state in the task."
+    def __init__(self, color, symbols):
+        self.color = color
+        super(FinalState, self).__init__(symbols)
+
+class Model(object):
+    """A transition model and configuration of final states for the task."""
+    def __init__(self, isymbol_codes, colors, fsymbol_codes):
+        self.isymbol_codes = isymbol_codes
+        self.colors = colors
+        self.fsymbol_codes = fsymbol_codes
+    @classmethod
+    def create_random(cls, config):
+        """Create a random model for the task from a given configuration."""
+        colors = list(config.final_state_colors)
+        random.shuffle(colors)
+        fsymbol_codes = list(config.final_state_symbols)
+        random.shuffle(fsymbol_codes)
+        return cls(config.initial_state_symbols, colors, fsymbol_codes)
+    def get_paths(self, common):
+        "Generator for the paths from initial symbol to final symbols."
+        if common:
+            for isymbol_code, color, fsymbol_codes in zip(
+                    self.isymbol_codes, self.colors, self.fsymbol_codes):
+                yield (isymbol_code, color, fsymbol_codes)
+        else:
+            for isymbol_code, color, fsymbol_codes in zip(
+                    self.isymbol_codes, reversed(self.colors), reversed(self.fsymbol_codes)):
+                yield (isymbol_code, color, fsymbol_codes)
+    def __str__(self):
+        output = "Common transitions: "
+        for isymbol_code, color, fsymbol_codes in self.get_paths(True):
+            output += "{} -> {} -> {}; ".format(isymbol_code, color, fsymbol_codes)
+        return output
+
+class Trial(object):
+    "A trial in the task."
+    def __init__(self, number, initial_state, common, reward_probabilities=None,
+                 random_state=None):
+        self.number = number
+        self.initial_state = initial_state
+        self.common = common
+        # State from which the trial was generated, to resume a session from it
+        self.reward_probabilities = reward_probabilities
+        self.random_state = random_state
+    @classmethod
+    def get_sequence(cls, config, model, trials=0, reward_probabilities=None, walk=None):
+        """Get an infinite sequence of trials with this configuration.
+
+        A sequence is resumed from a trial by giving its number and reward
+        probabilities, with the random state it was generated from. If a walk
+        from the walk bank is given, the reward probabilities of each trial
+        are those of the walk, in the order of the configuration's final
+        symbols, and diffuse from its last trial after it ends."""
+        if reward_probabilities is None:
+            reward_probabilities = {
+                fsymbol_code: RewardProbability.create_random()
+                for fsymbol_code in chain(*config.final_state_symbols)
+            }
+        else:
+            reward_probabilities = {
+                fsymbol_code: RewardProbability(prob)
+                for fsymbol_code, prob in reward_probabilities.items()
+            }
+        while True:
+            if walk is not None and trials < len(walk):
+                reward_probabilities = {
+                    fsymbol_code: RewardProbability(prob)
+                    for fsymbol_code, prob in zip(chain(*config.final_state_symbols), walk[trials])
+                }
+            random_state = random.getstate()
+            probs = {fsymbol_code: float(prob) for fsymbol_code, prob in reward_probabilities.items()}
+            common = config.get_common(trials)
+            isymbols = []
+            for isymbol_code, color, fsymbol_codes in model.get_paths(common):
+                fsymbols = [
+                    FinalSymbol(fsymbol_code, reward_probabilities[fsymbol_code])
+                    for fsymbol_code in fsymbol_codes
+                ]
+                random.shuffle(fsymbols)
+                final_state = FinalState(color, tuple(fsymbols))
+                isymbols.append(InitialSymbol(isymbol_code, final_state))
+            random.shuffle(isymbols)
+            initial_state = State(isymbols)
+            yield cls(trials, initial_state, common, probs, random_state)
+            for fsymbol_code, prob in reward_probabilities.items():
+                reward_probabilities[fsymbol_code] = prob.diffuse(config.diffusion_rate)
+            trials += 1
+
+CSV_FIELDNAMES = (
+    'trial', 'common', 'reward.1.1', 'reward.1.2', 'reward.2.1',
+    'reward.2.2', 'isymbol_lft', 'isymbol_rgt', 'rt1', 'choice1', 'final_state',
+    'fsymbol_lft', 'fsymbol_rgt', 'rt2', 'choice2', 'reward', 'slow', 'walk', 'walk_bank')
+# Columns that are not numbers: the id of the walk bank of the walk, empty without a walk
+TEXT_FIELDNAMES = ('walk_bank',)
+
+def code_to_bin(code, common=True):
+    if common:
+        return 2 - code % 2
+    else:
+        return code % 2 + 1
+
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+"""Shared bank of pre-generated reward probability walks.
+
+A walk is the sequence of reward probabilities of the four final symbols
+over a session, generated as RewardProbability does. The bank keeps many
+walks that passed quality checks in one array, memory-mapped so that loading
+a walk by its id at the start of a session only reads that walk, and keeps
+the statistics of each walk and the settings it was built with next to it.
+Sessions given the same walk id are yoked: their participants see identical
+reward probabilities. Build a bank by running this module."""
+
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import *
+
+import argparse
+import io
+import json
+import os
+
+import numpy as np
+
+from cache import content_hash
+from simulate import create_reward_probabilities, diffuse
+from two_step import WALK_BANK, GameConfig, RewardProbability
+
+# Statistics of each walk, by which walks are checked and can be chosen
+STATISTICS = ('best_prob', 'state_difference', 'best_changes')
+
+def get_metadata_path(bank_path):
+    return os.path.splitext(bank_path)[0] + '.json'
+
+def get_statistics(walks):
+    """Get the statistics of walks with the trial and the final symbol as the last dimensions.
+
+    The symbols are in the order of the configuration's final_state_symbols,
+    so the first two are in one final state and the last two in the other.
+    best_prob is the mean reward probability of the best symbol,
+    state_difference the mean difference between the best symbols of the two
+    final states, which is what model-based choices at the first stage gain
+    from, and best_changes the number of times the best symbol changes."""
+    best = walks.argmax(axis=-1)
+    return {
+        'best_prob': walks.max(axis=-1).mean(axis=-1),
+        'state_difference': np.abs(walks[..., :2].max(axis=-1) - walks[..., 2:].max(axis=-1)).mean(axis=-1),
+        'best_changes': (best[..., 1:] != best[..., :-1]).sum(axis=-1),
+    }
+
+def build_bank(bank_path, num_walks=1000, num_trials=200, diffusion_rate=0.025,
+               min_state_difference=0.1, min_best_changes=2, seed=0):
+    """Generate walks until num_walks pass the quality checks and save them to disk.
+
+    A walk passes if the best final states differ enough on average and the
+    best symbol changes at least min_best_changes times, so that learning
+    pays off throughout the session."""
+    rng = np.random.default_rng(seed)
+    accepted = []
+    num_accepted = num_candidates = 0
+    while num_accepted < num_walks:
+        walks = np.zeros((num_walks, num_trials, 4))
+        walks[:, 0] = create_reward_probabilities(rng, (num_walks, 4))
+        for t in range(1, num_trials):
+            walks[:, t] = diffuse(rng, walks[:, t - 1], diffusion_rate)
+        statistics = get_statistics(walks)
+        passed = ((statistics['state_difference'] >= min_state_difference) &
+                  (statistics['best_changes'] >= min_best_changes))
+        accepted.append(walks[passed])
+        num_accepted += passed.sum()
+        num_candidates += num_walks
+    walks = np.concatenate(accepted)[:num_walks]
+    settings = {
+        'num_walks': num_walks,
+        'num_trials': num_trials,
+        'diffusion_rate': diffusion_rate,
+        'reward_bounds': [RewardProbability.MIN_VALUE, RewardProbability.MAX_VALUE],
+        'min_state_difference': min_state_difference,
+        'min_best_changes': min_best_changes,
+        'seed': seed,
+    }
+    statistics = get_statistics(walks)
+    np.save(bank_path, walks)
+    with io.open(get_metadata_path(bank_path), 'w', encoding='utf-8') as outf:
+        outf.write(json.dumps({
+            'id': content_hash(settings)[:12],
+            'settings': settings,
+            'acceptance_rate': num_walks/num_candidates,
+            'statistics': {name: statistics[name].tolist() for name in STATISTICS},
+        }))
+
+class WalkBank(object):
+    "A bank of walks built by build_bank, with walks identified by their index."
+    def __init__(self, bank_path):
+        with io.open(get_metadata_path(bank_path), 'r', encoding='utf-8') as inf:
+            metadata = json.load(inf)
+        self.id = metadata['id']
+        self.settings = metadata['settings']
+        self.statistics = metadata['statistics']
+        # Walks have dimensions walk, trial and final symbol
+        self.walks = np.load(bank_path, mmap_mode='r')
+    def __len__(self):
+        return len(self.walks)
+    def get_walk(self, walk_id):
+        "Get the reward probabilities of a walk, by trial and final symbol."
+        if not 0 <= walk_id < len(self.walks):
+            raise KeyError('No walk {} in bank {}'.format(walk_id, self.id))
+        return np.array(self.walks[walk_id])
+    def get_statistics(self, walk_id):
+        return {name: self.statistics[name][walk_id] for name in STATISTICS}
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the bank of reward probability walks.')
+    parser.add_argument('--output', default=WALK_BANK)
+    parser.add_argument('--walks', type=int, default=1000)
+    parser.add_argument('--trials', type=int, default=GameConfig.num_trials, help='trials per walk')
+    parser.add_argument('--diffusion-rate', type=float, default=GameConfig.diffusion_rate)
+    parser.add_argument('--min-state-difference', type=float, default=0.1)
+    parser.add_argument('--min-best-changes', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    build_bank(args.output, args.walks, args.trials, args.diffusion_rate,
+               args.min_state_difference, args.min_best_changes, args.seed)
+    bank = WalkBank(args.output)
+    print('Bank {}: {} walks of {} trials'.format(bank.id, len(bank), args.trials))
+    for name in STATISTICS:
+        values = np.array(bank.statistics[name])
+        print('  {:<17} median {:.3f}, range {:.3f} to {:.3f}'.format(
+            name, np.median(values), values.min(), values.max()))
+
+if __name__ == '__main__':
+    main()